@@ -0,0 +1,159 @@
+import numpy as np
+from torch.utils.data import Sampler, Subset
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """
+    Batch sampler that groups items of similar token length and fills each batch up to `max_tokens` padded
+    tokens (batch size times the longest member) instead of a fixed batch size. Items are sorted by length
+    within windows of `window` items (all items by default), so that outputs can be restored to dataset order
+    one window at a time. Without `shuffle`, windows are consecutive ranges of items and batches run in order.
+    With `shuffle`, windows are drawn from a new permutation of the items on each pass and batches are shuffled
+    across windows.
+    """
+    def __init__(self, lengths, max_tokens, window=None, shuffle=False, seed=0):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.max_tokens = max_tokens
+        self.window = window if window is not None else max(len(self.lengths), 1)
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+
+        self._plan = None
+
+    def _pack(self, inds):
+        # Greedy packing of items sorted by length: the last item added is the longest in its batch
+        inds = inds[np.argsort(self.lengths[inds], kind="stable")]
+        batches = []
+        start = 0
+        for i, length in enumerate(self.lengths[inds].tolist()):
+            if i > start and (i - start + 1) * length > self.max_tokens:
+                batches.append(inds[start:i])
+                start = i
+        if start < len(inds):
+            batches.append(inds[start:])
+
+        return batches
+
+    def plan(self):
+        """
+        The windows of the next pass, as (window items, batches) pairs of dataset index arrays.
+        """
+        if self._plan is None:
+            order = self.rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+            self._plan = []
+            for start in range(0, len(order), self.window):
+                window_inds = order[start:start + self.window]
+                self._plan.append((window_inds, self._pack(window_inds)))
+
+        return self._plan
+
+    def __iter__(self):
+        plan = self.plan()
+        self._plan = None # The next pass draws a new plan
+
+        batches = [batch for _, window_batches in plan for batch in window_batches]
+        if self.shuffle:
+            batches = [batches[i] for i in self.rng.permutation(len(batches))]
+
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        return sum(len(window_batches) for _, window_batches in self.plan())
+
+
+def token_budget_sampler(dataset, max_tokens, window=None, shuffle=False, seed=0):
+    """
+    TokenBudgetBatchSampler over the pretokenized lengths of `dataset`, or None if `max_tokens` is None.
+    """
+    if max_tokens is None:
+        return None
+
+    lengths = getattr(dataset, "token_lengths", lambda: None)()
+    if lengths is None:
+        raise ValueError(f"{type(dataset).__name__} has no pretokenized lengths for a token budget; load it with a token_cache")
+
+    return TokenBudgetBatchSampler(lengths, max_tokens, window=window, shuffle=shuffle, seed=seed)
+
+
+def loader_batching(dataset, batch_size, max_tokens=None, window=None, shuffle=False, seed=0):
+    """
+    DataLoader batching arguments: a token budget batch sampler when `max_tokens` is set, or a fixed
+    `batch_size` otherwise.
+    """
+    sampler = token_budget_sampler(dataset, max_tokens, window=window, shuffle=shuffle, seed=seed)
+    if sampler is None:
+        return {"batch_size": batch_size, "shuffle": shuffle}
+
+    return {"batch_sampler": sampler}
+
+
+def _batch_len(batch):
+    return len(batch[0]) if isinstance(batch, (tuple, list)) else len(batch)
+
+
+def loader_windows(dataloader):
+    """
+    Groups the batches of an unshuffled DataLoader into windows of consecutive dataset items, yielding
+    (start, end, batches) with `batches` a list of (positions within the window, batch) pairs. Scattering batch
+    outputs to their positions restores dataset order. Without a token budget, each batch is its own window.
+    """
+    sampler = dataloader.batch_sampler
+
+    if not isinstance(sampler, TokenBudgetBatchSampler):
+        start = 0
+        for batch in dataloader:
+            end = start + _batch_len(batch)
+            yield start, end, [(np.arange(end - start), batch)]
+            start = end
+
+        return
+
+    if sampler.shuffle:
+        raise ValueError("Dataset order cannot be restored from a shuffled sampler")
+
+    plan = sampler.plan()
+    it = iter(dataloader)
+    for window_inds, batches in plan:
+        start, end = int(window_inds[0]), int(window_inds[-1]) + 1
+        yield start, end, [(inds - start, next(it)) for inds in batches]
+
+
+def restore_order(outputs, positions):
+    """
+    Concatenates the per-batch outputs of a window in dataset order, given the positions of each batch within the
+    window. Outputs of different widths along the second axis (token embeddings) are right-padded with zeros.
+    """
+    if len(outputs) == 1 and np.array_equal(positions[0], np.arange(len(positions[0]))):
+        return outputs[0]
+
+    if outputs[0].ndim > 1:
+        width = max(x.shape[1] for x in outputs)
+        outputs = [np.pad(x, [(0, 0), (0, width - x.shape[1])] + [(0, 0)] * (x.ndim - 2)) for x in outputs]
+
+    concat = np.concatenate(outputs)
+    ordered = np.empty_like(concat)
+    ordered[np.concatenate(positions)] = concat
+
+    return ordered
+
+
+class BatchedSubset(Subset):
+    """
+    Subset of the items at `indices`, keeping the batched fetches, collate function and pretokenized lengths of
+    the full dataset.
+    """
+    def __init__(self, dataset, indices):
+        # Plain ints, as datasets may index with them directly
+        super().__init__(dataset, np.asarray(indices, dtype=np.int64).tolist())
+
+    @property
+    def collate_fn(self):
+        return getattr(self.dataset, "collate_fn", None)
+
+    def token_lengths(self):
+        lengths = getattr(self.dataset, "token_lengths", lambda: None)()
+        if lengths is None:
+            return None
+
+        return np.asarray(lengths)[self.indices]
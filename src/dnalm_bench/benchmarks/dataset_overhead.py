@@ -0,0 +1,103 @@
+import os
+import time
+import json
+import argparse
+
+import numpy as np
+
+from ..task_1_paired_control.components import PairedControlDataset
+from ..task_2_5_single.components import SimpleSequence, VariantDataset
+from ..task_2_5_single.finetune import ChromatinEndToEndDataset, PeaksEndToEndDataset
+
+work_dir = os.environ.get("DART_WORK_DIR", "")
+
+peak_classes = {
+    "GM12878": 0,
+    "H1ESC": 1,
+    "HEPG2": 2,
+    "IMR90": 3,
+    "K562": 4
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Measures per-item overhead of the sequence datasets")
+    parser.add_argument("--genome_fa", type=str, default=os.path.join(work_dir, "refs/GRCh38_no_alt_analysis_set_GCA_000001405.15.fasta"))
+    parser.add_argument("--ccre_tsv", type=str, default=os.path.join(work_dir, "task_1_ccre/processed_inputs/ENCFF420VPZ_processed.tsv"))
+    parser.add_argument("--peaks_tsv", type=str, default=os.path.join(work_dir, "task_3_peak_classification/processed_inputs/peaks_by_cell_label_unique_dataloader_format.tsv"))
+    parser.add_argument("--chromatin_tsv", type=str, default=os.path.join(work_dir, "task_4_chromatin_activity/processed_data/cell_line_expanded_peaks/GM12878_peaks.bed"))
+    parser.add_argument("--assay_bw", type=str, default=os.path.join(work_dir, "task_4_chromatin_activity/processed_data/bigwigs/GM12878_unstranded.bw"))
+    parser.add_argument("--variants_tsv", type=str, default=None, help="Optional variants file for VariantDataset")
+    parser.add_argument("--num_items", type=int, default=4096)
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--out_path", type=str, default=os.path.join(work_dir, "benchmarks/dataset_overhead.json"))
+    args = parser.parse_args()
+    return args
+
+
+def us_per_item(fn, inds):
+    start = time.perf_counter()
+    fn(inds)
+    end = time.perf_counter()
+
+    return (end - start) / len(inds) * 1e6
+
+
+def row_access(dataset, inds):
+    # Previous element access: one DataFrame.row call and tuple unpack per item
+    for idx in inds:
+        dataset.elements_df.row(int(idx))
+
+
+def table_access(dataset, inds):
+    dataset.elements.chroms(inds)
+    for name in dataset.elements.columns:
+        dataset.elements[name][inds].tolist()
+
+
+def getitem(dataset, inds):
+    for idx in inds:
+        dataset[int(idx)]
+
+
+def getitems(dataset, batch_size):
+    def fn(inds):
+        for i in range(0, len(inds), batch_size):
+            dataset.__getitems__(inds[i:i + batch_size].tolist())
+
+    return fn
+
+
+def main():
+    args = parse_args()
+
+    datasets = {
+        "PairedControlDataset": lambda: PairedControlDataset(args.genome_fa, args.ccre_tsv, None, 0),
+        "PairedControlDataset_num_ctrls_4": lambda: PairedControlDataset(args.genome_fa, args.ccre_tsv, None, 0, num_ctrls=4),
+        "SimpleSequence": lambda: SimpleSequence(args.genome_fa, args.ccre_tsv, None, 0),
+        "PeaksEndToEndDataset": lambda: PeaksEndToEndDataset(args.genome_fa, args.peaks_tsv, None, peak_classes),
+        "ChromatinEndToEndDataset": lambda: ChromatinEndToEndDataset(args.genome_fa, args.assay_bw, args.chromatin_tsv, None, 557),
+    }
+    if args.variants_tsv is not None:
+        datasets["VariantDataset"] = lambda: VariantDataset(args.genome_fa, args.variants_tsv, None, 0)
+
+    metrics = {}
+    for name, make_dataset in datasets.items():
+        dataset = make_dataset()
+        inds = np.random.default_rng(0).choice(len(dataset), size=min(args.num_items, len(dataset)), replace=False)
+
+        metrics[name] = {
+            "row_access_us": us_per_item(lambda x: row_access(dataset, x), inds),
+            "table_access_us": us_per_item(lambda x: table_access(dataset, x), inds),
+            "getitem_us": us_per_item(lambda x: getitem(dataset, x), inds),
+            "getitems_us": us_per_item(getitems(dataset, args.batch_size), inds),
+        }
+
+        print(name, ", ".join(f"{k}: {v:.1f}" for k, v in metrics[name].items()))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.out_path)), exist_ok=True)
+    with open(args.out_path, "w") as f:
+        json.dump(metrics, f, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import os
+import sys
+import time
+import json
+
+import numpy as np
+import pyfaidx
+from torch.utils.data import DataLoader, Dataset
+
+from ..genome import FastaGenome, CompiledGenome
+from ..encoding import N_TOKEN, encode_tokens
+from ..task_1_paired_control.components import PairedControlDataset
+
+work_dir = os.environ.get("DART_WORK_DIR", "")
+
+
+class PerItemFastaGenome(FastaGenome):
+    # Previous dataset behavior: open and close the FASTA for every item
+    def chrom_size(self, chrom):
+        fa = pyfaidx.Fasta(self.genome_fa, one_based_attributes=False)
+        size = len(fa[chrom])
+        fa.close()
+
+        return size
+
+    def fetch_tokens(self, chrom, start, end):
+        tokens = np.full(end - start, N_TOKEN, dtype=np.uint8)
+
+        fa = pyfaidx.Fasta(self.genome_fa, one_based_attributes=False)
+
+        sequence_data = fa[chrom][max(0, start):end]
+        a = sequence_data.start - start
+        b = sequence_data.end - start
+        tokens[a:b] = encode_tokens(sequence_data.seq)
+
+        fa.close()
+
+        return tokens
+
+
+class PerItemDataset(Dataset):
+    # Hides __getitems__, so the DataLoader fetches one region per call
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        return self.dataset[idx]
+
+
+def items_per_sec(dataset, num_items, batch_size, num_workers):
+    inds = np.random.default_rng(0).choice(len(dataset), size=min(num_items, len(dataset)), replace=False)
+    inds.sort()
+    dataloader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, sampler=inds.tolist())
+
+    start = time.perf_counter()
+    count = 0
+    for seqs, _, _ in dataloader:
+        count += seqs.shape[0]
+    end = time.perf_counter()
+
+    return count / (end - start)
+
+
+if __name__ == "__main__":
+    num_items = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    compiled_dir = sys.argv[2] if len(sys.argv) > 2 else None
+
+    genome_fa = os.path.join(work_dir, "refs/GRCh38_no_alt_analysis_set_GCA_000001405.15.fasta")
+    elements_tsv = os.path.join(work_dir, "task_1_ccre/processed_inputs/ENCFF420VPZ_processed.tsv")
+
+    batch_size = 256
+    seed = 0
+
+    out_dir = os.path.join(work_dir, "benchmarks")
+    os.makedirs(out_dir, exist_ok=True)
+    out_path = os.path.join(out_dir, "genome_access.json")
+
+    dataset = PairedControlDataset(genome_fa, elements_tsv, None, seed)
+
+    metrics = {}
+    for num_workers in [0, 4]:
+        dataset.genome = PerItemFastaGenome(genome_fa)
+        metrics[f"per_item_open_workers_{num_workers}"] = items_per_sec(PerItemDataset(dataset), num_items, batch_size, num_workers)
+
+        dataset.genome = FastaGenome(genome_fa)
+        metrics[f"persistent_workers_{num_workers}"] = items_per_sec(PerItemDataset(dataset), num_items, batch_size, num_workers)
+        metrics[f"persistent_batched_workers_{num_workers}"] = items_per_sec(dataset, num_items, batch_size, num_workers)
+
+        if compiled_dir is not None:
+            dataset.genome = CompiledGenome(compiled_dir)
+            metrics[f"compiled_batched_workers_{num_workers}"] = items_per_sec(dataset, num_items, batch_size, num_workers)
+
+    with open(out_path, "w") as f:
+        json.dump(metrics, f, indent=4)
+
+    for k, v in metrics.items():
+        print(f"{k}: {v:.1f} items/sec")
@@ -0,0 +1,131 @@
+import os
+import time
+import json
+import argparse
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from transformers import BertConfig, BertForMaskedLM, MistralConfig, MistralForCausalLM
+
+from ..pll import LMHeadAtPositions
+from ..mutagenesis import saturation_mutagenesis, substitution_sites, mutant_seqs
+
+work_dir = os.environ.get("DART_WORK_DIR", "")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Measures saturation mutagenesis against scoring each mutant on its own, on random-weight character-level stand-ins")
+    parser.add_argument("--seq_len", type=int, default=200)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--num_threads", type=int, default=None)
+    parser.add_argument("--out_path", type=str, default=os.path.join(work_dir, "benchmarks/mutagenesis.json"))
+    args = parser.parse_args()
+    return args
+
+
+class CharStandIn(LMHeadAtPositions):
+    # Start token 1, end token 2, mask token 4, bases 5-8 and N 9
+    device = "cpu"
+    mask_token = 4
+
+    def __init__(self, model, lm_head, causal, kv_cache, batch_size):
+        self.model = model
+        self.lm_head = lm_head
+        self.causal = causal
+        self.kv_cache = kv_cache
+        self.batch_size = batch_size
+
+    def tokenize(self, seqs):
+        seqs = torch.as_tensor(seqs)
+        codes = torch.where(seqs.sum(dim=2) > 0, seqs.argmax(dim=2) + 5, 9)
+        batch_size = codes.shape[0]
+        tokens = torch.cat([torch.ones((batch_size, 1), dtype=torch.long), codes, torch.full((batch_size, 1), 2)], dim=1)
+        starts = torch.ones(batch_size, dtype=torch.long)
+        ends = torch.full((batch_size,), tokens.shape[1] - 1)
+
+        return tokens, starts, ends, torch.ones_like(tokens)
+
+    def model_fwd(self, tokens_in, attention_mask, tokens_out):
+        with torch.no_grad():
+            logits = self.model(tokens_in, attention_mask=attention_mask).logits.swapaxes(1, 2)
+            if self.causal:
+                lls = torch.zeros(tokens_out.shape[:2])
+                lls[:,1:] = -F.cross_entropy(logits[:,:,:-1], tokens_out[:,1:], reduction="none")
+            else:
+                lls = -F.cross_entropy(logits, tokens_out, reduction="none")
+        return lls
+
+
+def naive_effects(evaluator, seq):
+    # Previous approach: every mutant scored on its own, in batches, against the reference
+    pos, alts = substitution_sites(seq)
+    seqs = np.concatenate([seq[None], mutant_seqs(seq, pos, alts)])
+    tokens, starts, ends, attention_mask = evaluator.tokenize(seqs)
+    ref = tokens[0]
+    scores = []
+    for i in range(0, tokens.shape[0], evaluator.batch_size):
+        tokens_out = tokens[i:i + evaluator.batch_size]
+        if evaluator.causal:
+            tokens_in = tokens_out
+        else:
+            tokens_in = ref.repeat(tokens_out.shape[0], 1)
+            tokens_in[tokens_out != ref] = evaluator.mask_token
+        lls = evaluator.model_fwd(tokens_in, attention_mask[i:i + evaluator.batch_size], tokens_out)
+        scores.append(lls[:,int(starts[0]):int(ends[0])].sum(dim=1))
+    scores = torch.cat(scores).numpy()
+
+    out = np.zeros((seq.shape[0], 4), dtype=np.float32)
+    if evaluator.causal:
+        out[pos,alts] = scores[1:] - scores[0]
+    else:
+        # Masked scores differ only at the masked token, so the reference is scored under each mutant's masking
+        ref_scores = []
+        for i in range(1, tokens.shape[0], evaluator.batch_size):
+            tokens_out = tokens[i:i + evaluator.batch_size]
+            tokens_in = ref.repeat(tokens_out.shape[0], 1)
+            tokens_in[tokens_out != ref] = evaluator.mask_token
+            lls = evaluator.model_fwd(tokens_in, attention_mask[i:i + evaluator.batch_size], ref.expand_as(tokens_in))
+            ref_scores.append(lls[:,int(starts[0]):int(ends[0])].sum(dim=1))
+        out[pos,alts] = scores[1:] - torch.cat(ref_scores).numpy()
+
+    return out
+
+
+def main():
+    args = parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    torch.manual_seed(0)
+    seq = np.eye(4, dtype=np.int8)[np.random.default_rng(0).integers(0, 4, size=args.seq_len)]
+
+    mistral = MistralForCausalLM(MistralConfig(vocab_size=16, hidden_size=256, intermediate_size=1024, num_hidden_layers=4,
+                                               num_attention_heads=8, num_key_value_heads=2))
+    bert = BertForMaskedLM(BertConfig(vocab_size=16, hidden_size=256, num_hidden_layers=4, num_attention_heads=8,
+                                      intermediate_size=1024, max_position_embeddings=4096))
+    stand_ins = {
+        "causal_kv_cache": CharStandIn(mistral.eval(), "lm_head", True, True, args.batch_size),
+        "causal_full": CharStandIn(mistral, "lm_head", True, False, args.batch_size),
+        "masked": CharStandIn(bert.eval(), "cls", False, False, args.batch_size),
+    }
+
+    metrics = {}
+    for name, evaluator in stand_ins.items():
+        start = time.perf_counter()
+        expected = naive_effects(evaluator, seq)
+        naive_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        out = saturation_mutagenesis(evaluator, seq)
+        engine_s = time.perf_counter() - start
+
+        metrics[name] = {"naive_s": naive_s, "engine_s": engine_s, "speedup": naive_s / engine_s,
+                         "max_abs_diff": float(np.abs(out - expected).max())}
+        print(name, ", ".join(f"{k}: {v:.4g}" for k, v in metrics[name].items()))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.out_path)), exist_ok=True)
+    with open(args.out_path, "w") as f:
+        json.dump(metrics, f, indent=4)
+
+if __name__ == "__main__":
+    main()
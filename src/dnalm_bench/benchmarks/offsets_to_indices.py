@@ -0,0 +1,107 @@
+import os
+import time
+import json
+import argparse
+
+import numpy as np
+import torch
+from transformers import AutoTokenizer
+
+from ..tokenization import offsets_to_indices
+from ..utils import onehot_to_chars
+
+work_dir = os.environ.get("DART_WORK_DIR", "")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Measures the offset mapping to base index conversion used for detokenization")
+    parser.add_argument("--tokenizer", type=str, default=None, help="HF tokenizer name or path; synthetic BPE-like offsets if not given")
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--seq_len", type=int, default=2114)
+    parser.add_argument("--num_reps", type=int, default=10)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--out_path", type=str, default=os.path.join(work_dir, "benchmarks/offsets_to_indices.json"))
+    args = parser.parse_args()
+    return args
+
+
+def loop_offsets_to_indices(offsets, seq_len):
+    # Previous implementation: Python loop over batch and tokens
+    gather_idx = np.zeros((offsets.shape[0], seq_len), dtype=np.int64)
+    for i, offset in enumerate(offsets):
+        for j, (start, end) in enumerate(offset):
+            gather_idx[i,start:end] = j
+
+    return gather_idx
+
+
+def synthetic_offsets(batch_size, seq_len, rng):
+    # Variable-length tokens between a leading and trailing special token, right-padded to the longest sequence
+    rows = []
+    for _ in range(batch_size):
+        ends = np.cumsum(rng.integers(1, 13, size=seq_len))
+        ends = np.append(ends[ends < seq_len], seq_len)
+        starts = np.concatenate([[0], ends[:-1]])
+        rows.append(np.stack([starts, ends], axis=1))
+
+    width = max(len(r) for r in rows) + 2
+    offsets = np.zeros((batch_size, width, 2), dtype=np.int64)
+    for i, r in enumerate(rows):
+        offsets[i,1:len(r) + 1] = r
+
+    return torch.from_numpy(offsets)
+
+
+def tokenizer_offsets(tokenizer, batch_size, seq_len, rng):
+    seqs = np.eye(4, dtype=np.int8)[rng.integers(0, 4, size=(batch_size, seq_len))]
+    encoded = tokenizer(onehot_to_chars(seqs), return_tensors="pt", padding=True, return_offsets_mapping=True)
+
+    return encoded["offset_mapping"]
+
+
+def ms_per_call(fn, num_reps, device):
+    fn()
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(num_reps):
+        fn()
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    end = time.perf_counter()
+
+    return (end - start) / num_reps * 1e3
+
+
+def main():
+    args = parse_args()
+    rng = np.random.default_rng(0)
+
+    if args.tokenizer is None:
+        offsets = synthetic_offsets(args.batch_size, args.seq_len, rng)
+    else:
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer, trust_remote_code=True)
+        offsets = tokenizer_offsets(tokenizer, args.batch_size, args.seq_len, rng)
+
+    offsets_device = offsets.to(args.device)
+    expected = loop_offsets_to_indices(offsets, args.seq_len)
+    if not np.array_equal(offsets_to_indices(offsets_device, args.seq_len).numpy(force=True), expected):
+        raise ValueError("Vectorized indices do not match the loop implementation")
+
+    metrics = {
+        "batch_size": args.batch_size,
+        "seq_len": args.seq_len,
+        "num_tokens": offsets.shape[1],
+        "loop_ms": ms_per_call(lambda: loop_offsets_to_indices(offsets, args.seq_len), args.num_reps, "cpu"),
+        "vectorized_ms": ms_per_call(lambda: offsets_to_indices(offsets_device, args.seq_len), args.num_reps, args.device),
+    }
+    metrics["speedup"] = metrics["loop_ms"] / metrics["vectorized_ms"]
+
+    print(", ".join(f"{k}: {v:.1f}" if isinstance(v, float) else f"{k}: {v}" for k, v in metrics.items()))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.out_path)), exist_ok=True)
+    with open(args.out_path, "w") as f:
+        json.dump(metrics, f, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import os
+import time
+import json
+import argparse
+
+import numpy as np
+import torch
+from transformers import MistralConfig, MistralForCausalLM
+
+from ..pll import LMHeadAtPositions, positions_ll, pair_positions_ll
+
+work_dir = os.environ.get("DART_WORK_DIR", "")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Measures causal scoring of sequence pairs with and without a shared prefix pass, on a random-weight Mistral stand-in")
+    parser.add_argument("--num_tokens", type=int, default=512, help="Tokens per sequence")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--diff_fracs", type=float, nargs="+", default=[0.25, 0.5, 0.9], help="Relative position of the first differing token")
+    parser.add_argument("--num_reps", type=int, default=3)
+    parser.add_argument("--num_threads", type=int, default=None)
+    parser.add_argument("--out_path", type=str, default=os.path.join(work_dir, "benchmarks/pair_prefix.json"))
+    args = parser.parse_args()
+    return args
+
+
+class StandInWrapper(LMHeadAtPositions):
+    lm_head = "lm_head"
+    causal = True
+    kv_cache = True
+
+    def __init__(self, model):
+        self.model = model
+
+
+def seconds_per_call(fn, num_reps):
+    fn()
+    start = time.perf_counter()
+    for _ in range(num_reps):
+        out = fn()
+    end = time.perf_counter()
+
+    return (end - start) / num_reps, out
+
+
+def main():
+    args = parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    torch.manual_seed(0)
+
+    model = MistralForCausalLM(MistralConfig(vocab_size=4096, hidden_size=256, intermediate_size=1024, num_hidden_layers=4,
+                                             num_attention_heads=8, num_key_value_heads=2))
+    model.eval()
+    wrapper = StandInWrapper(model)
+
+    metrics = {}
+    for diff_frac in args.diff_fracs:
+        tokens_a = torch.randint(5, 4096, (args.batch_size, args.num_tokens))
+        tokens_b = tokens_a.clone()
+        diff_pos = int(args.num_tokens * diff_frac)
+        tokens_b[:,diff_pos] = (tokens_b[:,diff_pos] + 1 - 5) % 4091 + 5
+        attention_mask = torch.ones_like(tokens_a)
+        starts = torch.ones(args.batch_size, dtype=torch.long)
+        ends = torch.full((args.batch_size,), args.num_tokens - 1)
+
+        def separate():
+            return (positions_ll(wrapper.model_fwd_at, tokens_a, attention_mask, tokens_a, starts, ends),
+                    positions_ll(wrapper.model_fwd_at, tokens_b, attention_mask, tokens_b, starts, ends))
+
+        def paired():
+            return pair_positions_ll(wrapper.model_fwd_pair_at, tokens_a, attention_mask, starts, ends,
+                                     tokens_b, attention_mask, starts, ends)
+
+        separate_s, expected = seconds_per_call(separate, args.num_reps)
+        paired_s, out = seconds_per_call(paired, args.num_reps)
+
+        metrics[diff_frac] = {
+            "separate_ms": separate_s * 1e3,
+            "paired_ms": paired_s * 1e3,
+            "speedup": separate_s / paired_s,
+            "max_abs_diff": float(max(np.abs(out[0] - expected[0]).max(), np.abs(out[1] - expected[1]).max())),
+        }
+        print(f"diff_frac {diff_frac}", ", ".join(f"{k}: {v:.4g}" for k, v in metrics[diff_frac].items()))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.out_path)), exist_ok=True)
+    with open(args.out_path, "w") as f:
+        json.dump(metrics, f, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import os
+import time
+import json
+import argparse
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from transformers import BertConfig, BertForMaskedLM, EsmConfig, EsmForMaskedLM, MambaConfig, MambaForCausalLM
+
+from ..pll import LMHeadAtPositions, masked_pll
+
+work_dir = os.environ.get("DART_WORK_DIR", "")
+
+# Small random-weight stand-ins with each model's vocabulary and approximate tokens per base: BERT for DNABERT-2
+# and GENA-LM, ESM for NT, and Mamba for Caduceus, with the name of each LM head module
+stand_ins = {
+    "DNABERT-2": (lambda: BertForMaskedLM(BertConfig(vocab_size=4096, hidden_size=128, num_hidden_layers=2, num_attention_heads=4,
+                                                     intermediate_size=512, max_position_embeddings=4096)), 4096, 1 / 4.5, "cls"),
+    "GENA-LM": (lambda: BertForMaskedLM(BertConfig(vocab_size=32000, hidden_size=128, num_hidden_layers=2, num_attention_heads=4,
+                                                   intermediate_size=512, max_position_embeddings=4096)), 32000, 1 / 6.5, "cls"),
+    "NT": (lambda: EsmForMaskedLM(EsmConfig(vocab_size=4107, hidden_size=128, num_hidden_layers=2, num_attention_heads=4,
+                                            intermediate_size=512, max_position_embeddings=4096, pad_token_id=1, mask_token_id=2,
+                                            position_embedding_type="rotary")), 4107, 1 / 6, "lm_head"),
+    "Caduceus": (lambda: MambaForCausalLM(MambaConfig(vocab_size=16, hidden_size=128, num_hidden_layers=2, state_size=16)), 16, 1.,
+                 "lm_head"),
+}
+
+
+class StandInWrapper(LMHeadAtPositions):
+    def __init__(self, model, lm_head):
+        self.model = model
+        self.lm_head = lm_head
+
+    def model_fwd(self, tokens_in, attention_mask, tokens_out):
+        with torch.no_grad():
+            torch_outs = self.model(tokens_in, attention_mask=attention_mask)
+            logits = torch_outs.logits.swapaxes(1, 2)
+            lls = -F.cross_entropy(logits, tokens_out, reduction="none")
+        return lls
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Measures masked pseudo-log-likelihood throughput of the per-position loop and the packed engine, with full logits and with the LM head applied only at scored positions")
+    parser.add_argument("--models", type=str, nargs="+", default=list(stand_ins.keys()))
+    parser.add_argument("--seq_len", type=int, default=2114, help="Sequence length in bases")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--max_tokens", type=int, nargs="+", default=[16384], help="Engine token budgets per forward pass")
+    parser.add_argument("--num_threads", type=int, default=None)
+    parser.add_argument("--out_path", type=str, default=os.path.join(work_dir, "benchmarks/pll_throughput.json"))
+    args = parser.parse_args()
+    return args
+
+
+def loop_pll(model_fwd, tokens, starts, ends, attention_mask, mask_token):
+    # Previous engine: one forward pass of the whole batch per token position
+    lls = torch.zeros(tokens.shape[:2], device=tokens.device)
+    for i in range(tokens.shape[1]):
+        clip_mask = ((i >= starts) & (i < ends)).to(device=tokens.device)
+        masked_tokens = tokens.clone()
+        masked_tokens[:,i,...] = mask_token
+        lls[:,i] = model_fwd(masked_tokens, attention_mask, tokens)[:,i] * clip_mask
+
+    return lls.sum(dim=1).numpy(force=True)
+
+
+def make_batch(vocab_size, num_tokens, batch_size, rng):
+    # Sequences of 90-100% of the longest, between a start and an end token and right-padded
+    lengths = rng.integers(int(num_tokens * 0.9), num_tokens + 1, size=batch_size)
+    width = int(lengths.max()) + 2
+    tokens = torch.zeros((batch_size, width), dtype=torch.long)
+    attention_mask = torch.zeros((batch_size, width), dtype=torch.long)
+    for i, length in enumerate(lengths.tolist()):
+        tokens[i,0] = 1
+        tokens[i,1:length + 1] = torch.from_numpy(rng.integers(min(5, vocab_size - 1), vocab_size, size=length))
+        tokens[i,length + 1] = 2
+        attention_mask[i,:length + 2] = 1
+
+    starts = torch.ones(batch_size, dtype=torch.long)
+    ends = torch.from_numpy(lengths + 1)
+
+    return tokens, starts, ends, attention_mask
+
+
+def main():
+    args = parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    rng = np.random.default_rng(0)
+    torch.manual_seed(0)
+
+    metrics = {}
+    for name in args.models:
+        make_model, vocab_size, tokens_per_base, lm_head = stand_ins[name]
+        model = make_model()
+        model.eval()
+        wrapper = StandInWrapper(model, lm_head)
+        full_logits = StandInWrapper(model, None)
+
+        num_tokens = max(int(args.seq_len * tokens_per_base), 1)
+        tokens, starts, ends, attention_mask = make_batch(vocab_size, num_tokens, args.batch_size, rng)
+        num_positions = int((ends - starts).sum())
+
+        start = time.perf_counter()
+        expected = loop_pll(wrapper.model_fwd, tokens, starts, ends, attention_mask, 3)
+        loop_s = time.perf_counter() - start
+
+        metrics[name] = {"num_tokens": tokens.shape[1], "loop_positions_per_s": num_positions / loop_s}
+        for max_tokens in [None] + args.max_tokens:
+            for mode, engine in (("engine", full_logits), ("engine_head", wrapper)):
+                start = time.perf_counter()
+                out = masked_pll(engine.model_fwd_at, tokens, starts, ends, attention_mask, 3, max_tokens=max_tokens)
+                engine_s = time.perf_counter() - start
+
+                key = mode if max_tokens is None else f"{mode}_{max_tokens}"
+                metrics[name][f"{key}_positions_per_s"] = num_positions / engine_s
+                metrics[name][f"{key}_max_abs_diff"] = float(np.abs(out - expected).max())
+
+        print(name, ", ".join(f"{k}: {v:.4g}" for k, v in metrics[name].items()))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.out_path)), exist_ok=True)
+    with open(args.out_path, "w") as f:
+        json.dump(metrics, f, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import os
+import time
+import json
+import argparse
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from transformers import AutoTokenizer, AutoModel
+
+from ..task_2_5_single.components import SimpleSequence
+from ..tokenization import TokenizingCollate
+from ..utils import onehot_to_chars
+
+work_dir = os.environ.get("DART_WORK_DIR", "")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Measures how much HF tokenization overlaps model compute when run in DataLoader workers")
+    parser.add_argument("--model_name", type=str, default="zhihan1996/DNABERT-2-117M")
+    parser.add_argument("--genome_fa", type=str, default=os.path.join(work_dir, "refs/GRCh38_no_alt_analysis_set_GCA_000001405.15.fasta"))
+    parser.add_argument("--elements_tsv", type=str, default=os.path.join(work_dir, "task_1_ccre/processed_inputs/ENCFF420VPZ_processed.tsv"))
+    parser.add_argument("--num_batches", type=int, default=32)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--out_path", type=str, default=os.path.join(work_dir, "benchmarks/tokenize_overlap.json"))
+    args = parser.parse_args()
+    return args
+
+
+def _sync(device):
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+def run(dataloader, num_batches, tokenize, model_fwd, device):
+    """
+    Per-batch milliseconds spent waiting on the DataLoader, tokenizing in the main process and in the model.
+    """
+    times = {"wait_ms": 0., "tokenize_ms": 0., "compute_ms": 0.}
+    count = 0
+
+    start = time.perf_counter()
+    it = iter(dataloader)
+    for _ in range(num_batches):
+        t0 = time.perf_counter()
+        try:
+            batch = next(it)
+        except StopIteration:
+            break
+        t1 = time.perf_counter()
+        input_ids, attention_mask = tokenize(batch)
+        t2 = time.perf_counter()
+        model_fwd(input_ids, attention_mask)
+        _sync(device)
+        t3 = time.perf_counter()
+
+        times["wait_ms"] += (t1 - t0) * 1e3
+        times["tokenize_ms"] += (t2 - t1) * 1e3
+        times["compute_ms"] += (t3 - t2) * 1e3
+        count += 1
+    end = time.perf_counter()
+
+    metrics = {k: v / count for k, v in times.items()}
+    metrics["wall_ms"] = (end - start) * 1e3 / count
+
+    return metrics
+
+
+def main():
+    args = parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name, trust_remote_code=True)
+    model = AutoModel.from_pretrained(args.model_name, trust_remote_code=True)
+    model.to(args.device)
+    model.eval()
+
+    def model_fwd(input_ids, attention_mask):
+        with torch.no_grad():
+            model(input_ids.to(args.device), attention_mask=attention_mask.to(args.device))
+
+    def tokenize_main(seqs):
+        encoded = tokenizer(onehot_to_chars(seqs), return_tensors="pt", padding=True)
+        return encoded["input_ids"], encoded["attention_mask"]
+
+    def tokenize_collated(batch):
+        return batch.input_ids, batch.attention_mask
+
+    dataset = SimpleSequence(args.genome_fa, args.elements_tsv, None, 0)
+    num_items = min(args.num_batches * args.batch_size, len(dataset))
+    sampler = np.random.default_rng(0).choice(len(dataset), size=num_items, replace=False).tolist()
+
+    modes = {
+        "main_process": (None, tokenize_main),
+        "workers": (TokenizingCollate(tokenizer), tokenize_collated),
+    }
+
+    metrics = {}
+    for name, (collate_fn, tokenize) in modes.items():
+        dataloader = DataLoader(dataset, batch_size=args.batch_size, sampler=sampler, num_workers=args.num_workers,
+                                collate_fn=collate_fn, prefetch_factor=(2 if args.num_workers > 0 else None))
+        # Warm up the workers and the model before timing
+        run(dataloader, 1, tokenize, model_fwd, args.device)
+        metrics[name] = run(dataloader, args.num_batches, tokenize, model_fwd, args.device)
+
+        print(name, ", ".join(f"{k}: {v:.1f}" for k, v in metrics[name].items()))
+
+    # Fraction of the main-process tokenization time that no longer shows up in wall time
+    tokenize_ms = metrics["main_process"]["tokenize_ms"]
+    saved_ms = metrics["main_process"]["wall_ms"] - metrics["workers"]["wall_ms"]
+    metrics["overlap"] = saved_ms / tokenize_ms if tokenize_ms > 0 else 0.
+    print(f"overlap: {metrics['overlap']:.2f}")
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.out_path)), exist_ok=True)
+    with open(args.out_path, "w") as f:
+        json.dump(metrics, f, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+import os
+import re
+import shutil
+import hashlib
+import fcntl
+import uuid
+
+_SAMPLE_COUNT = 16
+_SAMPLE_SIZE = 2**16
+_FICLONE = 0x40049409 # linux/fs.h
+_KEY_LEN = 32 # Hex digits of the fingerprint that prefixes each entry name
+_ENTRY_RE = re.compile(rf"([0-9a-f]{{{_KEY_LEN}}})-")
+
+_LOCK_NAME = ".lock"
+_USE_NAME = ".use"
+_TMP_MARKER = ".tmp."
+
+
+def file_fingerprint(path):
+    """
+    Content key for a cached file: size, mtime and a hash of evenly spaced samples of the file contents.
+    """
+    stat = os.stat(path)
+    h = hashlib.sha256(f"{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8"))
+
+    with open(path, "rb") as f:
+        if stat.st_size <= _SAMPLE_COUNT * _SAMPLE_SIZE:
+            h.update(f.read())
+        else:
+            step = (stat.st_size - _SAMPLE_SIZE) // (_SAMPLE_COUNT - 1)
+            for i in range(_SAMPLE_COUNT):
+                f.seek(i * step)
+                h.update(f.read(_SAMPLE_SIZE))
+
+    return h.hexdigest()[:_KEY_LEN]
+
+
+def _entry_key(name):
+    # Fingerprint of a cache entry from its file name, or None for files that are not entries
+    match = _ENTRY_RE.match(name)
+    return match.group(1) if match is not None else None
+
+
+def _clone_or_copy(src, dst):
+    # Try a hardlink, then a reflink, then fall back to a byte copy
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+
+    with open(src, "rb") as sf, open(dst, "wb") as f:
+        try:
+            fcntl.ioctl(f.fileno(), _FICLONE, sf.fileno())
+            return
+        except OSError:
+            pass
+
+        shutil.copyfileobj(sf, f, length=2**24)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _flock(path, flags, mode="a"):
+    # Opens and locks `path`, retrying if eviction removed the file in between, so that the lock is always on the
+    # file currently at `path`. Returns None if a non-blocking lock is not available.
+    while True:
+        f = open(path, mode)
+        try:
+            fcntl.flock(f, flags)
+        except BlockingIOError:
+            f.close()
+            return None
+        try:
+            if os.stat(path).st_ino == os.fstat(f.fileno()).st_ino:
+                return f
+        except FileNotFoundError:
+            if mode == "r":
+                f.close()
+                raise
+        f.close()
+
+
+class _Lock:
+    def __init__(self, path, blocking=True):
+        self.path = path
+        self.blocking = blocking
+        self.f = None
+
+    def __enter__(self):
+        flags = fcntl.LOCK_EX if self.blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        self.f = _flock(self.path, flags)
+
+        return self.f is not None
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.f is not None:
+            fcntl.flock(self.f, fcntl.LOCK_UN)
+            self.f.close()
+
+
+_held = {}
+
+
+def _hold(use_path, mode="a"):
+    held_key = (os.getpid(), use_path)
+    if held_key in _held:
+        return
+
+    _held[held_key] = _flock(use_path, fcntl.LOCK_SH, mode=mode)
+
+
+def hold_cached(path):
+    """
+    Takes a shared lock on the cache entry of `path` for the life of the current process, so that `evict`
+    leaves it in place. Readers that open cached files lazily (in each DataLoader worker) call this before
+    opening them; paths outside a cache are ignored.
+    """
+    key = _entry_key(os.path.basename(path))
+    if key is None:
+        return
+
+    try:
+        _hold(os.path.join(os.path.dirname(path), f"{key}{_USE_NAME}"), mode="r")
+    except FileNotFoundError:
+        pass # Not a cache entry, or one already evicted
+
+
+class FileCache:
+    """
+    Content-addressed local copy of input files (genomes, bigwigs, embedding HDF5s). Entries are keyed by
+    `file_fingerprint`, populated through a temporary file and an atomic rename, and evicted least recently
+    used first once the cache exceeds `max_bytes`. Concurrent jobs coordinate through lock files in the
+    cache directory. Processes using an entry hold a shared lock on it (see `hold_cached`), and entries in use
+    are never evicted.
+    """
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        if max_bytes is None and os.environ.get("DART_CACHE_MAX_GB"):
+            max_bytes = int(float(os.environ["DART_CACHE_MAX_GB"]) * 2**30)
+        self.max_bytes = max_bytes
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_path(self, key, src):
+        return os.path.join(self.cache_dir, f"{key}-{os.path.basename(src)}")
+
+    def _populate(self, src, dst):
+        tmp_path = f"{dst}{_TMP_MARKER}{uuid.uuid4().hex}"
+        try:
+            _clone_or_copy(src, tmp_path)
+            os.replace(tmp_path, dst)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def get(self, src, companions=()):
+        """
+        Returns the cached path of `src`, copying it in if needed. Companion files (such as a ".fai" index)
+        are cached alongside under the same key when they exist next to `src`.
+        """
+        if os.path.isdir(src):
+            return src # Directories (compiled genomes) are memory-mapped in place
+
+        key = file_fingerprint(src)
+        dst = self._entry_path(key, src)
+
+        lock_path = os.path.join(self.cache_dir, f"{key}{_LOCK_NAME}")
+        with _Lock(lock_path):
+            if not os.path.exists(dst):
+                self._populate(src, dst)
+            # Recency lives on the lock file, since hardlinked entries share their mtime with the source
+            os.utime(lock_path)
+
+            for companion in companions:
+                companion_src = src + companion
+                companion_dst = dst + companion
+                if os.path.exists(companion_src) and not os.path.exists(companion_dst):
+                    self._populate(companion_src, companion_dst)
+
+            # Taken before the populate lock is released, so the entry cannot be evicted in between
+            _hold(os.path.join(self.cache_dir, f"{key}{_USE_NAME}"))
+
+        if self.max_bytes is not None:
+            self.evict(keep=key)
+
+        return dst
+
+    def _entries(self):
+        entries = {}
+        for name in os.listdir(self.cache_dir):
+            key = _entry_key(name)
+            if key is None or _TMP_MARKER in name:
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                size = os.stat(path).st_size
+            except FileNotFoundError:
+                continue
+            try:
+                last_used = os.stat(os.path.join(self.cache_dir, f"{key}{_LOCK_NAME}")).st_mtime
+            except FileNotFoundError:
+                last_used = 0
+            size_total, _, paths = entries.get(key, (0, last_used, []))
+            entries[key] = (size_total + size, last_used, paths + [path])
+
+        return entries
+
+    def evict(self, keep=None):
+        with _Lock(os.path.join(self.cache_dir, _LOCK_NAME)):
+            entries = self._entries()
+            total = sum(size for size, _, _ in entries.values())
+
+            for key, (size, _, paths) in sorted(entries.items(), key=lambda x: x[1][1]):
+                if total <= self.max_bytes:
+                    break
+                if key == keep:
+                    continue
+
+                # Skip entries another job is populating or using. The lock files go with the entry, removed while
+                # still held; jobs waiting on them retry on the new files (see _flock).
+                lock_path = os.path.join(self.cache_dir, f"{key}{_LOCK_NAME}")
+                use_path = os.path.join(self.cache_dir, f"{key}{_USE_NAME}")
+                with _Lock(lock_path, blocking=False) as acquired, _Lock(use_path, blocking=False) as unused:
+                    if not (acquired and unused):
+                        continue
+                    for path in paths + [use_path, lock_path]:
+                        try:
+                            os.remove(path)
+                        except FileNotFoundError:
+                            pass
+                total -= size
+
+
+def cached_path(src, cache_dir, companions=()):
+    return FileCache(cache_dir).get(src, companions=companions)
@@ -0,0 +1,21 @@
+import argparse
+
+from .genome import compile_genome
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compiles a FASTA genome into memory-mappable uint8 token arrays")
+    parser.add_argument("--genome_fa", type=str, required=True, help="Input FASTA file")
+    parser.add_argument("--out_dir", type=str, required=True, help="Output directory, usable in place of the FASTA path")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    index = compile_genome(args.genome_fa, args.out_dir)
+    total = sum(info["length"] for info in index["chroms"].values())
+    print(f"Compiled {len(index['chroms'])} sequences ({total} bp) to {args.out_dir}")
+
+if __name__ == "__main__":
+    main()
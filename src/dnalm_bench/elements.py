@@ -0,0 +1,50 @@
+import numpy as np
+
+
+class ElementTable:
+    """
+    Element table held as contiguous numpy columns, converted once from a polars DataFrame so that datasets
+    index arrays per batch instead of calling `DataFrame.row` per item. Integer columns are widened to int64,
+    and the chromosome column is stored as integer codes into `chrom_names`.
+    """
+    def __init__(self, df, chrom_col="chr"):
+        self.height = df.height
+        self.columns = {}
+        self.chrom_names = []
+        self.chrom_codes = np.zeros(df.height, dtype=np.int32)
+
+        for name, dtype in zip(df.columns, df.dtypes):
+            col = df.get_column(name)
+            if name == chrom_col:
+                names, codes = np.unique(col.to_numpy().astype(str), return_inverse=True)
+                self.chrom_names = names.tolist()
+                self.chrom_codes = codes.astype(np.int32)
+            elif dtype.is_integer():
+                self.columns[name] = col.to_numpy().astype(np.int64)
+            else:
+                self.columns[name] = col.to_numpy()
+
+    def __len__(self):
+        return self.height
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def chroms(self, indices=None):
+        codes = self.chrom_codes if indices is None else self.chrom_codes[indices]
+        return [self.chrom_names[c] for c in codes]
+
+    def take(self, indices):
+        """
+        Rows at the given positions, as a new table sharing the chromosome names.
+        """
+        table = object.__new__(ElementTable)
+        table.chrom_names = self.chrom_names
+        table.chrom_codes = self.chrom_codes[indices]
+        table.columns = {name: col[indices] for name, col in self.columns.items()}
+        table.height = len(table.chrom_codes)
+
+        return table
+
+    def slice(self, start, length):
+        return self.take(slice(start, start + length))
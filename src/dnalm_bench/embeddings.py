@@ -11,6 +11,8 @@ from tqdm import tqdm
 import h5py
 
 from .utils import onehot_to_chars
+from .token_cache import TokenBatch
+from .tokenization import offsets_to_indices
 
 
 class EmbeddingExtractor(metaclass=ABCMeta):
@@ -41,6 +43,9 @@ class HFEmbeddingExtractor(EmbeddingExtractor, metaclass=ABCMeta):
         super().__init__(batch_size, num_workers, device)
 
     def tokenize(self, seqs):
+        if isinstance(seqs, TokenBatch):
+            return seqs.input_ids, seqs.offsets
+
         seqs_str = onehot_to_chars(seqs)
         encoded = self.tokenizer(seqs_str, return_tensors="pt", padding=True, return_offsets_mapping=True)
         tokens = encoded["input_ids"]
@@ -62,12 +67,8 @@ class HFEmbeddingExtractor(EmbeddingExtractor, metaclass=ABCMeta):
         return embs
 
     def detokenize(self, seqs, token_embeddings, offsets):
-        gather_idx = torch.zeros((seqs.shape[0], seqs.shape[1], 1), dtype=torch.long)
-        for i, offset in enumerate(offsets):
-            for j, (start, end) in enumerate(offset):
-                gather_idx[i,start:end,:] = j
-
-        gather_idx = gather_idx.expand(-1,-1,token_embeddings.shape[2]).to(self.device)
+        gather_idx = offsets_to_indices(offsets, seqs.shape[1]).to(self.device)
+        gather_idx = gather_idx[:,:,None].expand(-1,-1,token_embeddings.shape[2])
         seq_embeddings = torch.gather(token_embeddings, 1, gather_idx)
 
         return seq_embeddings
@@ -0,0 +1,64 @@
+import numpy as np
+
+# Token ids shared by the one-hot encoders and compiled genomes: A, C, G, T -> 0-3, anything else -> 4
+N_TOKEN = 4
+
+_TOKEN_LUT = np.full(256, N_TOKEN, dtype=np.uint8)
+for _i, _c in enumerate(b"ACGT"):
+    _TOKEN_LUT[_c] = _i
+    _TOKEN_LUT[_c + 32] = _i # Lowercase
+
+_TOKEN_ONEHOT = np.zeros((N_TOKEN + 1, 4), dtype=np.int8)
+_TOKEN_ONEHOT[np.arange(4), np.arange(4)] = 1
+
+_ONEHOT_LUT = _TOKEN_ONEHOT[_TOKEN_LUT]
+_ONEHOT_RC_LUT = _ONEHOT_LUT[:,::-1].copy()
+
+_TOKEN_RC = np.array([3, 2, 1, 0, N_TOKEN], dtype=np.uint8)
+
+
+def _as_codes(seqs):
+    """
+    Views a string, a bytes object or a list of equal-length strings as an array of ASCII codes, with shape
+    (L,) or (B, L) respectively.
+    """
+    if isinstance(seqs, str):
+        return np.frombuffer(seqs.encode("ascii"), dtype=np.uint8)
+    if isinstance(seqs, (bytes, bytearray)):
+        return np.frombuffer(seqs, dtype=np.uint8)
+    if isinstance(seqs, np.ndarray):
+        return seqs.view(np.uint8) if seqs.dtype.itemsize == 1 else seqs.astype(np.uint8)
+
+    seq_len = len(seqs[0]) if len(seqs) > 0 else 0
+    if any(len(s) != seq_len for s in seqs):
+        raise ValueError("All sequences in a batch must have the same length")
+
+    joined = b"".join(s.encode("ascii") if isinstance(s, str) else s for s in seqs)
+    return np.frombuffer(joined, dtype=np.uint8).reshape(len(seqs), seq_len)
+
+
+def encode_tokens(seqs, reverse_complement=False):
+    tokens = _TOKEN_LUT[_as_codes(seqs)]
+    if reverse_complement:
+        tokens = _TOKEN_RC[tokens[...,::-1]]
+
+    return tokens
+
+
+def encode_one_hot(seqs, reverse_complement=False):
+    codes = _as_codes(seqs)
+    if reverse_complement:
+        return _ONEHOT_RC_LUT[codes[...,::-1]]
+
+    return _ONEHOT_LUT[codes]
+
+
+def tokens_to_one_hot(tokens, out=None):
+    if out is None:
+        return _TOKEN_ONEHOT[tokens]
+
+    return np.take(_TOKEN_ONEHOT, tokens, axis=0, out=out)
+
+
+def reverse_complement_tokens(tokens):
+    return _TOKEN_RC[tokens[...,::-1]]
@@ -16,6 +16,7 @@ import h5py
 import minlora
 
 from .utils import onehot_to_chars
+from .token_cache import TokenBatch
 
 
 class LoRAModule(nn.Module):
@@ -52,6 +53,8 @@ class LoRAModule(nn.Module):
 
 
 class HFClassifierModel(nn.Module):
+    tensor_tokenizer = None
+
     def __init__(self, tokenizer, model):
         super().__init__()
 
@@ -62,6 +65,9 @@ class HFClassifierModel(nn.Module):
         self.register_buffer("device_indicator", device_indicator)
         
     def _tokenize(self, seqs):
+        if isinstance(seqs, TokenBatch):
+            return seqs.input_ids.to(self.device), seqs.attention_mask.to(self.device)
+
         seqs_str = onehot_to_chars(seqs)
         encoded = self.tokenizer(seqs_str, return_tensors="pt", padding=True)
         tokens = encoded["input_ids"]
@@ -0,0 +1,220 @@
+import os
+import json
+
+import numpy as np
+import pyfaidx
+
+from .encoding import N_TOKEN, encode_tokens, tokens_to_one_hot
+from .cache import hold_cached
+
+_INDEX_NAME = "index.json"
+_CHUNK_SIZE = 2**24
+
+
+class Genome:
+    def fetch_tokens_batch(self, chroms, starts, ends):
+        """
+        Fetches equal-width windows as a (B, L) token array. Windows are read in (chrom, start) order, and
+        overlapping or adjacent windows on the same chromosome are coalesced into a single read.
+        """
+        widths = {end - start for start, end in zip(starts, ends)}
+        if len(widths) > 1:
+            raise ValueError(f"Batched fetch requires equal-width windows, got widths {sorted(widths)}")
+        width = widths.pop() if widths else 0
+
+        tokens = np.empty((len(starts), width), dtype=np.uint8)
+
+        order = sorted(range(len(starts)), key=lambda i: (chroms[i], starts[i]))
+        span_members = []
+        for i in order:
+            if span_members and (chroms[i] != span_chrom or starts[i] > span_end):
+                self._scatter_span(tokens, span_members, span_chrom, span_start, span_end, starts)
+                span_members = []
+            if not span_members:
+                span_chrom, span_start, span_end = chroms[i], starts[i], ends[i]
+            span_end = max(span_end, ends[i])
+            span_members.append(i)
+        if span_members:
+            self._scatter_span(tokens, span_members, span_chrom, span_start, span_end, starts)
+
+        return tokens
+
+    def _scatter_span(self, tokens, members, chrom, span_start, span_end, starts):
+        span = self.fetch_tokens(chrom, span_start, span_end)
+        width = tokens.shape[1]
+        for i in members:
+            a = starts[i] - span_start
+            tokens[i] = span[a:a + width]
+
+    def fetch_positions(self, chrom, positions):
+        """
+        Tokens at the given 0-based positions of one chromosome, read in sorted spans of at most _CHUNK_SIZE bp.
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        tokens = np.full(len(positions), N_TOKEN, dtype=np.uint8)
+
+        order = np.argsort(positions, kind="stable")
+        sorted_positions = positions[order]
+        i = 0
+        while i < len(sorted_positions):
+            span_start = sorted_positions[i]
+            j = np.searchsorted(sorted_positions, span_start + _CHUNK_SIZE, side="left")
+            span_end = sorted_positions[j - 1] + 1
+            span = self.fetch_tokens(chrom, int(span_start), int(span_end))
+            tokens[order[i:j]] = span[sorted_positions[i:j] - span_start]
+            i = j
+
+        return tokens
+
+    def fetch(self, chrom, start, end):
+        return tokens_to_one_hot(self.fetch_tokens(chrom, start, end))
+
+    def fetch_batch(self, chroms, starts, ends, out=None):
+        tokens = self.fetch_tokens_batch(chroms, starts, ends)
+        return tokens_to_one_hot(tokens, out=out)
+
+
+class FastaGenome(Genome):
+    """
+    Persistent genome reader for the sequence datasets. The pyfaidx handle is opened lazily, once per
+    process, so each DataLoader worker keeps its own handle across items and epochs.
+    """
+    def __init__(self, genome_fa):
+        self.genome_fa = genome_fa
+        fa = pyfaidx.Fasta(self.genome_fa) # Build index if needed
+        fa.close()
+
+        self._fa = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_fa"] = None
+        state["_pid"] = None
+
+        return state
+
+    @property
+    def fa(self):
+        pid = os.getpid()
+        if self._fa is None or self._pid != pid:
+            # Handles inherited through fork share a file offset with the parent, so never reuse them
+            hold_cached(self.genome_fa)
+            self._fa = pyfaidx.Fasta(self.genome_fa, one_based_attributes=False)
+            self._pid = pid
+
+        return self._fa
+
+    def chrom_size(self, chrom):
+        return len(self.fa[chrom])
+
+    def fetch_tokens(self, chrom, start, end):
+        tokens = np.full(end - start, N_TOKEN, dtype=np.uint8)
+
+        start_adj = max(0, start)
+        end_adj = min(end, self.chrom_size(chrom))
+        if end_adj > start_adj:
+            sequence = self.fa[chrom][start_adj:end_adj].seq
+            tokens[start_adj - start:end_adj - start] = encode_tokens(sequence)
+
+        return tokens
+
+    def close(self):
+        if self._fa is not None and self._pid == os.getpid():
+            self._fa.close()
+        self._fa = None
+        self._pid = None
+
+
+class CompiledGenome(Genome):
+    """
+    Genome compiled by `compile_genome`: one flat uint8 token file per chromosome, memory-mapped read-only.
+    Windows are plain array slices, and all DataLoader workers share the same page cache.
+    """
+    def __init__(self, genome_dir):
+        self.genome_dir = genome_dir
+        with open(os.path.join(genome_dir, _INDEX_NAME)) as f:
+            self.index = json.load(f)
+
+        self.chrom_sizes = {chrom: info["length"] for chrom, info in self.index["chroms"].items()}
+
+        self._maps = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_maps"] = {} # np.memmap pickles as a full in-memory copy
+
+        return state
+
+    def _tokens(self, chrom):
+        tokens = self._maps.get(chrom)
+        if tokens is None:
+            info = self.index["chroms"][chrom]
+            if info["length"] == 0:
+                tokens = np.zeros(0, dtype=np.uint8)
+            else:
+                path = os.path.join(self.genome_dir, info["file"])
+                tokens = np.memmap(path, dtype=np.uint8, mode="r", shape=(info["length"],))
+            self._maps[chrom] = tokens
+
+        return tokens
+
+    def chrom_size(self, chrom):
+        return self.chrom_sizes[chrom]
+
+    def fetch_tokens(self, chrom, start, end):
+        tokens = np.full(end - start, N_TOKEN, dtype=np.uint8)
+
+        start_adj = max(0, start)
+        end_adj = min(end, self.chrom_sizes[chrom])
+        if end_adj > start_adj:
+            tokens[start_adj - start:end_adj - start] = self._tokens(chrom)[start_adj:end_adj]
+
+        return tokens
+
+    def close(self):
+        self._maps = {}
+
+
+def compile_genome(genome_fa, out_dir):
+    os.makedirs(out_dir, exist_ok=True)
+
+    fa = pyfaidx.Fasta(genome_fa, one_based_attributes=False)
+    chroms = {}
+    for i, chrom in enumerate(fa.keys()):
+        record = fa[chrom]
+        length = len(record)
+        file_name = f"{i:04d}.u8"
+        path = os.path.join(out_dir, file_name)
+        tmp_path = f"{path}.tmp{os.getpid()}"
+
+        with open(tmp_path, "wb") as f:
+            for chunk_start in range(0, length, _CHUNK_SIZE):
+                chunk = record[chunk_start:min(chunk_start + _CHUNK_SIZE, length)].seq
+                f.write(encode_tokens(chunk).tobytes())
+        os.replace(tmp_path, path)
+
+        chroms[chrom] = {"file": file_name, "length": length}
+
+    fa.close()
+
+    # The index is written last, so an interrupted compile is never picked up as a genome
+    index = {
+        "source": os.path.abspath(genome_fa),
+        "dtype": "uint8",
+        "alphabet": "ACGTN",
+        "chroms": chroms,
+    }
+    tmp_path = os.path.join(out_dir, f"{_INDEX_NAME}.tmp{os.getpid()}")
+    with open(tmp_path, "w") as f:
+        json.dump(index, f, indent=4)
+    os.replace(tmp_path, os.path.join(out_dir, _INDEX_NAME))
+
+    return index
+
+
+def load_genome(genome_path):
+    if os.path.isfile(os.path.join(genome_path, _INDEX_NAME)):
+        return CompiledGenome(genome_path)
+
+    return FastaGenome(genome_path)
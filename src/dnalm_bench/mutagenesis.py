@@ -0,0 +1,291 @@
+import copy
+
+import numpy as np
+import torch
+
+from .pll import bypass_module, head_lls, positions_ll, repeat_cache
+
+# Alternative bases for each reference base
+_ALTS = np.array([[b for b in range(4) if b != r] for r in range(4)])
+
+
+def substitution_sites(seq):
+    """
+    Positions and alternative bases of the 3 x L single-nucleotide substitutions of an (L, 4) one-hot sequence,
+    skipping N positions.
+    """
+    valid = np.flatnonzero(seq.sum(axis=1) > 0)
+    pos = np.repeat(valid, 3)
+    alts = _ALTS[seq[valid].argmax(axis=1)].ravel()
+
+    return pos, alts
+
+
+def mutant_seqs(seq, pos, alts):
+    """
+    (N, L, 4) one-hot mutants of an (L, 4) sequence, each with one substitution.
+    """
+    mutants = np.repeat(seq[None], len(pos), axis=0)
+    inds = np.arange(len(pos))
+    mutants[inds,pos] = 0
+    mutants[inds,pos,alts] = 1
+
+    return mutants
+
+
+def _unpad(tokens, starts, ends, attention_mask):
+    # Token rows without padding, with their scored ranges shifted to match
+    batch_size, width = tokens.shape
+    starts = torch.as_tensor(starts).expand(batch_size).tolist()
+    ends = torch.as_tensor(ends).expand(batch_size).tolist()
+    if attention_mask is None:
+        firsts, lengths = [0] * batch_size, [width] * batch_size
+    else:
+        valid = attention_mask.bool()
+        firsts, lengths = valid.int().argmax(dim=1).tolist(), valid.sum(dim=1).tolist()
+
+    return [(tokens[i,first:first + length], start - first, end - first)
+            for i, (first, length, start, end) in enumerate(zip(firsts, lengths, starts, ends))]
+
+
+def _tokenize_rows(evaluator, seqs, batch_size):
+    rows = []
+    for i in range(0, len(seqs), batch_size):
+        tokens, starts, ends, attention_mask = evaluator.tokenize(torch.from_numpy(seqs[i:i + batch_size]))[:4]
+        rows.extend(_unpad(tokens, starts, ends, attention_mask))
+
+    return rows
+
+
+def _masked_effects(evaluator, ref, mutants, batch_size):
+    # Each mutant's score difference with its differing tokens masked, as in VariantSingleTokenLikelihoodEvaluator:
+    # the log-probabilities of its tokens minus those of the reference tokens at those positions. Mutants that
+    # differ at the same token positions share one masked copy of the reference.
+    ref_tokens, ref_start, ref_end = ref
+    effects = np.full(len(mutants), np.nan, dtype=np.float32)
+    groups = {}
+    misaligned = []
+    for j, (tokens, start, end) in enumerate(mutants):
+        if tokens.shape != ref_tokens.shape or start != ref_start or end != ref_end:
+            misaligned.append(j) # Tokenized differently from the reference
+            continue
+        diff = torch.nonzero(tokens != ref_tokens, as_tuple=True)[0]
+        if diff.shape[0] == 0:
+            effects[j] = 0
+        elif diff.min() >= start and diff.max() < end:
+            groups.setdefault(tuple(diff.tolist()), []).append(j)
+
+    keys = list(groups)
+    for i in range(0, len(keys), batch_size):
+        chunk = keys[i:i + batch_size]
+        rows = torch.tensor([r for r, key in enumerate(chunk) for _ in key])
+        cols = torch.tensor([c for key in chunk for c in key])
+        tokens_in = ref_tokens.repeat(len(chunk), 1)
+        tokens_in[rows, cols] = evaluator.mask_token
+
+        device = evaluator.device
+        log_probs = evaluator.model_log_probs_at(tokens_in.to(device=device), torch.ones_like(tokens_in, device=device),
+                                                 rows.to(device=device), cols.to(device=device)).cpu()
+        ref_lls = log_probs[torch.arange(cols.shape[0]),ref_tokens[cols]]
+
+        start = 0
+        for key in chunk:
+            inds = torch.arange(start, start + len(key))
+            key_cols = cols[inds]
+            for j in groups[key]:
+                effects[j] = float((log_probs[inds,mutants[j][0][key_cols]] - ref_lls[inds]).sum())
+            start += len(key)
+
+    for i in range(0, len(misaligned), batch_size):
+        chunk = misaligned[i:i + batch_size]
+        effects[chunk] = _misaligned_effects(evaluator, ref, [mutants[j] for j in chunk])
+
+    return effects
+
+
+def _misaligned_effects(evaluator, ref, mutants):
+    # As the misaligned variants of VariantSingleTokenLikelihoodEvaluator.score_alleles: the tokens differing
+    # between the padded reference and mutant are masked, and each is scored over its own range in its own forward
+    ref_tokens, ref_start, ref_end = ref
+    width = max([ref_tokens.shape[0]] + [tokens.shape[0] for tokens, _, _ in mutants])
+    tokens_out = torch.zeros((2 * len(mutants), width), dtype=torch.long)
+    attention_mask = torch.zeros_like(tokens_out)
+    tokens_out[:len(mutants),:ref_tokens.shape[0]] = ref_tokens
+    attention_mask[:len(mutants),:ref_tokens.shape[0]] = 1
+    for r, (tokens, _, _) in enumerate(mutants):
+        tokens_out[len(mutants) + r,:tokens.shape[0]] = tokens
+        attention_mask[len(mutants) + r,:tokens.shape[0]] = 1
+    starts = torch.tensor([ref_start] * len(mutants) + [start for _, start, _ in mutants])
+    ends = torch.tensor([ref_end] * len(mutants) + [end for _, _, end in mutants])
+
+    diffs = (tokens_out[:len(mutants)] != tokens_out[len(mutants):]).repeat(2, 1)
+    tokens_in = tokens_out[:len(mutants)].repeat(2, 1)
+    tokens_in[diffs] = evaluator.mask_token
+
+    device = evaluator.device
+    lls = positions_ll(evaluator.model_fwd_at, tokens_in.to(device=device), attention_mask.to(device=device),
+                       tokens_out.to(device=device), starts, ends)
+
+    return lls[len(mutants):] - lls[:len(mutants)]
+
+
+def _continuation_lls(evaluator, ref, mutants, batch_size):
+    # Log-likelihoods of the reference tokens at every position, and of the tokens of each mutant from its first
+    # difference with the reference on. Mutants continue from the key-value cache of the shared reference prefix
+    # where the wrapper supports it, and otherwise run in full.
+    ref_tokens = ref[0]
+    device = evaluator.device
+    use_cache = evaluator.kv_cache and evaluator.lm_head is not None and getattr(evaluator.model, evaluator.lm_head, None) is not None
+
+    groups = {}
+    prefix_lens = {}
+    for j, (tokens, start, end) in enumerate(mutants):
+        length = min(tokens.shape[0], ref_tokens.shape[0])
+        diff = torch.nonzero(tokens[:length] != ref_tokens[:length], as_tuple=True)[0]
+        prefix_len = int(diff[0]) if diff.shape[0] > 0 else length
+        prefix_len = min(prefix_len, tokens.shape[0] - 1) # At least one token to continue from the cache
+        groups.setdefault((prefix_len, tokens.shape[0]), []).append(j)
+        prefix_lens[j] = prefix_len
+
+    mutant_lls = [None] * len(mutants)
+
+    def score(j_list, lls_fn):
+        rows, cols = [], []
+        for r, j in enumerate(j_list):
+            _, start, end = mutants[j]
+            first = max(start, prefix_lens[j])
+            rows.extend([r] * max(end - first, 0))
+            cols.extend(range(first, end))
+        rows = torch.tensor(rows, dtype=torch.long, device=device)
+        cols = torch.tensor(cols, dtype=torch.long, device=device)
+        lls = lls_fn(rows, cols).cpu()
+        for r, j in enumerate(j_list):
+            mutant_lls[j] = (cols[rows == r].cpu(), lls[(rows == r).cpu()])
+
+    if not use_cache:
+        for j_list in groups.values():
+            for i in range(0, len(j_list), batch_size):
+                chunk = j_list[i:i + batch_size]
+                tokens = torch.stack([mutants[j][0] for j in chunk]).to(device=device)
+                score(chunk, lambda rows, cols: evaluator.model_fwd_at(tokens, torch.ones_like(tokens), tokens, rows, cols))
+
+        ref_in = ref_tokens[None].to(device=device)
+        cols = torch.arange(ref_in.shape[1], device=device)
+        rows = torch.zeros_like(cols)
+        ref_lls = evaluator.model_fwd_at(ref_in, torch.ones_like(ref_in), ref_in, rows, cols).cpu()
+
+        return (cols.cpu(), ref_lls), mutant_lls
+
+    ref_in = ref_tokens[None].to(device=device)
+    ref_len = ref_in.shape[1]
+    with torch.no_grad(), bypass_module(evaluator.model, evaluator.lm_head) as head:
+        # The reference runs once with its cache kept whole
+        ref_outs = evaluator.model(ref_in, attention_mask=torch.ones_like(ref_in), use_cache=True)
+        ref_hidden = ref_outs.logits
+        cols = torch.arange(ref_len, device=device)
+        rows = torch.zeros_like(cols)
+        ref_lls = head_lls(head, ref_hidden, ref_in, rows, cols, shift=True, chunk_size=evaluator.head_chunk_size).cpu()
+
+        # Mutants differing at the first token have no prefix to continue from
+        for (prefix_len, length), j_list in groups.items():
+            if prefix_len > 0:
+                continue
+            for i in range(0, len(j_list), batch_size):
+                chunk = j_list[i:i + batch_size]
+                tokens = torch.stack([mutants[j][0] for j in chunk]).to(device=device)
+                hidden = evaluator.model(tokens, attention_mask=torch.ones_like(tokens)).logits
+                score(chunk, lambda rows, cols: head_lls(head, hidden, tokens, rows, cols, shift=True, chunk_size=evaluator.head_chunk_size))
+
+        # Continuations of many positions run in one forward pass. Each row attends to the reference cache up to
+        # its own prefix, with the rest of the cache masked out and positions set to continue from the prefix.
+        # Rows of neighbouring prefixes are batched together so their continuations pad to similar lengths.
+        order = sorted((j for j in range(len(mutants)) if prefix_lens[j] > 0), key=lambda j: prefix_lens[j])
+        for i in range(0, len(order), batch_size):
+            chunk = order[i:i + batch_size]
+            prefixes = torch.tensor([prefix_lens[j] for j in chunk], device=device)
+            # Local row k of a mutant is its token at prefix - 1 + k; local row 0 takes the reference hidden state
+            local = [mutants[j][0][prefix_lens[j] - 1:] for j in chunk]
+            width = max(x.shape[0] for x in local)
+            local_tokens = torch.zeros((len(chunk), width), dtype=torch.long)
+            for r, x in enumerate(local):
+                local_tokens[r,:x.shape[0]] = x
+            local_tokens = local_tokens.to(device=device)
+            cont_lens = torch.tensor([x.shape[0] - 1 for x in local], device=device)
+
+            cont_width = width - 1
+            attention_mask = torch.cat([torch.arange(ref_len, device=device)[None,:] < prefixes[:,None],
+                                        torch.arange(cont_width, device=device)[None,:] < cont_lens[:,None]], dim=1).long()
+            position_ids = prefixes[:,None] + torch.arange(cont_width, device=device)[None,:]
+            past_key_values = repeat_cache(copy.deepcopy(ref_outs.past_key_values), len(chunk))
+            cont = evaluator.model(local_tokens[:,1:], attention_mask=attention_mask, position_ids=position_ids,
+                                   past_key_values=past_key_values, use_cache=True).logits
+            hidden = torch.cat([ref_hidden[0,prefixes - 1][:,None], cont], dim=1)
+
+            rows, local_cols, global_cols = [], [], []
+            for r, j in enumerate(chunk):
+                _, start, end = mutants[j]
+                first = max(start, prefix_lens[j])
+                rows.extend([r] * max(end - first, 0))
+                global_cols.extend(range(first, end))
+                local_cols.extend(c - prefix_lens[j] + 1 for c in range(first, end))
+            rows = torch.tensor(rows, dtype=torch.long, device=device)
+            local_cols = torch.tensor(local_cols, dtype=torch.long, device=device)
+            global_cols = torch.tensor(global_cols, dtype=torch.long)
+            lls = head_lls(head, hidden, local_tokens, rows, local_cols, shift=True, chunk_size=evaluator.head_chunk_size).cpu()
+            rows = rows.cpu()
+            for r, j in enumerate(chunk):
+                mutant_lls[j] = (global_cols[rows == r], lls[rows == r])
+
+    return (cols.cpu(), ref_lls), mutant_lls
+
+
+def _causal_effects(evaluator, ref, mutants, batch_size):
+    # Differences of the summed log-likelihoods over each scored range. Positions before the first difference
+    # have the reference log-likelihoods.
+    (ref_cols, ref_lls), mutant_lls = _continuation_lls(evaluator, ref, mutants, batch_size)
+    ref_by_pos = torch.zeros(ref[0].shape[0], dtype=ref_lls.dtype)
+    ref_by_pos[ref_cols] = ref_lls
+    ref_total = float(ref_by_pos[ref[1]:ref[2]].double().sum())
+
+    effects = np.empty(len(mutants), dtype=np.float32)
+    for j, (tokens, start, end) in enumerate(mutants):
+        cols, lls = mutant_lls[j]
+        first = int(cols.min()) if cols.shape[0] > 0 else end
+        shared = ref_by_pos[start:min(first, end, ref_by_pos.shape[0])]
+        effects[j] = float(shared.double().sum() + lls.double().sum()) - ref_total
+
+    return effects
+
+
+def saturation_mutagenesis(evaluator, seq, batch_size=None):
+    """
+    Effects of all 3 x L single-nucleotide substitutions of an (L, 4) one-hot region under a zero-shot likelihood
+    evaluator, as an (L, 4) matrix of mutant minus reference score: 0 at the reference base, and NaN at N
+    positions and for substitutions that cannot be scored.
+
+    Masked models score each substitution with its differing tokens masked, as for single-token variants, so one
+    masked forward pass gives the log-probabilities of every substitution within a token. Substitutions that
+    change the tokenization beyond a token-for-token replacement run a masked forward pass for the reference and
+    one for the mutant, as for misaligned variants. Causal models score the whole sequence; each mutant continues
+    from the cached reference prefix up to its first differing token for wrappers with `kv_cache`, and runs in full
+    otherwise.
+    """
+    seq = np.asarray(seq)
+    batch_size = batch_size if batch_size is not None else evaluator.batch_size
+    pos, alts = substitution_sites(seq)
+
+    ref = _tokenize_rows(evaluator, seq[None], 1)[0]
+    mutants = []
+    for i in range(0, len(pos), batch_size):
+        mutants.extend(_tokenize_rows(evaluator, mutant_seqs(seq, pos[i:i + batch_size], alts[i:i + batch_size]), batch_size))
+
+    if evaluator.causal:
+        effects = _causal_effects(evaluator, ref, mutants, batch_size)
+    else:
+        effects = _masked_effects(evaluator, ref, mutants, batch_size)
+
+    out = np.zeros((seq.shape[0], 4), dtype=np.float32)
+    out[seq.sum(axis=1) == 0] = np.nan
+    out[pos,alts] = effects
+
+    return out
@@ -0,0 +1,423 @@
+from contextlib import contextmanager
+from statistics import NormalDist
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def in_range_mask(starts, ends, shape, device=None):
+    """
+    (B, L) mask of the token positions in [start, end) of each sequence in a (B, L) token batch. `starts` and
+    `ends` are per-sequence tensors or scalars.
+    """
+    batch_size, seq_len = shape
+    pos = torch.arange(seq_len, device=device)
+    starts = torch.as_tensor(starts, device=device).reshape(-1, 1)
+    ends = torch.as_tensor(ends, device=device).reshape(-1, 1)
+
+    return ((pos[None,:] >= starts) & (pos[None,:] < ends)).expand(batch_size, -1)
+
+
+def scored_positions(starts, ends, shape, device=None):
+    """
+    (row, column) indices of the token positions in [start, end) of each sequence in a (B, L) token batch.
+    `starts` and `ends` are per-sequence tensors or scalars.
+    """
+    return torch.nonzero(in_range_mask(starts, ends, shape, device=device), as_tuple=True)
+
+
+class _Bypass(torch.nn.Identity):
+    # Identity that still exposes the attributes of the bypassed module, which some models read in their forward
+    # pass (e.g. the dtype of the head weight)
+    def __init__(self, module):
+        super().__init__()
+        object.__setattr__(self, "_bypassed", module)
+
+    def __getattr__(self, name):
+        try:
+            return super().__getattr__(name)
+        except AttributeError:
+            return getattr(self._bypassed, name)
+
+
+@contextmanager
+def bypass_module(model, name):
+    """
+    Temporarily replaces the submodule `name` of `model` with an identity, yielding the original.
+    """
+    module = getattr(model, name)
+    setattr(model, name, _Bypass(module))
+    try:
+        yield module
+    finally:
+        setattr(model, name, module)
+
+
+def head_lls(head, hidden, tokens_out, rows, cols, shift=False, chunk_size=1024):
+    """
+    Log-likelihoods of `tokens_out` at (rows, cols) from (N, L, H) hidden states, applying the LM head and
+    log-softmax only at those positions, `chunk_size` positions at a time. With `shift` (causal models), position i
+    is predicted from the hidden state at i - 1 and position 0 scores 0. `tokens_out` may be a tuple of target
+    batches, read from the same log-softmax, for a tuple of log-likelihoods.
+    """
+    multi = isinstance(tokens_out, (tuple, list))
+    src_cols = cols - 1 if shift else cols
+    targets = [x[rows, cols] for x in tokens_out] if multi else [tokens_out[rows, cols]]
+    inds = torch.nonzero(src_cols >= 0, as_tuple=True)[0]
+
+    param = next(head.parameters(), None)
+    dtype = param.dtype if param is not None else hidden.dtype
+
+    lls = [torch.zeros(rows.shape[0], device=hidden.device) for _ in targets]
+    for i in range(0, inds.shape[0], chunk_size):
+        chunk = inds[i:i + chunk_size]
+        logits = head(hidden[rows[chunk], src_cols[chunk]][:,None,:].to(dtype))[:,0,:]
+        log_probs = F.log_softmax(logits.float(), dim=-1)
+        for x, y in zip(lls, targets):
+            x[chunk] = log_probs.gather(1, y[chunk,None])[:,0]
+
+    return tuple(lls) if multi else lls[0]
+
+
+def shared_prefix_len(tokens_a, tokens_b, attention_mask_a=None, attention_mask_b=None):
+    """
+    Number of leading positions at which every row of two (B, L) token batches agrees, in tokens and attention mask.
+    """
+    if tokens_a.shape != tokens_b.shape:
+        return 0
+
+    same = tokens_a == tokens_b
+    if attention_mask_a is not None or attention_mask_b is not None:
+        if attention_mask_a is None or attention_mask_b is None:
+            return 0
+        same &= attention_mask_a == attention_mask_b
+
+    diff = (~same).any(dim=0)
+    return int(diff.int().argmax()) if diff.any() else tokens_a.shape[1]
+
+
+def repeat_cache(past_key_values, repeats):
+    """
+    Repeats each row of a key-value cache in place, for Cache objects, or as new legacy per-layer (key, value) tuples.
+    """
+    if hasattr(past_key_values, "batch_repeat_interleave"):
+        past_key_values.batch_repeat_interleave(repeats)
+        return past_key_values
+
+    return tuple(tuple(x.repeat_interleave(repeats, dim=0) for x in layer) for layer in past_key_values)
+
+
+def row_sums(lls, rows, cols, shape):
+    """
+    Per-row sums of the log-likelihoods at (rows, cols) in a batch of the given (B, L) shape.
+    """
+    out = torch.zeros(shape, device=lls.device)
+    out[rows, cols] = lls
+
+    return out.sum(dim=1).numpy(force=True)
+
+
+class LMHeadAtPositions:
+    """
+    Model wrapper mixin for scoring only some token positions. Wrappers name their model's LM head module in
+    `lm_head`; the model then runs with the head bypassed, and the head is applied to the hidden states gathered at
+    the scored positions. Wrappers without a separate head fall back to the full logits of `model_fwd`. Causal
+    models set `causal`, as their `model_fwd` scores each token from the previous position, and `kv_cache` if the
+    model continues from `past_key_values`. Wrappers whose model takes no attention mask (HyenaDNA, Caduceus) clear
+    `takes_attention_mask`, as their `model_fwd` does.
+    """
+    lm_head = None
+    causal = False
+    kv_cache = False
+    takes_attention_mask = True
+    head_chunk_size = 1024
+
+    def model_hidden(self, tokens_in, attention_mask):
+        if self.takes_attention_mask:
+            torch_outs = self.model(tokens_in, attention_mask=attention_mask)
+        else:
+            torch_outs = self.model(tokens_in)
+
+        return torch_outs.logits
+
+    def model_fwd_at(self, tokens_in, attention_mask, tokens_out, rows, cols):
+        """
+        Log-likelihoods of `tokens_out` at (rows, cols), the same as `model_fwd(...)[rows, cols]`. For a tuple of
+        target batches, one forward pass gives a tuple of log-likelihoods, or one pass per target in the fallback.
+        """
+        if self.lm_head is None or getattr(self.model, self.lm_head, None) is None:
+            if isinstance(tokens_out, (tuple, list)):
+                return tuple(self.model_fwd(tokens_in, attention_mask, x)[rows, cols] for x in tokens_out)
+            return self.model_fwd(tokens_in, attention_mask, tokens_out)[rows, cols]
+
+        with torch.no_grad(), bypass_module(self.model, self.lm_head) as head:
+            hidden = self.model_hidden(tokens_in, attention_mask)
+            lls = head_lls(head, hidden, tokens_out, rows, cols, shift=self.causal, chunk_size=self.head_chunk_size)
+
+        return lls
+
+    def model_log_probs_at(self, tokens_in, attention_mask, rows, cols):
+        """
+        (N, V) log-probabilities over the vocabulary predicted at (rows, cols), without the causal shift.
+        """
+        head = getattr(self.model, self.lm_head, None) if self.lm_head is not None else None
+        with torch.no_grad():
+            if head is None:
+                logits = self.model_hidden(tokens_in, attention_mask)[rows, cols]
+            else:
+                with bypass_module(self.model, self.lm_head) as head:
+                    hidden = self.model_hidden(tokens_in, attention_mask)
+                param = next(head.parameters(), None)
+                dtype = param.dtype if param is not None else hidden.dtype
+                logits = head(hidden[rows, cols][:,None,:].to(dtype))[:,0,:]
+
+        return F.log_softmax(logits.float(), dim=-1)
+
+    def model_fwd_pair_at(self, tokens_a, attention_mask_a, rows_a, cols_a, tokens_b, attention_mask_b, rows_b, cols_b):
+        """
+        Causal log-likelihoods of two token batches at their (rows, cols), the same as `model_fwd_at` on each. With
+        `kv_cache`, the prefix shared by every pair of rows (up to the first differing token) runs once, and both
+        batches continue from its cached keys and values in a single forward pass. Otherwise, or without a shared
+        prefix, each batch runs on its own.
+        """
+        prefix_len = shared_prefix_len(tokens_a, tokens_b, attention_mask_a, attention_mask_b)
+        prefix_len = min(prefix_len, tokens_a.shape[1] - 1) # At least one token to continue from the cache
+        head = getattr(self.model, self.lm_head, None) if self.lm_head is not None else None
+        if not (self.causal and self.kv_cache) or head is None or prefix_len < 1:
+            return (self.model_fwd_at(tokens_a, attention_mask_a, tokens_a, rows_a, cols_a),
+                    self.model_fwd_at(tokens_b, attention_mask_b, tokens_b, rows_b, cols_b))
+
+        # Rows of the two batches interleaved, so that each continues from its repeated prefix row
+        tokens = torch.stack([tokens_a, tokens_b], dim=1).flatten(0, 1)
+        attention_mask = None
+        if attention_mask_a is not None:
+            attention_mask = torch.stack([attention_mask_a, attention_mask_b], dim=1).flatten(0, 1)
+            prefix_mask = attention_mask_a[:,:prefix_len]
+        else:
+            prefix_mask = None
+
+        with torch.no_grad(), bypass_module(self.model, self.lm_head) as head:
+            prefix_outs = self.model(tokens_a[:,:prefix_len], attention_mask=prefix_mask, use_cache=True)
+            past_key_values = repeat_cache(prefix_outs.past_key_values, 2)
+            torch_outs = self.model(tokens[:,prefix_len:], attention_mask=attention_mask, past_key_values=past_key_values,
+                                    use_cache=True)
+            hidden = torch.cat([prefix_outs.logits.repeat_interleave(2, dim=0), torch_outs.logits], dim=1)
+
+            rows = torch.cat([rows_a * 2, rows_b * 2 + 1])
+            cols = torch.cat([cols_a, cols_b])
+            lls = head_lls(head, hidden, tokens, rows, cols, shift=True, chunk_size=self.head_chunk_size)
+
+        return lls[:rows_a.shape[0]], lls[rows_a.shape[0]:]
+
+
+def positions_ll(model_fwd_at, tokens_in, attention_mask, tokens_out, starts, ends):
+    """
+    Sum of the log-likelihoods of `tokens_out` over the positions in [start, end) of each sequence, from a single
+    forward pass of `tokens_in`.
+    """
+    rows, cols = scored_positions(starts, ends, tokens_out.shape[:2], device=tokens_out.device)
+    lls = model_fwd_at(tokens_in, attention_mask, tokens_out, rows, cols)
+
+    return row_sums(lls, rows, cols, tokens_out.shape[:2])
+
+
+def masked_copies_lls(model_fwd_at, tokens, attention_mask, mask_token, copy_rows, pos_copies, pos_cols, max_copies):
+    """
+    Log-likelihoods of the true tokens at masked positions of a (B, L) token batch. Copy j is row copy_rows[j]
+    with the positions pos_cols[pos_copies == j] masked, and the positions are grouped by copy in order. Copies
+    run `max_copies` per forward pass.
+    """
+    device = tokens.device
+    num_copies = copy_rows.shape[0]
+    bounds = torch.searchsorted(pos_copies, torch.arange(0, num_copies + max_copies, max_copies, device=device)).tolist()
+
+    lls = torch.zeros(pos_cols.shape[0], device=device)
+    for i, start in enumerate(range(0, num_copies, max_copies)):
+        pos_start, pos_end = bounds[i], bounds[i + 1]
+        rows = copy_rows[start:start + max_copies]
+        inds = pos_copies[pos_start:pos_end] - start
+        cols = pos_cols[pos_start:pos_end]
+
+        tokens_out = tokens[rows]
+        tokens_in = tokens_out.clone()
+        tokens_in[inds, cols] = mask_token
+        copy_mask = attention_mask[rows] if attention_mask is not None else None
+
+        lls[pos_start:pos_end] = model_fwd_at(tokens_in, copy_mask, tokens_out, inds, cols)
+
+    return lls
+
+
+def masked_pll(model_fwd_at, tokens, starts, ends, attention_mask, mask_token, max_tokens=None):
+    """
+    Pseudo-log-likelihood of each sequence in a (B, L) token batch: the sum over positions in [start, end) of the
+    log-likelihood of the true token with only that position masked. Only in-range (sequence, position) pairs are
+    scored. Their masked copies are packed into forward passes of at most `max_tokens` tokens (B x L, the size of
+    the batch itself, by default) and the scores are scattered back before summing per sequence.
+
+    `model_fwd_at(tokens_in, attention_mask, tokens_out, rows, cols)` returns the token log-likelihoods at
+    (rows, cols), as in LMHeadAtPositions.
+    """
+    batch_size, seq_len = tokens.shape[:2]
+    device = tokens.device
+    rows, cols = scored_positions(starts, ends, (batch_size, seq_len), device=device)
+
+    max_pairs = batch_size if max_tokens is None else max(max_tokens // seq_len, 1)
+    copies = torch.arange(rows.shape[0], device=device)
+    lls = masked_copies_lls(model_fwd_at, tokens, attention_mask, mask_token, rows, copies, cols, max_pairs)
+
+    return row_sums(lls, rows, cols, (batch_size, seq_len))
+
+
+def _group_copies(rows, cols, positions_per_copy, spacing):
+    # Greedily groups positions, row by row in column order, into masked copies of up to positions_per_copy
+    # positions at least `spacing` apart. Returns the row of each copy, and the copy of each position
+    if positions_per_copy == 1:
+        return rows, np.arange(len(rows))
+
+    order = np.lexsort((cols, rows))
+    pos_copies = np.empty(len(rows), dtype=np.int64)
+    copy_rows = []
+    open_copies = {} # Row -> [copy, number of positions, last column] for copies with room
+    for i in order.tolist():
+        row, col = int(rows[i]), int(cols[i])
+        row_copies = open_copies.setdefault(row, [])
+        for copy in row_copies:
+            if col - copy[2] >= spacing:
+                break
+        else:
+            copy = [len(copy_rows), 0, col]
+            copy_rows.append(row)
+            row_copies.append(copy)
+
+        pos_copies[i] = copy[0]
+        copy[1] += 1
+        copy[2] = col
+        if copy[1] == positions_per_copy:
+            row_copies.remove(copy)
+
+    return np.array(copy_rows, dtype=np.int64), pos_copies
+
+
+class SampledPLL:
+    """
+    Monte Carlo estimate of the pseudo-log-likelihood of each sequence in a (B, L) token batch, from the masked
+    log-likelihoods of positions drawn uniformly without replacement from [start, end). The estimate is the
+    number of positions times the mean sampled log-likelihood, unbiased for the full sum, and its standard error
+    includes the finite population correction, so it is 0 once every position is sampled.
+
+    With `positions_per_copy` > 1, that many sampled positions at least `spacing` apart are masked together in
+    each copy, trading exactness of each term for fewer forward passes. Copies are packed into forward passes of
+    at most `max_tokens` tokens, as in masked_pll.
+    """
+    def __init__(self, model_fwd_at, tokens, starts, ends, attention_mask, mask_token, positions_per_copy=1, spacing=1,
+                 max_tokens=None, generator=None):
+        self.model_fwd_at = model_fwd_at
+        self.tokens = tokens
+        self.attention_mask = attention_mask
+        self.mask_token = mask_token
+        self.positions_per_copy = positions_per_copy
+        self.spacing = spacing
+        self.generator = generator
+
+        batch_size, seq_len = tokens.shape[:2]
+        self.max_copies = batch_size if max_tokens is None else max(max_tokens // seq_len, 1)
+        self.available = in_range_mask(starts, ends, (batch_size, seq_len)).clone()
+        self.totals = self.available.sum(dim=1).double()
+        self.counts = torch.zeros(batch_size, dtype=torch.float64)
+        self.sums = torch.zeros(batch_size, dtype=torch.float64)
+        self.sq_sums = torch.zeros(batch_size, dtype=torch.float64)
+
+    @property
+    def exhausted(self):
+        return self.counts == self.totals
+
+    def sample(self, num_samples, active=None):
+        """
+        Scores up to `num_samples` new positions of each sequence, or of the sequences in the boolean `active`.
+        """
+        available = self.available if active is None else self.available & active[:,None]
+        keys = torch.rand(available.shape, generator=self.generator)
+        keys[~available] = 2.
+        k = min(num_samples, keys.shape[1])
+        vals, cols = keys.topk(k, dim=1, largest=False)
+        keep = vals < 2.
+        rows = torch.arange(keys.shape[0])[:,None].expand(-1, k)[keep]
+        cols = cols[keep]
+        if rows.shape[0] == 0:
+            return
+
+        self.available[rows, cols] = False
+
+        copy_rows, pos_copies = _group_copies(rows.numpy(), cols.numpy(), self.positions_per_copy, self.spacing)
+        order = np.argsort(pos_copies, kind="stable")
+        device = self.tokens.device
+        lls = masked_copies_lls(self.model_fwd_at, self.tokens, self.attention_mask, self.mask_token,
+                                torch.as_tensor(copy_rows, device=device), torch.as_tensor(pos_copies[order], device=device),
+                                cols[order].to(device=device), self.max_copies)
+        lls = lls.double().cpu()
+        rows = rows[order]
+
+        self.counts.index_add_(0, rows, torch.ones_like(lls))
+        self.sums.index_add_(0, rows, lls)
+        self.sq_sums.index_add_(0, rows, lls ** 2)
+
+    def estimate(self):
+        """
+        Estimated pseudo-log-likelihoods and their standard errors, as float64 tensors.
+        """
+        counts = self.counts.clamp(min=1)
+        mean = self.sums / counts
+        var = ((self.sq_sums - self.sums * mean) / (self.counts - 1).clamp(min=1)).clamp(min=0)
+        fpc = (1 - self.counts / self.totals.clamp(min=1)).clamp(min=0)
+        se = self.totals * torch.sqrt(var / counts * fpc)
+        # A single sample of several positions has no variance estimate
+        se[(self.counts < 2) & ~self.exhausted] = float("inf")
+
+        return self.totals * mean, se
+
+
+def sampled_pll(sampler, num_samples):
+    """
+    Estimated pseudo-log-likelihoods and standard errors from `num_samples` positions per sequence of a
+    SampledPLL, as numpy arrays.
+    """
+    sampler.sample(num_samples)
+    est, se = sampler.estimate()
+
+    return est.numpy(), se.numpy()
+
+
+def adaptive_pll_pair(sampler_a, sampler_b, num_samples, confidence):
+    """
+    Estimated pseudo-log-likelihoods and standard errors of paired sequences (sequence and control, or two
+    alleles) from two SampledPLLs, as numpy arrays (estimate a, se a, estimate b, se b). Each pair samples
+    `num_samples` more positions per sequence per round until the sign of its difference is resolved at
+    `confidence` under a normal approximation, or until every position is scored and the difference is exact.
+    """
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    active = torch.ones(sampler_a.totals.shape[0], dtype=torch.bool)
+    while active.any():
+        sampler_a.sample(num_samples, active)
+        sampler_b.sample(num_samples, active)
+        est_a, se_a = sampler_a.estimate()
+        est_b, se_b = sampler_b.estimate()
+
+        resolved = (est_a - est_b).abs() > z * torch.sqrt(se_a ** 2 + se_b ** 2)
+        resolved |= sampler_a.exhausted & sampler_b.exhausted
+        active &= ~resolved
+
+    return est_a.numpy(), se_a.numpy(), est_b.numpy(), se_b.numpy()
+
+
+def pair_positions_ll(model_fwd_pair_at, tokens_a, attention_mask_a, starts_a, ends_a,
+                      tokens_b, attention_mask_b, starts_b, ends_b):
+    """
+    positions_ll of two token batches scored together by `model_fwd_pair_at`, as in LMHeadAtPositions.
+    """
+    rows_a, cols_a = scored_positions(starts_a, ends_a, tokens_a.shape[:2], device=tokens_a.device)
+    rows_b, cols_b = scored_positions(starts_b, ends_b, tokens_b.shape[:2], device=tokens_b.device)
+    lls_a, lls_b = model_fwd_pair_at(tokens_a, attention_mask_a, rows_a, cols_a, tokens_b, attention_mask_b, rows_b, cols_b)
+
+    return row_sums(lls_a, rows_a, cols_a, tokens_a.shape[:2]), row_sums(lls_b, rows_b, cols_b, tokens_b.shape[:2])
@@ -0,0 +1,174 @@
+import os
+import json
+import uuid
+import shutil
+
+import numpy as np
+import h5py
+
+_PROGRESS_NAME = "progress.json"
+
+
+def _parts_dir(path):
+    return path + ".parts"
+
+
+def _progress(parts_dir):
+    # The id of the parts directory and its committed parts
+    progress_path = os.path.join(parts_dir, _PROGRESS_NAME)
+    if not os.path.exists(progress_path):
+        return None, []
+
+    with open(progress_path) as f:
+        progress = json.load(f)
+
+    return progress["id"], progress["parts"]
+
+
+def _merged_id(path):
+    if not os.path.exists(path):
+        return None
+
+    with h5py.File(path, "r") as f:
+        return f.attrs.get("parts_id")
+
+
+def _pieces(path):
+    # The merged score file, if any, then the committed parts in commit order. Parts already merged, left behind
+    # by an interruption between the merge and their removal, are skipped.
+    pieces = [path] if os.path.exists(path) else []
+    parts_dir = _parts_dir(path)
+    parts_id, parts = _progress(parts_dir)
+    if parts_id is None or parts_id != _merged_id(path):
+        pieces.extend(os.path.join(parts_dir, name) for name in parts)
+
+    return pieces
+
+
+def read_scores(path, columns=None):
+    """
+    Columns of a score file as numpy arrays ordered by dataset position, including the parts committed by an
+    unfinished run. `columns` selects a subset; all columns by default.
+    """
+    parts = {}
+    for piece in _pieces(path):
+        with h5py.File(piece, "r") as f:
+            for name in (columns if columns is not None else f.keys()):
+                parts.setdefault(name, []).append(f[name][:])
+
+    if len(parts) == 0:
+        return {}
+
+    scores = {name: np.concatenate(values) for name, values in parts.items()}
+    pos = scores["pos"] if "pos" in scores else read_scores(path, columns=["pos"])["pos"]
+    order = np.argsort(pos, kind="stable")
+
+    return {name: values[order] for name, values in scores.items()}
+
+
+class ScoreWriter:
+    """
+    Columnar HDF5 score output keyed by dataset position ("pos"). Rows are buffered in memory and committed
+    every `chunk_size` rows as a part file, written under a temporary name and renamed into place, then listed
+    in a progress marker replaced the same way, so an interrupted run leaves only whole committed parts. `close`
+    appends the parts to the score file one at a time and removes them. With `resume`, rows already in the score
+    file or its committed parts are kept and left out of `remaining`; otherwise earlier output is cleared.
+    """
+    def __init__(self, path, chunk_size=4096, resume=False):
+        self.path = path
+        self.parts_dir = _parts_dir(path)
+        self.chunk_size = chunk_size
+
+        if not resume:
+            shutil.rmtree(self.parts_dir, ignore_errors=True)
+            if os.path.exists(path):
+                os.remove(path)
+
+        self.parts_id, self.parts = _progress(self.parts_dir)
+        if self.parts_id is not None and self.parts_id == _merged_id(path):
+            shutil.rmtree(self.parts_dir)
+            self.parts_id, self.parts = None, []
+        if self.parts_id is None:
+            self.parts_id = uuid.uuid4().hex
+        os.makedirs(self.parts_dir, exist_ok=True)
+
+        # Files not in the progress marker are from an interrupted commit
+        for name in os.listdir(self.parts_dir):
+            if name != _PROGRESS_NAME and name not in self.parts:
+                os.remove(os.path.join(self.parts_dir, name))
+
+        self.done = read_scores(path, columns=["pos"]).get("pos", np.zeros(0, dtype=np.int64))
+
+        self._buffer = {}
+        self._buffered = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Buffered rows are whole batches, so they are kept on failure too
+        if exc_type is None:
+            self.close()
+        else:
+            self.commit()
+
+    def remaining(self, num_items):
+        """
+        Positions out of `num_items` not yet scored, in order.
+        """
+        return np.setdiff1d(np.arange(num_items), self.done)
+
+    def write(self, pos, **columns):
+        """
+        Buffers rows at dataset positions `pos`, one value (or array) per row in each column.
+        """
+        self._buffer.setdefault("pos", []).append(np.asarray(pos, dtype=np.int64))
+        for name, values in columns.items():
+            self._buffer.setdefault(name, []).append(np.asarray(values))
+        self._buffered += len(pos)
+
+        if self._buffered >= self.chunk_size:
+            self.commit()
+
+    def commit(self):
+        if self._buffered == 0:
+            return
+
+        name = f"{len(self.parts):06d}.h5"
+        part_path = os.path.join(self.parts_dir, name)
+        with h5py.File(part_path + ".tmp", "w") as f:
+            for col, values in self._buffer.items():
+                f.create_dataset(col, data=np.concatenate(values))
+        os.replace(part_path + ".tmp", part_path)
+
+        self.parts.append(name)
+        progress_path = os.path.join(self.parts_dir, _PROGRESS_NAME)
+        with open(progress_path + ".tmp", "w") as f:
+            json.dump({"id": self.parts_id, "parts": self.parts}, f)
+        os.replace(progress_path + ".tmp", progress_path)
+
+        self._buffer = {}
+        self._buffered = 0
+
+    def close(self):
+        self.commit()
+
+        if len(self.parts) > 0:
+            # The merged file records the parts it holds, so they are not read again if removing them is interrupted
+            with h5py.File(self.path + ".tmp", "w") as out_f:
+                out_f.attrs["parts_id"] = self.parts_id
+                for piece in _pieces(self.path):
+                    with h5py.File(piece, "r") as f:
+                        for col, values in f.items():
+                            if col not in out_f:
+                                out_f.create_dataset(col, shape=((0,) + values.shape[1:]), maxshape=((None,) + values.shape[1:]),
+                                                     dtype=values.dtype, chunks=True)
+                            dset = out_f[col]
+                            offset = dset.shape[0]
+                            dset.resize(offset + values.shape[0], axis=0)
+                            for i in range(0, values.shape[0], self.chunk_size):
+                                dset[offset + i:offset + i + self.chunk_size] = values[i:i + self.chunk_size]
+            os.replace(self.path + ".tmp", self.path)
+
+        shutil.rmtree(self.parts_dir, ignore_errors=True)
+        self.parts_id, self.parts = uuid.uuid4().hex, []
@@ -1,16 +1,22 @@
 # from abc import ABCMeta, abstractmethod
 import hashlib
 import os
+import json
 
 import numpy as np
 import torch
 from torch.utils.data import Dataset, DataLoader
 import polars as pl
-import pyfaidx
 # from scipy.stats import wilcoxon
-# from tqdm import tqdm
+from tqdm import tqdm
 
-from ..utils import one_hot_encode, copy_if_not_exists
+from ..cache import cached_path
+from ..genome import load_genome
+from ..elements import ElementTable
+from ..encoding import N_TOKEN, tokens_to_one_hot
+from ..utils import dinucleotide_shuffle_keys, dinucleotide_shuffle_batch
+
+_CONTROLS_INDEX_NAME = "index.json"
 
 class PairedControlDataset(Dataset):
     _elements_dtypes = {
@@ -28,31 +34,35 @@ class PairedControlDataset(Dataset):
 
     _seed_upper = 2**128
 
-    def __init__(self, genome_fa, elements_tsv, chroms, seed, cache_dir=None):
+    def __init__(self, genome_fa, elements_tsv, chroms, seed, cache_dir=None, controls_dir=None, num_ctrls=None):
         super().__init__()
 
         self.seed = seed
+        # None keeps the original per-item SHA-256 seeded shuffle; an integer K returns (K, L, 4) controls per item
+        # from the batched, counter-seeded shuffle
+        self.num_ctrls = num_ctrls
+        if num_ctrls is not None and controls_dir is not None:
+            raise ValueError("Precomputed controls only cover the single-control shuffle")
 
         self.elements_df = self._load_elements(elements_tsv, chroms)
+        self.elements = ElementTable(self.elements_df)
 
         if cache_dir is not None:
-            os.makedirs(cache_dir, exist_ok=True)
-
-            fa_path_abs = os.path.abspath(genome_fa)
-            fa_idx_path_abs = fa_path_abs + ".fai"
-            fa_path_hash = hashlib.sha256(fa_path_abs.encode('utf-8')).hexdigest()
-            fa_cache_path = os.path.join(cache_dir, fa_path_hash + ".fa")
-            fa_idx_cache_path = fa_cache_path + ".fai"
-            copy_if_not_exists(genome_fa, fa_cache_path)
-            genome_fa = fa_cache_path
-            try:
-                copy_if_not_exists(fa_idx_path_abs, fa_idx_cache_path)
-            except FileNotFoundError:
-                pass
+            genome_fa = cached_path(genome_fa, cache_dir, companions=(".fai",))
 
         self.genome_fa = genome_fa
-        fa = pyfaidx.Fasta(self.genome_fa) # Build index if needed
-        fa.close()
+        self.genome = load_genome(self.genome_fa)
+
+        self.controls_dir = controls_dir
+        if controls_dir is not None:
+            self._check_controls(controls_dir, elements_tsv)
+        self._controls = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_controls"] = None # np.memmap pickles as a full in-memory copy
+
+        return state
 
     @classmethod
     def _load_elements(cls, elements_file, chroms):
@@ -102,44 +112,192 @@ class PairedControlDataset(Dataset):
         return shuffled
     
     def __len__(self):
-        return self.elements_df.height
+        return self.elements.height
     
     def __getitem__(self, idx):
-        idx_orig, chrom, start, end, elem_start, elem_end, _, _, rc = self.elements_df.row(idx)
+        return self.__getitems__([idx])[0]
+
+    def _element_bounds(self, chrom, start, end, elem_start, elem_end):
+        a = max(0, start) - start
+        b = min(end, self.genome.chrom_size(chrom)) - start
+
+        e_a = max(elem_start - start, a)
+        e_b = min(elem_end - start, b)
+
+        return e_a, e_b
+
+    def _rows(self, indices):
+        # (chrom, start, end, elem_start, elem_end) per index, as Python scalars
+        return list(zip(self.elements.chroms(indices), self.elements["input_start"][indices].tolist(), 
+                        self.elements["input_end"][indices].tolist(), self.elements["ccre_start"][indices].tolist(),
+                        self.elements["ccre_end"][indices].tolist()))
+
+    def _shuffle_element(self, row, seq):
+        chrom, start, end, elem_start, elem_end = row
 
         item_bytes = (self.seed, chrom, elem_start, elem_end).__repr__().encode('utf-8')
         item_seed = int(hashlib.sha256(item_bytes).hexdigest(), 16) % self._seed_upper
         
         rng = np.random.default_rng(item_seed)
 
-        # Extract the sequence
-        window = end - start
-        seq = np.zeros((window, 4), dtype=np.int8)
+        e_a, e_b = self._element_bounds(chrom, start, end, elem_start, elem_end)
+        elem = seq[e_a:e_b,:]
+        shuf = self._dinuc_shuffle(elem, rng)
+
+        return e_a, e_b, shuf
 
-        fa = pyfaidx.Fasta(self.genome_fa, one_based_attributes=False)
+    def _check_controls(self, controls_dir, elements_tsv):
+        with open(os.path.join(controls_dir, _CONTROLS_INDEX_NAME)) as f:
+            index = json.load(f)
 
-        sequence_data = fa[chrom][max(0, start):end]
-        sequence = sequence_data.seq.upper()
-        start_adj = sequence_data.start
-        end_adj = sequence_data.end
+        if index["seed"] != self.seed:
+            raise ValueError(f"Controls in {controls_dir} were generated with seed {index['seed']}, not {self.seed}")
+        if index["elements_sha256"] != _file_sha256(elements_tsv):
+            raise ValueError(f"Controls in {controls_dir} were generated from a different elements file")
 
-        fa.close()
+    @property
+    def controls(self):
+        if self.controls_dir is not None and self._controls is None:
+            offsets = np.load(os.path.join(self.controls_dir, "offsets.npy"))
+            tokens = np.memmap(os.path.join(self.controls_dir, "controls.u8"), dtype=np.uint8, mode="r", 
+                               shape=(int(offsets[-1]),))
+            self._controls = offsets, tokens
 
-        a = start_adj - start
-        b = end_adj - start
-        seq[a:b,:] = one_hot_encode(sequence)
+        return self._controls
 
-        # Generate shuffled control
-        e_a = max(elem_start - start, a)
-        e_b = min(elem_end - start, b)
-        elem = seq[e_a:e_b,:]
-        shuf = self._dinuc_shuffle(elem, rng)
-        ctrl = seq.copy()
-        ctrl[e_a:e_b,:] = shuf
-        
-        # Reverse complement augment
-        if rc:
-            seq = seq[::-1,::-1].copy()
-            ctrl = ctrl[::-1,::-1].copy()
+    def control_tokens(self, indices):
+        """
+        Shuffled element tokens for the given dataset indices, as stored by `write_controls`.
+        """
+        indices = np.asarray(indices)
+        rows = self._rows(indices)
+        seqs = self.genome.fetch_batch([row[0] for row in rows], [row[1] for row in rows], [row[2] for row in rows])
+
+        return [self._shuffle_element(row, seq)[2].argmax(axis=1).astype(np.uint8) for row, seq in zip(rows, seqs)]
+
+    def _batched_controls(self, rows, seqs):
+        bounds = [self._element_bounds(*row) for row in rows]
+        lengths = np.array([max(e_b - e_a, 0) for e_a, e_b in bounds])
+
+        elem_tokens = np.full((len(rows), lengths.max(initial=0)), N_TOKEN, dtype=np.uint8)
+        for i, ((e_a, e_b), seq) in enumerate(zip(bounds, seqs)):
+            elem = seq[e_a:e_b,:]
+            elem_tokens[i,:len(elem)] = np.where(elem.any(axis=1), elem.argmax(axis=1), N_TOKEN)
+
+        # One row per (element, replicate)
+        replicates = np.tile(np.arange(self.num_ctrls), len(rows))
+        keys = dinucleotide_shuffle_keys(self.seed, [row[0] for row in rows for _ in range(self.num_ctrls)],
+                                         np.repeat([row[3] for row in rows], self.num_ctrls),
+                                         np.repeat([row[4] for row in rows], self.num_ctrls), replicates)
+        shuf_tokens = dinucleotide_shuffle_batch(np.repeat(elem_tokens, self.num_ctrls, axis=0), 
+                                                 np.repeat(lengths, self.num_ctrls), keys)
+        shuf = tokens_to_one_hot(shuf_tokens).reshape(len(rows), self.num_ctrls, -1, 4)
+
+        ctrls = np.repeat(seqs[:,None,:,:], self.num_ctrls, axis=1)
+        for i, (e_a, e_b) in enumerate(bounds):
+            ctrls[i,:,e_a:e_b,:] = shuf[i,:,:e_b - e_a,:]
+
+        return ctrls
+
+    def __getitems__(self, indices):
+        indices = np.asarray(indices)
+        rows = self._rows(indices)
+        idxs_orig = self.elements["index"][indices].tolist()
+        rcs = self.elements["reverse_complement"][indices].tolist()
+
+        # Extract the sequences
+        seqs = self.genome.fetch_batch([row[0] for row in rows], [row[1] for row in rows], [row[2] for row in rows])
+
+        if self.num_ctrls is not None:
+            items = []
+            for idx_orig, rc, seq, ctrls in zip(idxs_orig, rcs, seqs, self._batched_controls(rows, seqs)):
+                # Reverse complement augment
+                if rc:
+                    seq = seq[::-1,::-1].copy()
+                    ctrls = ctrls[:,::-1,::-1].copy()
+
+                items.append((torch.from_numpy(seq), torch.from_numpy(ctrls), torch.tensor(idx_orig)))
+
+            return items
+
+        items = []
+        for idx_orig, rc, row, seq in zip(idxs_orig, rcs, rows, seqs):
+            # Generate shuffled control, or read back a precomputed one
+            if self.controls is None:
+                e_a, e_b, shuf = self._shuffle_element(row, seq)
+            else:
+                e_a, e_b = self._element_bounds(*row)
+                offsets, tokens = self.controls
+                shuf = tokens_to_one_hot(tokens[offsets[idx_orig]:offsets[idx_orig + 1]])
+            ctrl = seq.copy()
+            ctrl[e_a:e_b,:] = shuf
+            
+            # Reverse complement augment
+            if rc:
+                seq = seq[::-1,::-1].copy()
+                ctrl = ctrl[::-1,::-1].copy()
+
+            items.append((torch.from_numpy(seq), torch.from_numpy(ctrl), torch.tensor(idx_orig)))
+
+        return items
+
+
+def _file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(2**20), b""):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def _identity(batch):
+    return batch
+
+
+class _ControlTokens(Dataset):
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitems__(self, indices):
+        return self.dataset.control_tokens(indices)
+
+
+def write_controls(genome_fa, elements_tsv, seed, out_dir, batch_size=1024, num_workers=0, progress_bar=False):
+    """
+    Materializes the dinucleotide-shuffled control of every element in `elements_tsv` as a flat uint8 token
+    file indexed by row. A PairedControlDataset given the output as `controls_dir` reproduces its on-the-fly
+    controls exactly.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+
+    dataset = PairedControlDataset(genome_fa, elements_tsv, None, seed)
+    dataloader = DataLoader(_ControlTokens(dataset), batch_size=batch_size, shuffle=False, num_workers=num_workers,
+                            collate_fn=_identity)
+
+    offsets = [0]
+    tokens_path = os.path.join(out_dir, "controls.u8")
+    with open(tokens_path + ".tmp", "wb") as f:
+        for batch in tqdm(dataloader, disable=(not progress_bar), ncols=120):
+            for tokens in batch:
+                f.write(tokens.tobytes())
+                offsets.append(offsets[-1] + len(tokens))
+    os.replace(tokens_path + ".tmp", tokens_path)
+    np.save(os.path.join(out_dir, "offsets.npy"), np.array(offsets, dtype=np.int64))
+
+    # The index is written last, so an interrupted run is never picked up
+    index = {
+        "seed": seed,
+        "genome": os.path.abspath(genome_fa),
+        "elements": os.path.abspath(elements_tsv),
+        "elements_sha256": _file_sha256(elements_tsv),
+        "num_elements": len(dataset),
+    }
+    with open(os.path.join(out_dir, _CONTROLS_INDEX_NAME + ".tmp"), "w") as f:
+        json.dump(index, f, indent=4)
+    os.replace(os.path.join(out_dir, _CONTROLS_INDEX_NAME + ".tmp"), os.path.join(out_dir, _CONTROLS_INDEX_NAME))
 
-        return torch.from_numpy(seq), torch.from_numpy(ctrl), torch.tensor(idx_orig)
+    return index
@@ -0,0 +1,25 @@
+import argparse
+
+from ..components import write_controls
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(description="Precomputes the dinucleotide-shuffled controls of a paired-control elements file")
+	parser.add_argument("--genome_fa", type=str, required=True, help="Genome FASTA file or compiled genome directory")
+	parser.add_argument("--elements_tsv", type=str, required=True, help="Processed elements file")
+	parser.add_argument("--seed", type=int, default=0, help="Dataset seed the controls are generated for")
+	parser.add_argument("--out_dir", type=str, required=True, help="Output directory, passed to PairedControlDataset as controls_dir")
+	parser.add_argument("--batch_size", type=int, default=1024, help="Elements per batch")
+	parser.add_argument("--num_workers", type=int, default=0, help="DataLoader workers")
+	args = parser.parse_args()
+	return args
+
+
+def main():
+	args = parse_args()
+	index = write_controls(args.genome_fa, args.elements_tsv, args.seed, args.out_dir, 
+						   batch_size=args.batch_size, num_workers=args.num_workers, progress_bar=True)
+	print(f"Wrote controls for {index['num_elements']} elements to {args.out_dir}")
+
+if __name__ == "__main__":
+	main()
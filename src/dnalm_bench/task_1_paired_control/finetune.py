@@ -16,14 +16,15 @@ import polars as pl
 from sklearn.metrics import roc_auc_score, average_precision_score, matthews_corrcoef
 
 from ..finetune import HFClassifierModel, LoRAModule
-from ..utils import onehot_to_chars, one_hot_encode, NoModule, copy_if_not_exists
+from ..utils import one_hot_encode, NoModule
+from ..tokenization import CharTokenizer, KmerTokenizer, loader_collate_fn
 
 
 def train_finetuned_classifier(train_dataset, val_dataset, model, num_epochs, out_dir, batch_size, lr, wd, accumulate, num_workers, prefetch_factor, device, progress_bar=False, resume_from=None):
     train_dataloader = DataLoader(train_dataset, batch_size=batch_size, num_workers=num_workers,
-                                  pin_memory=True, prefetch_factor=prefetch_factor, persistent_workers=True)
+                                  pin_memory=True, prefetch_factor=prefetch_factor, persistent_workers=True, collate_fn=loader_collate_fn(train_dataset, model, seq_fields=(0, 1)))
     val_dataloader = DataLoader(val_dataset, batch_size=batch_size, num_workers=num_workers, 
-                                pin_memory=True, prefetch_factor=prefetch_factor, persistent_workers=True)
+                                pin_memory=True, prefetch_factor=prefetch_factor, persistent_workers=True, collate_fn=loader_collate_fn(val_dataset, model, seq_fields=(0, 1)))
 
     os.makedirs(out_dir, exist_ok=True)
     log_file = os.path.join(out_dir, "train.log")
@@ -108,7 +109,7 @@ def train_finetuned_classifier(train_dataset, val_dataset, model, num_epochs, ou
 
 def evaluate_finetuned_classifier(test_dataset, model, out_path, batch_size,num_workers, prefetch_factor, device, progress_bar=False):
     test_dataloader = DataLoader(test_dataset, batch_size=batch_size, num_workers=num_workers,
-                                  pin_memory=True, prefetch_factor=prefetch_factor)
+                                  pin_memory=True, prefetch_factor=prefetch_factor, collate_fn=loader_collate_fn(test_dataset, model, seq_fields=(0, 1)))
 
     zero = torch.tensor(0, dtype=torch.long, device=device)[None]
     one = torch.tensor(1, dtype=torch.long, device=device)[None]
@@ -217,10 +218,10 @@ class NucleotideTransformerLoRAModel(HFClassifierModel):
         model.esm = LoRAModule(model.esm, lora_rank, lora_alpha, lora_dropout)
 
         super().__init__(tokenizer, model)
+        self.tensor_tokenizer = KmerTokenizer(tokenizer)
 
     def _tokenize(self, seqs):
-        seqs_str = onehot_to_chars(seqs)
-        encoded = self.tokenizer(seqs_str, return_tensors="pt", padding=True)
+        encoded = self.tensor_tokenizer(seqs)
         tokens = encoded["input_ids"]
 
         return tokens.to(self.device), None
@@ -234,10 +235,10 @@ class HyenaDNALoRAModel(HFClassifierModel):
         model.hyena = LoRAModule(model.hyena, lora_rank, lora_alpha, lora_dropout)
 
         super().__init__(tokenizer, model)
+        self.tensor_tokenizer = CharTokenizer(tokenizer)
 
     def _tokenize(self, seqs):
-        seqs_str = onehot_to_chars(seqs)
-        encoded = self.tokenizer(seqs_str, return_tensors="pt", padding=True)
+        encoded = self.tensor_tokenizer(seqs)
         tokens = encoded["input_ids"]
 
         return tokens.to(self.device), None
@@ -259,10 +260,10 @@ class CaduceusLoRAModel(HFClassifierModel):
         model.caduceus = LoRAModule(model.caduceus, lora_rank, lora_alpha, lora_dropout)
 
         super().__init__(tokenizer, model)
+        self.tensor_tokenizer = CharTokenizer(tokenizer)
 
     def _tokenize(self, seqs):
-        seqs_str = onehot_to_chars(seqs)
-        encoded = self.tokenizer(seqs_str, return_tensors="pt", padding=True)
+        encoded = self.tensor_tokenizer(seqs)
         tokens = encoded["input_ids"]
 
         return tokens.to(self.device), None
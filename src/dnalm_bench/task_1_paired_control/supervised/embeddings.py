@@ -11,7 +11,7 @@ from tqdm import tqdm
 import h5py
 
 from ..components import PairedControlDataset
-from ...utils import onehot_to_chars
+from ...tokenization import CharTokenizer, KmerTokenizer, offsets_to_indices
 from ...embeddings import HFEmbeddingExtractor, SequenceBaselineEmbeddingExtractor
 
 
@@ -20,12 +20,7 @@ class PairedControlEmbeddingExtractor:
 
     @staticmethod
     def _offsets_to_indices(offsets, seqs):
-        gather_idx = np.zeros((seqs.shape[0], seqs.shape[1]), dtype=np.uint32)
-        for i, offset in enumerate(offsets):
-            for j, (start, end) in enumerate(offset):
-                gather_idx[i,start:end] = j
-        
-        return gather_idx
+        return offsets_to_indices(offsets, seqs.shape[1]).numpy(force=True).astype(np.uint32)
 
     def extract_embeddings(self, dataset, out_path, progress_bar=False):
         dataloader = DataLoader(dataset, batch_size=self.batch_size, shuffle=False, num_workers=self.num_workers)
@@ -103,10 +98,10 @@ class HyenaDNAEmbeddingExtractor(HFEmbeddingExtractor, PairedControlEmbeddingExt
         tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True, padding_side="right")
         model =  AutoModelForCausalLM.from_pretrained(model_name, trust_remote_code=True)
         super().__init__(tokenizer, model, batch_size, num_workers, device)
+        self.tensor_tokenizer = CharTokenizer(tokenizer)
 
     def tokenize(self, seqs):
-        seqs_str = onehot_to_chars(seqs)
-        encoded = self.tokenizer(seqs_str, return_tensors="pt", padding=True)
+        encoded = self.tensor_tokenizer(seqs)
         tokens = encoded["input_ids"]
 
         return tokens, None
@@ -134,24 +129,18 @@ class NucleotideTransformerEmbeddingExtractor(HFEmbeddingExtractor, PairedContro
         tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
         model =  AutoModelForMaskedLM.from_pretrained(model_name, trust_remote_code=True)
         super().__init__(tokenizer, model, batch_size, num_workers, device)
+        self.tensor_tokenizer = KmerTokenizer(tokenizer)
 
     def tokenize(self, seqs):
-        seqs_str = onehot_to_chars(seqs)
-        encoded = self.tokenizer(seqs_str, return_tensors="pt", padding=True)
+        encoded = self.tensor_tokenizer(seqs, return_indices=True)
         tokens = encoded["input_ids"]
 
-        return tokens, None
+        return tokens, encoded["indices"]
 
     @staticmethod
     def _offsets_to_indices(offsets, seqs):
-        seq_len = seqs.shape[1]
-        inds = np.zeros(seq_len, dtype=np.int32)
-        # seq_len_contig = (seq_len // 6) * 6
-        for i in range(seq_len // 6):
-            inds[i*6:(i+1)*6] = i + 1
-        inds[(i+1)*6:] = np.arange(i+2, i+(seq_len%6)+2)
-
-        return inds
+        # Token index of each base, from the tokenizer pass. Same for every sequence in the batch.
+        return offsets[0].numpy().astype(np.int32)
     
 class CaduceusEmbeddingExtractor(HFEmbeddingExtractor, PairedControlEmbeddingExtractor):
     _idx_mode = "fixed"
@@ -161,10 +150,10 @@ class CaduceusEmbeddingExtractor(HFEmbeddingExtractor, PairedControlEmbeddingExt
         tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True, padding_side="right")
         model = AutoModelForMaskedLM.from_pretrained(model_name, trust_remote_code=True)
         super().__init__(tokenizer, model, batch_size, num_workers, device)
+        self.tensor_tokenizer = CharTokenizer(tokenizer)
 
     def tokenize(self, seqs):
-        seqs_str = onehot_to_chars(seqs)
-        encoded = self.tokenizer(seqs_str, return_tensors="pt", padding=True)
+        encoded = self.tensor_tokenizer(seqs)
         tokens = encoded["input_ids"]
 
         return tokens, None
@@ -1,7 +1,6 @@
 # from abc import ABCMeta, abstractmethod
 import os
 import math
-import hashlib
 import warnings
 import json
 
@@ -20,6 +19,7 @@ from sklearn.metrics import roc_auc_score, average_precision_score, matthews_cor
 from tqdm import tqdm
 
 from ...utils import one_hot_encode
+from ...cache import cached_path, hold_cached
 
 class EmbeddingsDataset(IterableDataset):
     _elements_dtypes = {
@@ -40,13 +40,7 @@ class EmbeddingsDataset(IterableDataset):
         self.embeddings_h5 = embeddings_h5
 
         if cache_dir is not None:
-            os.makedirs(cache_dir, exist_ok=True)
-
-            embeddings_h5_abs = os.path.abspath(embeddings_h5)
-            embeddings_h5_hash = hashlib.sha256(embeddings_h5_abs.encode('utf-8')).hexdigest()
-            embeddings_h5_cache_path = os.path.join(cache_dir, embeddings_h5_hash + ".fa")
-            self._copy_if_not_exists(embeddings_h5, embeddings_h5_cache_path)
-            self.embeddings_h5 = embeddings_h5_cache_path
+            self.embeddings_h5 = cached_path(embeddings_h5, cache_dir)
 
     @classmethod
     def _load_elements(cls, elements_file, chroms):
@@ -80,6 +74,7 @@ class EmbeddingsDataset(IterableDataset):
         query_struct = NCLS(valid_inds, valid_inds + 1, valid_inds)
 
         chunk_start = 0
+        hold_cached(self.embeddings_h5)
         with h5py.File(self.embeddings_h5) as h5:
             chunk_ranges = []
             for name in h5["seq"].keys():
@@ -0,0 +1,101 @@
+import os
+import json
+import argparse
+
+import numpy as np
+from scipy.stats import spearmanr
+from torch.utils.data import DataLoader, Subset
+from tqdm import tqdm
+
+from . import evaluators
+from .evaluators import PairedControlDataset, MaskedZeroShotScore
+from ...tokenization import loader_collate_fn
+
+os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
+work_dir = os.environ.get("DART_WORK_DIR", "")
+
+
+def calibrate_score_mode(evaluator, dataset, num_samples, batch_size, num_workers=0, seed=0, progress_bar=False):
+    """
+    Scores a random subsample of paired-control items both with exact masked pseudo-log-likelihoods and with the
+    one-pass unmasked approximation. Reports the Spearman correlations of the scores and of the sequence-control
+    differences, the task accuracy in each mode, and how often the two modes agree on which of the pair is
+    scored higher.
+    """
+    if not isinstance(evaluator, MaskedZeroShotScore):
+        raise ValueError(f"{type(evaluator).__name__} has no masked score modes to calibrate")
+
+    rng = np.random.default_rng(seed)
+    inds = np.sort(rng.choice(len(dataset), size=min(num_samples, len(dataset)), replace=False))
+    dataloader = DataLoader(Subset(dataset, inds), batch_size=batch_size, shuffle=False, num_workers=num_workers,
+                            collate_fn=loader_collate_fn(dataset, evaluator, seq_fields=(0, 1)))
+
+    modes = ("masked", "unmasked")
+    seq_scores = {mode: [] for mode in modes}
+    ctrl_scores = {mode: [] for mode in modes}
+    score_mode = evaluator.score_mode
+    try:
+        for seqs, ctrls, _ in tqdm(dataloader, disable=(not progress_bar), ncols=120):
+            seq_tokens, seq_starts, seq_ends, seq_attention_mask = evaluator.tokenize(seqs)
+            ctrl_tokens, ctrl_starts, ctrl_ends, ctrl_attention_mask = evaluator.tokenize(ctrls)
+            for mode in modes:
+                evaluator.score_mode = mode
+                seq_scores[mode].append(evaluator.score(seq_tokens, seq_starts, seq_ends, seq_attention_mask))
+                ctrl_scores[mode].append(evaluator.score(ctrl_tokens, ctrl_starts, ctrl_ends, ctrl_attention_mask))
+    finally:
+        evaluator.score_mode = score_mode
+
+    scores = {mode: np.concatenate(seq_scores[mode] + ctrl_scores[mode]) for mode in modes}
+    diffs = {mode: np.concatenate(seq_scores[mode]) - np.concatenate(ctrl_scores[mode]) for mode in modes}
+    corrects = {mode: diffs[mode] > 0 for mode in modes}
+
+    metrics = {
+        "num_pairs": len(inds),
+        "score_spearman": float(spearmanr(scores["masked"], scores["unmasked"]).statistic),
+        "diff_spearman": float(spearmanr(diffs["masked"], diffs["unmasked"]).statistic),
+        "masked_acc": float(corrects["masked"].mean()),
+        "unmasked_acc": float(corrects["unmasked"].mean()),
+        "outcome_agreement": float((corrects["masked"] == corrects["unmasked"]).mean()),
+    }
+
+    return metrics
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compares exact masked pseudo-log-likelihoods with the one-pass unmasked approximation on a subsample of cCRE-control pairs")
+    parser.add_argument("--evaluator", type=str, required=True, help="Masked zero-shot evaluator class, e.g. DNABERT2Evaluator")
+    parser.add_argument("--model_name", type=str, required=True)
+    parser.add_argument("--genome_fa", type=str, default=os.path.join(work_dir, "refs/GRCh38_no_alt_analysis_set_GCA_000001405.15.fasta"))
+    parser.add_argument("--elements_tsv", type=str, default=os.path.join(work_dir, "task_1_ccre/processed_inputs/ENCFF420VPZ_processed.tsv"))
+    parser.add_argument("--chroms", type=str, nargs="+", default=["chr5", "chr10", "chr14", "chr18", "chr20", "chr22"])
+    parser.add_argument("--num_samples", type=int, default=2000)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--device", type=str, default="cuda")
+    parser.add_argument("--out_path", type=str, default=None)
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+
+    dataset = PairedControlDataset(args.genome_fa, args.elements_tsv, args.chroms, args.seed)
+    evaluator = getattr(evaluators, args.evaluator)(args.model_name, dataset, args.batch_size, args.num_workers, args.device)
+    metrics = calibrate_score_mode(evaluator, dataset, args.num_samples, args.batch_size, num_workers=args.num_workers,
+                                   seed=args.seed, progress_bar=True)
+
+    for k, v in metrics.items():
+        print(f"{k}: {v}")
+
+    out_path = args.out_path
+    if out_path is None:
+        out_path = os.path.join(work_dir, f"task_1_ccre/zero_shot_outputs/score_mode_calibration/{args.model_name}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+    with open(out_path, "w") as f:
+        json.dump(metrics, f, indent=4)
+
+if __name__ == "__main__":
+    main()
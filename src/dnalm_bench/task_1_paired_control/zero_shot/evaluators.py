@@ -3,6 +3,7 @@ import os
 import json
 
 import numpy as np
+import polars as pl
 import torch
 import torch.nn.functional as F
 from torch.utils.data import Dataset, DataLoader
@@ -12,8 +13,22 @@ from tqdm import tqdm
 
 from ..components import PairedControlDataset
 from ...utils import onehot_to_chars, NoModule
+from ...tokenization import CharTokenizer, KmerTokenizer, loader_collate_fn
+from ...token_cache import TokenBatch
+from ...batching import BatchedSubset
+from ...score_store import ScoreWriter, read_scores
+from ...pll import LMHeadAtPositions, SampledPLL, masked_pll, positions_ll, pair_positions_ll, sampled_pll, adaptive_pll_pair
 
 class MaskedZeroShotScore(metaclass=ABCMeta):
+    pll_max_tokens = None # Tokens per forward pass of masked copies, the batch size times its length by default
+    score_mode = "masked" # "unmasked" approximates the pseudo-log-likelihood from one forward pass without masking,
+                          # "sampled" and "adaptive" (per pair) estimate it from a random subset of positions
+    pll_num_samples = 32 # Positions sampled per sequence, per round in the adaptive mode
+    pll_positions_per_copy = 1 # Sampled positions masked together in each copy
+    pll_mask_spacing = 64 # Minimum distance between positions masked in the same copy
+    pll_confidence = 0.95 # Confidence at which the adaptive mode resolves the sign of each pair's difference
+    pll_seed = 0
+
     @property
     @abstractmethod
     def mask_token(self):
@@ -23,41 +38,75 @@ class MaskedZeroShotScore(metaclass=ABCMeta):
         tokens = tokens.to(device=self.device)
         if attention_mask is not None:
             attention_mask = attention_mask.to(device=self.device)
-        lls = torch.zeros(tokens.shape[:2], device=self.device)
-        for i in range(tokens.shape[1]):
-            clip_mask = ((i >= starts) & (i < ends)).to(device=self.device)
-            masked_tokens = tokens.clone()
-            masked_tokens[:,i,...] = self.mask_token
-            lls[:,i] = self.model_fwd(masked_tokens, attention_mask, tokens)[:,i] * clip_mask
-
-        out = lls.sum(dim=1).numpy(force=True)
+        if self.score_mode == "masked":
+            out = masked_pll(self.model_fwd_at, tokens, starts, ends, attention_mask, self.mask_token, max_tokens=self.pll_max_tokens)
+        elif self.score_mode == "unmasked":
+            out = positions_ll(self.model_fwd_at, tokens, attention_mask, tokens, starts, ends)
+        elif self.score_mode in ("sampled", "adaptive"):
+            # Unpaired sequences get a fixed number of samples in either mode
+            out, _ = self.score_se(tokens, starts, ends, attention_mask)
+        else:
+            raise ValueError(f"Unknown score mode '{self.score_mode}'")
 
         return out
+
+    def _pll_sampler(self, tokens, starts, ends, attention_mask):
+        if getattr(self, "_pll_generator", None) is None:
+            self._pll_generator = torch.Generator().manual_seed(self.pll_seed)
+        tokens = tokens.to(device=self.device)
+        if attention_mask is not None:
+            attention_mask = attention_mask.to(device=self.device)
+
+        return SampledPLL(self.model_fwd_at, tokens, starts, ends, attention_mask, self.mask_token,
+                          positions_per_copy=self.pll_positions_per_copy, spacing=self.pll_mask_spacing,
+                          max_tokens=self.pll_max_tokens, generator=self._pll_generator)
+
+    def score_se(self, tokens, starts, ends, attention_mask):
+        sampler = self._pll_sampler(tokens, starts, ends, attention_mask)
+
+        return sampled_pll(sampler, self.pll_num_samples)
+
+    def score_pair_se(self, tokens_a, starts_a, ends_a, attention_mask_a, tokens_b, starts_b, ends_b, attention_mask_b):
+        sampler_a = self._pll_sampler(tokens_a, starts_a, ends_a, attention_mask_a)
+        sampler_b = self._pll_sampler(tokens_b, starts_b, ends_b, attention_mask_b)
+        if self.score_mode == "adaptive":
+            return adaptive_pll_pair(sampler_a, sampler_b, self.pll_num_samples, self.pll_confidence)
+
+        return (*sampled_pll(sampler_a, self.pll_num_samples), *sampled_pll(sampler_b, self.pll_num_samples))
     
 
 class CausalZeroShotScore(metaclass=ABCMeta):
+    pair_prefix = False # Score sequence pairs together from one pass over their shared prefix, for wrappers with kv_cache
+
     def score(self, tokens, starts, ends, attention_mask):
         tokens = tokens.to(device=self.device)
         if attention_mask is not None:
             attention_mask = attention_mask.to(device=self.device)
-        lls = self.model_fwd(tokens, attention_mask, tokens)
-        clip_mask = torch.zeros_like(lls)
-        for i in range(lls.shape[1]):
-            clip_mask[:,i] = ((i >= starts) & (i < ends))
+        out = positions_ll(self.model_fwd_at, tokens, attention_mask, tokens, starts, ends)
 
-        # clip_mask = torch.tensor([[(i >= s) and (i < e) for i in range(lls.shape[1])] for s, e in zip(starts, ends)], 
-        #                          dtype=torch.float).to(device=self.device)
+        return out
 
-        out = (lls * clip_mask).sum(1).numpy(force=True)
+    def score_pair(self, tokens_a, starts_a, ends_a, attention_mask_a, tokens_b, starts_b, ends_b, attention_mask_b):
+        tokens_a = tokens_a.to(device=self.device)
+        tokens_b = tokens_b.to(device=self.device)
+        if attention_mask_a is not None:
+            attention_mask_a = attention_mask_a.to(device=self.device)
+        if attention_mask_b is not None:
+            attention_mask_b = attention_mask_b.to(device=self.device)
+        out_a, out_b = pair_positions_ll(self.model_fwd_pair_at, tokens_a, attention_mask_a, starts_a, ends_a,
+                                         tokens_b, attention_mask_b, starts_b, ends_b)
 
-        return out
+        return out_a, out_b
 
 
 class ZeroShotPairedControlEvaluator(metaclass=ABCMeta):
+    score_chunk_size = 4096 # Rows per committed part of the score file
+
     @abstractmethod
     def __init__(self, dataset, batch_size, num_workers, device):
         self.dataset = dataset
-        self.dataloader = DataLoader(self.dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+        self.dataloader = DataLoader(self.dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers,
+                                     collate_fn=loader_collate_fn(self.dataset, self, seq_fields=(0, 1)))
 
         self.device = device
 
@@ -73,38 +122,53 @@ class ZeroShotPairedControlEvaluator(metaclass=ABCMeta):
     # def score(self, tokens, starts, ends, attention_mask):
     #     pass
     
-    def evaluate(self, out_dir, progress_bar=False):
+    def evaluate(self, out_dir, progress_bar=False, resume=False):
         os.makedirs(out_dir, exist_ok=True)
-        scores_path = os.path.join(out_dir, "scores.tsv")
+        scores_path = os.path.join(out_dir, "scores.h5")
+        tsv_path = os.path.join(out_dir, "scores.tsv")
         metrics_path = os.path.join(out_dir, "metrics.json")
 
-        with open(scores_path, "w") as f:
-            f.write("idx\tseq_score\tctrl_score\n")
+        # Sampled scores are written with their standard errors
+        sampled = getattr(self, "score_mode", None) in ("sampled", "adaptive")
+
+        with ScoreWriter(scores_path, chunk_size=self.score_chunk_size, resume=resume) as writer:
+            positions = writer.remaining(len(self.dataset))
+            dataloader = self.dataloader
+            if len(positions) < len(self.dataset):
+                dataloader = DataLoader(BatchedSubset(self.dataset, positions), batch_size=self.dataloader.batch_size, shuffle=False,
+                                        num_workers=self.dataloader.num_workers, collate_fn=self.dataloader.collate_fn)
 
-            metrics = {}
-            diffs_lst = []
-            corrects_lst = []
-            
-            for seqs, ctrls, inds in tqdm(self.dataloader, disable=(not progress_bar), ncols=120):
+            start = 0
+            for seqs, ctrls, inds in tqdm(dataloader, disable=(not progress_bar), ncols=120):
                 seq_tokens, seq_starts, seq_ends, seq_attention_mask = self.tokenize(seqs)
                 ctrl_tokens, ctrl_starts, ctrl_ends, ctrl_attention_mask = self.tokenize(ctrls)
 
-                seq_scores = self.score(seq_tokens, seq_starts, seq_ends, seq_attention_mask)
-                ctrl_scores = self.score(ctrl_tokens, ctrl_starts, ctrl_ends, ctrl_attention_mask)
-
-                for ind, seq_score, ctrl_score in zip(inds, seq_scores, ctrl_scores):
-                    f.write(f"{ind}\t{seq_score}\t{ctrl_score}\n")
-                f.flush()
-
-                diff_batch = seq_scores - ctrl_scores
-                correct_batch = diff_batch > 0
-
-                diffs_lst.append(diff_batch)
-                corrects_lst.append(correct_batch)
-
-            diffs = np.concatenate(diffs_lst)
-            corrects = np.concatenate(corrects_lst)
-
+                if sampled:
+                    seq_scores, seq_ses, ctrl_scores, ctrl_ses = self.score_pair_se(seq_tokens, seq_starts, seq_ends, seq_attention_mask,
+                                                                                    ctrl_tokens, ctrl_starts, ctrl_ends, ctrl_attention_mask)
+                elif getattr(self, "pair_prefix", False):
+                    seq_scores, ctrl_scores = self.score_pair(seq_tokens, seq_starts, seq_ends, seq_attention_mask,
+                                                              ctrl_tokens, ctrl_starts, ctrl_ends, ctrl_attention_mask)
+                else:
+                    seq_scores = self.score(seq_tokens, seq_starts, seq_ends, seq_attention_mask)
+                    ctrl_scores = self.score(ctrl_tokens, ctrl_starts, ctrl_ends, ctrl_attention_mask)
+
+                end = start + len(inds)
+                if sampled:
+                    writer.write(positions[start:end], idx=inds, seq_score=seq_scores, ctrl_score=ctrl_scores, seq_se=seq_ses, ctrl_se=ctrl_ses)
+                else:
+                    writer.write(positions[start:end], idx=inds, seq_score=seq_scores, ctrl_score=ctrl_scores)
+                start = end
+
+        # Scores and summaries are read back from the score file, which includes the rows of earlier runs when resuming
+        columns = ["idx", "seq_score", "ctrl_score", "seq_se", "ctrl_se"] if sampled else ["idx", "seq_score", "ctrl_score"]
+        scores = read_scores(scores_path, columns=columns)
+        pl.DataFrame(scores).write_csv(tsv_path, separator="\t")
+
+        diffs = scores["seq_score"] - scores["ctrl_score"]
+        corrects = diffs > 0
+
+        metrics = {}
         metrics["acc"] = corrects.mean()
 
         wilcox = wilcoxon(diffs, alternative="greater")
@@ -123,7 +187,9 @@ class ZeroShotPairedControlEvaluator(metaclass=ABCMeta):
         return metrics
 
 
-class HFZeroShotEvaluator(ZeroShotPairedControlEvaluator, metaclass=ABCMeta):
+class HFZeroShotEvaluator(ZeroShotPairedControlEvaluator, LMHeadAtPositions, metaclass=ABCMeta):
+    tensor_tokenizer = None # Set by subclasses before __init__, which builds the DataLoader
+
     def __init__(self, tokenizer, model, dataset, batch_size, num_workers, device):
         self.tokenizer = tokenizer
         self.model = model
@@ -145,8 +211,13 @@ class HFZeroShotEvaluator(ZeroShotPairedControlEvaluator, metaclass=ABCMeta):
         return self.tokenizer.mask_token_id
 
     def tokenize(self, seqs):
-        seqs_str = onehot_to_chars(seqs)
-        encoded = self.tokenizer.batch_encode_plus(seqs_str, return_tensors="pt", padding=True)
+        if isinstance(seqs, TokenBatch):
+            encoded = seqs.as_encoded()
+        elif self.tensor_tokenizer is not None:
+            encoded = self.tensor_tokenizer(seqs)
+        else:
+            seqs_str = onehot_to_chars(seqs)
+            encoded = self.tokenizer.batch_encode_plus(seqs_str, return_tensors="pt", padding=True)
         tokens = encoded["input_ids"]
         attention_mask = encoded.get("attention_mask")
         if self.start_token is not None:
@@ -172,6 +243,8 @@ class HFZeroShotEvaluator(ZeroShotPairedControlEvaluator, metaclass=ABCMeta):
     
 
 class DNABERT2Evaluator(HFZeroShotEvaluator, MaskedZeroShotScore):
+    lm_head = "cls"
+
     def __init__(self, model_name, dataset, batch_size, num_workers, device):
         model_name = f"zhihan1996/{model_name}"
         with NoModule("triton"):
@@ -190,6 +263,8 @@ class DNABERT2Evaluator(HFZeroShotEvaluator, MaskedZeroShotScore):
 
 
 class GenaLMEvaluator(HFZeroShotEvaluator, MaskedZeroShotScore):
+    lm_head = "cls"
+
     def __init__(self, model_name, dataset, batch_size, num_workers, device):
         model_name = f"AIRI-Institute/{model_name}"
         tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
@@ -206,10 +281,15 @@ class GenaLMEvaluator(HFZeroShotEvaluator, MaskedZeroShotScore):
 
 
 class HDEvaluator(HFZeroShotEvaluator, CausalZeroShotScore):
+    lm_head = "lm_head"
+    causal = True
+    takes_attention_mask = False
+
     def __init__(self, model_name, dataset, batch_size, num_workers, device):
         model_name = f"LongSafari/{model_name}"
         tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True, padding_side="right")
         model = AutoModelForCausalLM.from_pretrained(model_name, trust_remote_code=True)
+        self.tensor_tokenizer = CharTokenizer(tokenizer)
         super().__init__(tokenizer, model, dataset, batch_size, num_workers, device)
 
     @property
@@ -232,10 +312,14 @@ class HDEvaluator(HFZeroShotEvaluator, CausalZeroShotScore):
     
 
 class CaduceusEvaluator(HFZeroShotEvaluator, MaskedZeroShotScore):
+    lm_head = "lm_head"
+    takes_attention_mask = False
+
     def __init__(self, model_name, dataset, batch_size, num_workers, device):
         model_name = f"kuleshov-group/{model_name}"
         tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True, padding_side="right")
         model = AutoModelForMaskedLM.from_pretrained(model_name, trust_remote_code=True)
+        self.tensor_tokenizer = CharTokenizer(tokenizer)
         super().__init__(tokenizer, model, dataset, batch_size, num_workers, device)
 
     @property
@@ -257,6 +341,10 @@ class CaduceusEvaluator(HFZeroShotEvaluator, MaskedZeroShotScore):
 
 
 class MistralEvaluator(HFZeroShotEvaluator, CausalZeroShotScore):
+    lm_head = "lm_head"
+    causal = True
+    kv_cache = True
+
     def __init__(self, model_name, dataset, batch_size, num_workers, device):
         model_name = f"RaphaelMourad/{model_name}"
         tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
@@ -284,10 +372,13 @@ class MistralEvaluator(HFZeroShotEvaluator, CausalZeroShotScore):
 
 
 class NTEvaluator(HFZeroShotEvaluator, MaskedZeroShotScore):
+    lm_head = "lm_head"
+
     def __init__(self, model_name, dataset, batch_size, num_workers, device):
         model_name = f"InstaDeepAI/{model_name}"
         tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
         model = AutoModelForMaskedLM.from_pretrained(model_name, trust_remote_code=True)
+        self.tensor_tokenizer = KmerTokenizer(tokenizer)
         super().__init__(tokenizer, model, dataset, batch_size, num_workers, device)
 
     @property
@@ -10,32 +10,16 @@ import numpy as np
 from scipy.stats import spearmanr, pearsonr
 from sklearn.metrics import roc_auc_score, average_precision_score
 
+from ..encoding import encode_one_hot
+
 
 def mean_squared_error(true_vals, pred_vals):
 	return np.mean(np.square(true_vals - pred_vals))
 
 
 def dna_to_one_hot(seqs):
-	seq_len = len(seqs[0])
-	assert np.all(np.array([len(s) for s in seqs]) == seq_len)
-
-	# Join all sequences together into one long string, all uppercase
-	seq_concat = "".join(seqs).upper() + "ACGT"
-	# Add one example of each base, so np.unique doesn't miss indices later
-
-	one_hot_map = np.identity(5)[:, :-1].astype(np.int8)
-
-	# Convert string into array of ASCII character codes;
-	base_vals = np.frombuffer(bytearray(seq_concat, "utf8"), dtype=np.int8)
-
-	# Anything that's not an A, C, G, or T gets assigned a higher code
-	base_vals[~np.isin(base_vals, np.array([65, 67, 71, 84]))] = 85
-
-	# Convert the codes into indices in [0, 4], in ascending order by code
-	_, base_inds = np.unique(base_vals, return_inverse=True)
-
-	# Get the one-hot encoding for those indices, and reshape back to separate
-	return one_hot_map[base_inds[:-4]].reshape((len(seqs), seq_len, 4))
+	# Single lookup-table pass over the batch; anything that's not an A, C, G, or T becomes all zeros
+	return encode_one_hot(seqs)
 
 def multinomial_nll(true_counts, logits):
 	"""Compute the multinomial negative log-likelihood
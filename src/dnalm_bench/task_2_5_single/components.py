@@ -1,17 +1,19 @@
 # from abc import ABCMeta, abstractmethod
-import hashlib
-import os
+import warnings
 
 import numpy as np
 import torch
 from torch.utils.data import Dataset, DataLoader
 import polars as pl
-import pyfaidx
 import pandas as pd
 # from scipy.stats import wilcoxon
 # from tqdm import tqdm
 
-from ..utils import one_hot_encode, copy_if_not_exists
+from ..utils import one_hot_encode
+from ..encoding import N_TOKEN, encode_tokens, tokens_to_one_hot
+from ..cache import cached_path
+from ..genome import load_genome
+from ..elements import ElementTable
 
 class SimpleSequence(Dataset):
         _elements_dtypes = {
@@ -26,35 +28,24 @@ class SimpleSequence(Dataset):
 
         _seed_upper = 2**128
 
-        def __init__(self, genome_fa, elements_tsv, chroms, seed, cache_dir=None):
+        def __init__(self, genome_fa, elements_tsv, chroms, seed, cache_dir=None, token_cache=None):
                 super().__init__()
 
                 self.seed = seed
+                self.token_cache = token_cache
 
                 self.elements_df = self._load_elements(elements_tsv, chroms)
+                self.elements = ElementTable(self.elements_df)
 
                 if cache_dir is not None:
-                    os.makedirs(cache_dir, exist_ok=True)
-
-                    fa_path_abs = os.path.abspath(genome_fa)
-                    fa_idx_path_abs = fa_path_abs + ".fai"
-                    fa_path_hash = hashlib.sha256(fa_path_abs.encode('utf-8')).hexdigest()
-                    fa_cache_path = os.path.join(cache_dir, fa_path_hash + ".fa")
-                    fa_idx_cache_path = fa_cache_path + ".fai"
-                    copy_if_not_exists(genome_fa, fa_cache_path)
-                    genome_fa = fa_cache_path
-                    try:
-                        copy_if_not_exists(fa_idx_path_abs, fa_idx_cache_path)
-                    except FileNotFoundError:
-                        pass
+                    genome_fa = cached_path(genome_fa, cache_dir, companions=(".fai",))
 
                 self.genome_fa = genome_fa
-                fa = pyfaidx.Fasta(self.genome_fa) # Build index if needed
-                fa.close()
+                self.genome = load_genome(self.genome_fa)
 
         @classmethod
         def _load_elements(cls, elements_file, chroms):
-                df = pl.scan_csv(elements_file, separator="\t", quote_char=None, dtypes=cls._elements_dtypes)
+                df = pl.scan_csv(elements_file, separator="\t", quote_char=None, dtypes=cls._elements_dtypes).with_row_index()
                 
                 if chroms is not None:
                         df = df.filter(pl.col("chr").is_in(chroms))
@@ -63,30 +54,31 @@ class SimpleSequence(Dataset):
 
                 return df
 
+        @property
+        def collate_fn(self):
+                return self.token_cache.collate if self.token_cache is not None else None
+
+        def token_lengths(self):
+                return self.token_cache.lengths(self.elements["index"]) if self.token_cache is not None else None
         
         def __len__(self):
-                return self.elements_df.height
+                return self.elements.height
         
         def __getitem__(self, idx):
-                chrom, start, end, _, _, _, _ = self.elements_df.row(idx)
+                return self.__getitems__([idx])[0]
 
-                # Extract the sequence
-                window = end - start
-                seq = np.zeros((window, 4), dtype=np.int8)
+        def __getitems__(self, indices):
+                indices = np.asarray(indices)
 
-                fa = pyfaidx.Fasta(self.genome_fa, one_based_attributes=False)
+                if self.token_cache is not None:
+                        # Token mode: rows of the token cache, padded into a TokenBatch by collate_fn
+                        return self.elements["index"][indices].tolist()
 
-                sequence_data = fa[chrom][max(0, start):end]
-                sequence = sequence_data.seq.upper()
-                start_adj = sequence_data.start
-                end_adj = sequence_data.end
+                # Extract the sequences
+                seqs = self.genome.fetch_batch(self.elements.chroms(indices), self.elements["input_start"][indices].tolist(),
+                                               self.elements["input_end"][indices].tolist())
 
-                fa.close()
-
-                a = start_adj - start
-                b = end_adj - start
-                seq[a:b,:] = one_hot_encode(sequence)
-                return torch.from_numpy(seq)
+                return list(torch.from_numpy(seqs))
 
 class VariantDataset(Dataset):
         _elements_dtypes = {
@@ -108,8 +100,18 @@ class VariantDataset(Dataset):
                 self.elements_df = self._load_elements(elements_tsv, chroms)
 
                 self.genome_fa = genome_fa
-                fa = pyfaidx.Fasta(self.genome_fa) # Build index if needed
-                fa.close()
+                self.genome = load_genome(self.genome_fa)
+
+                self.elements = ElementTable(self.elements_df.select("chr", "pos"))
+                # 1-indexed positions
+                self.positions = self.elements["pos"] - 1
+                self.allele1_tokens = self._encode_alleles(self.elements_df.get_column("ref"))
+                self.allele2_tokens = self._encode_alleles(self.elements_df.get_column("alt"))
+
+                self.mismatch_df = self._check_reference()
+                if self.mismatch_df.height > 0:
+                        warnings.warn(f"{self.mismatch_df.height} variants match neither allele in the reference genome "
+                                      "and are scored by substituting both alleles; see mismatch_df")
 
         @classmethod
         def _load_elements(cls, elements_file, chroms):
@@ -122,55 +124,57 @@ class VariantDataset(Dataset):
 
                 return df
 
+        @staticmethod
+        def _encode_alleles(alleles):
+                lengths = alleles.str.len_bytes()
+                if (lengths != 1).any():
+                        bad = alleles.filter(lengths != 1).head(5).to_list()
+                        raise ValueError(f"VariantDataset only supports single-nucleotide alleles, got e.g. {bad}")
+
+                return encode_tokens("".join(alleles.to_list()))
+
+        def _check_reference(self):
+                """
+                Reads the reference base of every variant at once and reports those matching neither allele.
+                """
+                ref_tokens = np.full(len(self.positions), N_TOKEN, dtype=np.uint8)
+                for code, chrom in enumerate(self.elements.chrom_names):
+                        rows = np.flatnonzero(self.elements.chrom_codes == code)
+                        ref_tokens[rows] = self.genome.fetch_positions(chrom, self.positions[rows])
+
+                mismatch = (ref_tokens != self.allele1_tokens) & (ref_tokens != self.allele2_tokens)
+                mismatch_df = (
+                        self.elements_df
+                        .with_row_index()
+                        .with_columns(pl.Series("genome_ref", np.array(list("ACGTN"))[ref_tokens]))
+                        .filter(pl.Series(mismatch))
+                )
+
+                return mismatch_df
 
         def __len__(self):
-                return self.elements_df.height
+                return self.elements.height
 
         def __getitem__(self, idx):
-                chrom, pos, allele1, allele2 = self.elements_df.row(idx)[:4]
+                return self.__getitems__([idx])[0]
+
+        def __getitems__(self, indices):
+                indices = np.asarray(indices)
+                positions = self.positions[indices]
 
-                # 1-indexed position
-                pos = int(pos) - 1
-                # Extract the sequence
+                # Extract the sequences centered on pos, then substitute each allele in place
                 window = 2114
                 sequence_extension = int(window / 2)
-                allele1_seq = np.zeros((window, 4), dtype=np.int8)
-                allele2_seq = np.zeros((window, 4), dtype=np.int8)
-                fa = pyfaidx.Fasta(self.genome_fa, one_based_attributes=False)
-
-                # extend the sequence by -249 on the left of pos and +sequence_extension on the right of pos
-                allele1_sequence_data = fa[chrom][pos-sequence_extension:pos+sequence_extension] # check if pos+250 goes outside chrom
-                start_adj = allele1_sequence_data.start
-                end_adj = allele1_sequence_data.end
-                allele1_sequence_data = str(allele1_sequence_data.seq)
-                allele2_sequence_data = str(fa[chrom][pos-sequence_extension:pos].seq)
-                fa_chrom_pos = str(fa[chrom][pos]).upper()
-                if fa_chrom_pos==allele1: # allele1 is the reference allele
-                        allele2_sequence_data += allele2
-                        allele2_sequence_data += str(fa[chrom][pos+1:pos+sequence_extension].seq)
-                elif fa_chrom_pos==allele2:
-                        allele1_sequence_data, allele2_sequence_data = allele2_sequence_data, allele1_sequence_data # allele2 is the reference allele
-                        allele1_sequence_data += allele1
-                        allele1_sequence_data += str(fa[chrom][pos+1:pos+sequence_extension].seq)
-                else: # allele1 and allele2 both do not appear in the reference genome
-                        print(chrom, pos, allele1, allele2, " not in reference. In reference, it appears as ", fa_chrom_pos)
-                        # still score the SNP by replacing chrom:pos with allele1 and allele2 respectively
-                        allele1_sequence_data = str(fa[chrom][pos-sequence_extension:pos].seq)
-                        allele2_sequence_data = str(fa[chrom][pos-sequence_extension:pos].seq) 
-                        allele1_sequence_data += allele1
-                        allele2_sequence_data += allele2
-                        allele1_sequence_data += str(fa[chrom][pos+1:pos+sequence_extension].seq)
-                        allele2_sequence_data += str(fa[chrom][pos+1:pos+sequence_extension].seq)
-
-                allele1_sequence = allele1_sequence_data.upper()
-                allele2_sequence = allele2_sequence_data.upper()
-
-                fa.close()
-                a = start_adj - (pos - sequence_extension)
-                b = end_adj - (pos - sequence_extension)
-                allele1_seq[a:b,:] = one_hot_encode(allele1_sequence)
-                allele2_seq[a:b,:] = one_hot_encode(allele2_sequence)
-                return torch.from_numpy(allele1_seq), torch.from_numpy(allele2_seq)
+                tokens = self.genome.fetch_tokens_batch(self.elements.chroms(indices),
+                                                        (positions - sequence_extension).tolist(),
+                                                        (positions + sequence_extension).tolist())
+
+                tokens[:,sequence_extension] = self.allele1_tokens[indices]
+                allele1_seqs = tokens_to_one_hot(tokens)
+                tokens[:,sequence_extension] = self.allele2_tokens[indices]
+                allele2_seqs = tokens_to_one_hot(tokens)
+
+                return list(zip(torch.from_numpy(allele1_seqs), torch.from_numpy(allele2_seqs)))
 
 
 class FootprintingDataset(Dataset):
@@ -10,48 +10,53 @@ from scipy.stats import wilcoxon
 from tqdm import tqdm
 import h5py
 from ..embeddings import HFEmbeddingExtractor, SequenceBaselineEmbeddingExtractor
-from ..utils import onehot_to_chars, NoModule
+from ..utils import NoModule
+from ..tokenization import CharTokenizer, KmerTokenizer, offsets_to_indices
+from ..batching import loader_batching, loader_windows, restore_order
 
 
 
 class SimpleEmbeddingExtractor:
     _idx_mode = "variable"
+    max_tokens = None # Token budget per batch in place of batch_size, for datasets with a token cache
 
     @staticmethod
     def _offsets_to_indices(offsets, seqs):
-        gather_idx = np.zeros((seqs.shape[0], seqs.shape[1]), dtype=np.uint32)
-        for i, offset in enumerate(offsets):
-            for j, (start, end) in enumerate(offset):
-                gather_idx[i,start:end] = j
-        
-        return gather_idx
+        return offsets_to_indices(offsets, seqs.shape[1]).numpy(force=True).astype(np.uint32)
 
     def extract_embeddings(self, dataset, out_path, progress_bar=False):
-        dataloader = DataLoader(dataset, batch_size=self.batch_size, shuffle=False, num_workers=self.num_workers)
+        # A window's embeddings are held until it is written in dataset order, so token budget windows are kept small
+        dataloader = DataLoader(dataset, **loader_batching(dataset, self.batch_size, self.max_tokens, window=(self.batch_size * 16)),
+                                num_workers=self.num_workers, collate_fn=getattr(dataset, "collate_fn", None))
 
         with h5py.File(out_path + ".tmp", "w") as out_f:
             seq_grp = out_f.create_group("seq")
 
-            start = 0
-            for seqs in tqdm(dataloader, disable=(not progress_bar)):
-                end = start + len(seqs)
+            for start, end, batches in tqdm(loader_windows(dataloader), disable=(not progress_bar)):
+                window_positions = []
+                window_emb = []
+                window_indices = []
+                for positions, seqs in batches:
+                    seq_tokens, seq_offsets = self.tokenize(seqs)
 
-                seq_tokens, seq_offsets = self.tokenize(seqs)
+                    seq_token_emb = self.model_fwd(seq_tokens)
 
-                seq_token_emb = self.model_fwd(seq_tokens)
+                    window_positions.append(positions)
+                    window_emb.append(seq_token_emb.numpy(force=True))
+
+                    if self._idx_mode == "variable":
+                        window_indices.append(self._offsets_to_indices(seq_offsets, seqs))
+
+                    elif (self._idx_mode == "fixed") and ("idx_fix" not in seq_grp):
+                        seq_indices = self._offsets_to_indices(seq_offsets, seqs)
+                        seq_indices_dset = seq_grp.create_dataset("idx_fix", data=seq_indices, dtype=np.uint32)
 
                 if self._idx_mode == "variable":
-                    seq_indices = self._offsets_to_indices(seq_offsets, seqs)
+                    seq_indices = restore_order(window_indices, window_positions)
                     seq_indices_dset = seq_grp.require_dataset("idx_var", (len(dataset), seq_indices.shape[1]), dtype=np.uint32)
                     seq_indices_dset[start:end] = seq_indices
 
-                elif (start == 0) and (self._idx_mode == "fixed"):
-                    seq_indices = self._offsets_to_indices(seq_offsets, seqs)
-                    seq_indices_dset = seq_grp.create_dataset("idx_fix", data=seq_indices, dtype=np.uint32)
-
-                seq_grp.create_dataset(f"emb_{start}_{end}", data=seq_token_emb.numpy(force=True))
-
-                start = end
+                seq_grp.create_dataset(f"emb_{start}_{end}", data=restore_order(window_emb, window_positions))
 
         os.rename(out_path + ".tmp", out_path)
 
@@ -64,11 +69,7 @@ class HFVariantEmbeddingExtractor(HFEmbeddingExtractor):
 
     @staticmethod
     def _offsets_to_indices(offsets, seqs):
-        gather_idx = np.zeros((seqs.shape[0], seqs.shape[1]), dtype=np.uint32)
-        for i, offset in enumerate(offsets):
-            for j, (start, end) in enumerate(offset):
-                gather_idx[i,start:end] = j
-        return gather_idx
+        return offsets_to_indices(offsets, seqs.shape[1]).numpy(force=True).astype(np.uint32)
 
     def extract_embeddings(self, dataset, out_path, progress_bar=False):
         dataloader = DataLoader(dataset, batch_size=self.batch_size, shuffle=False, num_workers=self.num_workers)
@@ -165,24 +166,18 @@ class NucleotideTransformerEmbeddingExtractor(HFEmbeddingExtractor, SimpleEmbedd
         tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
         model =  AutoModelForMaskedLM.from_pretrained(model_name, trust_remote_code=True)
         super().__init__(tokenizer, model, batch_size, num_workers, device)
+        self.tensor_tokenizer = KmerTokenizer(tokenizer)
 
     def tokenize(self, seqs):
-        seqs_str = onehot_to_chars(seqs)
-        encoded = self.tokenizer(seqs_str, return_tensors="pt", padding=True)
+        encoded = self.tensor_tokenizer(seqs, return_indices=True)
         tokens = encoded["input_ids"]
 
-        return tokens, None
+        return tokens, encoded["indices"]
 
     @staticmethod
     def _offsets_to_indices(offsets, seqs):
-        seq_len = seqs.shape[1]
-        inds = np.zeros(seq_len, dtype=np.int32)
-        # seq_len_contig = (seq_len // 6) * 6
-        for i in range(seq_len // 6):
-            inds[i*6:(i+1)*6] = i + 1
-        inds[(i+1)*6:] = np.arange(i+2, i+(seq_len%6)+2)
-
-        return inds
+        # Token index of each base, from the tokenizer pass. Same for every sequence in the batch.
+        return offsets[0].numpy().astype(np.int32)
 
 class HyenaDNAEmbeddingExtractor(HFEmbeddingExtractor, SimpleEmbeddingExtractor):
     _idx_mode = "fixed"
@@ -192,10 +187,10 @@ class HyenaDNAEmbeddingExtractor(HFEmbeddingExtractor, SimpleEmbeddingExtractor)
         tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True, padding_side="right")
         model =  AutoModelForCausalLM.from_pretrained(model_name, trust_remote_code=True)
         super().__init__(tokenizer, model, batch_size, num_workers, device)
+        self.tensor_tokenizer = CharTokenizer(tokenizer)
 
     def tokenize(self, seqs):
-        seqs_str = onehot_to_chars(seqs)
-        encoded = self.tokenizer(seqs_str, return_tensors="pt", padding=True)
+        encoded = self.tensor_tokenizer(seqs)
         tokens = encoded["input_ids"]
 
         return tokens, None
@@ -213,9 +208,9 @@ class CaduceusEmbeddingExtractor(HFEmbeddingExtractor, SimpleEmbeddingExtractor)
         tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True, padding_side="right")
         model = AutoModelForMaskedLM.from_pretrained(model_name, trust_remote_code=True)
         super().__init__(tokenizer, model, batch_size, num_workers, device)
+        self.tensor_tokenizer = CharTokenizer(tokenizer)
     def tokenize(self, seqs):
-        seqs_str = onehot_to_chars(seqs)
-        encoded = self.tokenizer(seqs_str, return_tensors="pt", padding=True)
+        encoded = self.tensor_tokenizer(seqs)
         tokens = encoded["input_ids"]
         return tokens, None
     
@@ -234,10 +229,10 @@ class HyenaDNAUntrainedEmbeddingExtractor(HFEmbeddingExtractor, SimpleEmbeddingE
         config = AutoConfig.from_pretrained(model_name, trust_remote_code=True)
         model =  AutoModelForCausalLM.from_config(config, trust_remote_code=True)
         super().__init__(tokenizer, model, batch_size, num_workers, device)
+        self.tensor_tokenizer = CharTokenizer(tokenizer)
 
     def tokenize(self, seqs):
-        seqs_str = onehot_to_chars(seqs)
-        encoded = self.tokenizer(seqs_str, return_tensors="pt", padding=True)
+        encoded = self.tensor_tokenizer(seqs)
         tokens = encoded["input_ids"]
 
         return tokens, None
@@ -280,10 +275,10 @@ class HyenaDNAVariantEmbeddingExtractor(HFVariantEmbeddingExtractor):
         tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True, padding_side="right")
         model =  AutoModelForCausalLM.from_pretrained(model_name, trust_remote_code=True)
         super().__init__(tokenizer, model, batch_size, num_workers, device)
+        self.tensor_tokenizer = CharTokenizer(tokenizer)
 
     def tokenize(self, seqs):
-        seqs_str = onehot_to_chars(seqs)
-        encoded = self.tokenizer(seqs_str, return_tensors="pt", padding=True)
+        encoded = self.tensor_tokenizer(seqs)
         tokens = encoded["input_ids"]
 
         return tokens, None
@@ -307,22 +302,16 @@ class NucleotideTransformerVariantEmbeddingExtractor(HFVariantEmbeddingExtractor
         tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
         model =  AutoModelForMaskedLM.from_pretrained(model_name, trust_remote_code=True)
         super().__init__(tokenizer, model, batch_size, num_workers, device)
+        self.tensor_tokenizer = KmerTokenizer(tokenizer)
 
     def tokenize(self, seqs):
-        seqs_str = onehot_to_chars(seqs)
-        encoded = self.tokenizer(seqs_str, return_tensors="pt", padding=True)
+        encoded = self.tensor_tokenizer(seqs, return_indices=True)
         tokens = encoded["input_ids"]
 
-        return tokens, None
+        return tokens, encoded["indices"]
 
     @staticmethod
     def _offsets_to_indices(offsets, seqs):
-        seq_len = seqs.shape[1]
-        inds = np.zeros(seq_len, dtype=np.int32)
-        # seq_len_contig = (seq_len // 6) * 6
-        for i in range(seq_len // 6):
-            inds[i*6:(i+1)*6] = i + 1
-        inds[(i+1)*6:] = np.arange(i+2, i+(seq_len%6)+2)
-
-        return inds
+        # Token index of each base, from the tokenizer pass. Same for every sequence in the batch.
+        return offsets[0].numpy().astype(np.int32)
 
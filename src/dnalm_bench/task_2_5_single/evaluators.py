@@ -1,16 +1,50 @@
 from abc import ABCMeta, abstractmethod
+import os
 
 import numpy as np
 import torch
 import torch.nn.functional as F
 from torch.utils.data import Dataset, DataLoader
 from transformers import AutoTokenizer, AutoModelForMaskedLM, AutoModel, AutoModelForCausalLM, BertConfig, AutoConfig
-from scipy.spatial import distance
 from tqdm import tqdm
 from ..utils import NoModule, onehot_to_chars
+from ..tokenization import CharTokenizer, KmerTokenizer, loader_collate_fn, offsets_to_indices
+from ..token_cache import TokenBatch
+from ..score_store import ScoreWriter, read_scores
+from ..batching import BatchedSubset, loader_batching, loader_windows, restore_order
+from ..pll import (LMHeadAtPositions, SampledPLL, masked_pll, positions_ll, pair_positions_ll, sampled_pll, adaptive_pll_pair,
+                   scored_positions, row_sums)
 import polars as pl
 
-class LikelihoodEvaluator(metaclass=ABCMeta):
+def _scores_path(output_file):
+    # Columnar scores next to the text output, which is written from them once evaluation completes
+    return os.path.splitext(output_file)[0] + ".scores.h5"
+
+
+def _scores_df(scores_path, output_file, columns):
+    scores = read_scores(scores_path, columns=columns)
+    df = pl.DataFrame(scores, schema={name: pl.Float64 for name in columns})
+    df.write_csv(output_file, separator="\t", include_header=False)
+
+    return df
+
+
+def _embedding_distances(embs_allele1, embs_allele2):
+    # Cosine distance, dot product and L2 distance of each pair of rows, in double precision as in scipy.spatial.distance
+    embs_allele1 = torch.as_tensor(embs_allele1, dtype=torch.float64)
+    embs_allele2 = torch.as_tensor(embs_allele2, dtype=torch.float64)
+    dots = (embs_allele1 * embs_allele2).sum(dim=1)
+    cosine_dists = (1 - dots / (embs_allele1.norm(dim=1) * embs_allele2.norm(dim=1))).clip(0, 2)
+    l2_dists = (embs_allele1 - embs_allele2).norm(dim=1)
+
+    return cosine_dists.numpy(), dots.numpy(), l2_dists.numpy()
+
+
+class LikelihoodEvaluator(LMHeadAtPositions, metaclass=ABCMeta):
+    tensor_tokenizer = None
+    max_tokens = None # Token budget per batch in place of batch_size, for datasets with a token cache
+    score_chunk_size = 4096 # Rows per committed part of the score file
+
     def __init__(self, tokenizer, model, batch_size, num_workers, device):
         self.tokenizer = tokenizer
         self.model = model
@@ -34,8 +68,13 @@ class LikelihoodEvaluator(metaclass=ABCMeta):
         return self.tokenizer.mask_token_id
 
     def tokenize(self, seqs):
-        seqs_str = onehot_to_chars(seqs)
-        encoded = self.tokenizer.batch_encode_plus(seqs_str, return_tensors="pt", padding=True)
+        if isinstance(seqs, TokenBatch):
+            encoded = seqs.as_encoded()
+        elif self.tensor_tokenizer is not None:
+            encoded = self.tensor_tokenizer(seqs)
+        else:
+            seqs_str = onehot_to_chars(seqs)
+            encoded = self.tokenizer.batch_encode_plus(seqs_str, return_tensors="pt", padding=True)
         tokens = encoded["input_ids"]
         try:
             attention_mask = encoded["attention_mask"]
@@ -75,46 +114,78 @@ class LikelihoodEvaluator(metaclass=ABCMeta):
             lls = -F.cross_entropy(logits, tokens_out, reduction="none")
         return lls
 
-    def evaluate(self, dataset, output_file, progress_bar=True):
-        out_file_obj = open(output_file, "w")
-        dataloader = DataLoader(dataset, batch_size=self.batch_size, shuffle=False, num_workers=self.num_workers)
-        for seqs in tqdm(dataloader, disable=(not progress_bar), ncols=120):
-            tokens, starts, ends, attention_mask = self.tokenize(seqs)
-            lls = self.score(tokens, starts, ends, attention_mask)
-            for lhood in lls.flatten():
-                out_file_obj.write(f"{str(lhood)}\n")
-                out_file_obj.flush()
+    def evaluate(self, dataset, output_file, progress_bar=True, resume=False):
+        scores_path = _scores_path(output_file)
+        with ScoreWriter(scores_path, chunk_size=self.score_chunk_size, resume=resume) as writer:
+            positions = writer.remaining(len(dataset))
+            subset = BatchedSubset(dataset, positions)
+            # Windows are kept small so that scores reach the writer, and are committed, as the run goes
+            dataloader = DataLoader(subset, **loader_batching(subset, self.batch_size, self.max_tokens, window=(self.batch_size * 16)),
+                                    num_workers=self.num_workers, collate_fn=loader_collate_fn(subset, self))
+            # Token budget batches are length-sorted within each window, so scores are written back in dataset order
+            for start, end, batches in tqdm(loader_windows(dataloader), disable=(not progress_bar), ncols=120):
+                window_positions = []
+                window_lls = []
+                for batch_positions, seqs in batches:
+                    tokens, starts, ends, attention_mask = self.tokenize(seqs)
+                    lls = self.score(tokens, starts, ends, attention_mask)
+                    window_positions.append(batch_positions)
+                    window_lls.append(lls.flatten())
+                writer.write(positions[start:end], lhood=restore_order(window_lls, window_positions))
+
+        scores = read_scores(scores_path, columns=["lhood"])
+        pl.DataFrame(scores).write_csv(output_file, separator="\t", include_header=False)
 
 class VariantLikelihoodEvaluator(LikelihoodEvaluator):
 
-    def evaluate(self, dataset, output_file, progress_bar=True):
-        dataloader = DataLoader(dataset, batch_size=self.batch_size, shuffle=False, num_workers=self.num_workers)
-        allele1_likelihoods = []
-        allele2_likelihoods = []
+    def evaluate(self, dataset, output_file, progress_bar=True, resume=False):
+        # Sampled scores are written with their standard errors
+        sampled = getattr(self, "score_mode", None) in ("sampled", "adaptive")
 
-        with open(output_file, "a") as f:
+        scores_path = _scores_path(output_file)
+        with ScoreWriter(scores_path, chunk_size=self.score_chunk_size, resume=resume) as writer:
+            positions = writer.remaining(len(dataset))
+            subset = BatchedSubset(dataset, positions)
+            dataloader = DataLoader(subset, batch_size=self.batch_size, shuffle=False, num_workers=self.num_workers,
+                                    collate_fn=loader_collate_fn(subset, self, seq_fields=(0, 1), return_offsets=True))
+
+            start = 0
             for allele1, allele2 in tqdm(dataloader, disable=(not progress_bar), ncols=120):
                 torch.cuda.empty_cache()
                 tokens_allele1, starts_allele1, ends_allele1, attention_mask_allele1, offsets_allele1 = self.tokenize(allele1)
                 tokens_allele2, starts_allele2, ends_allele2, attention_mask_allele2, offsets_allele2 = self.tokenize(allele2)
-                lls_allele1 = self.score(tokens_allele1, starts_allele1, ends_allele1, attention_mask_allele1, offsets_allele1, allele1)
-                lls_allele2 = self.score(tokens_allele2, starts_allele2, ends_allele2, attention_mask_allele2, offsets_allele2, allele2)
-                for lhood_allele1, lhood_allele2 in zip(lls_allele1.flatten(), lls_allele2.flatten()):
-                    allele1_likelihoods.append(lhood_allele1)
-                    allele2_likelihoods.append(lhood_allele2)
-                    f.write(f"{lhood_allele1}\t{lhood_allele2}\n")
-                    f.flush()
+                end = start + tokens_allele1.shape[0]
+                if sampled:
+                    lls_allele1, ses_allele1, lls_allele2, ses_allele2 = self.score_pair_se(tokens_allele1, starts_allele1, ends_allele1, attention_mask_allele1,
+                                                                                            tokens_allele2, starts_allele2, ends_allele2, attention_mask_allele2)
+                    writer.write(positions[start:end], allele1_scores=lls_allele1, allele2_scores=lls_allele2,
+                                 allele1_se=ses_allele1, allele2_se=ses_allele2)
+                    start = end
+                    continue
+                if getattr(self, "pair_prefix", False):
+                    lls_allele1, lls_allele2 = self.score_pair(tokens_allele1, starts_allele1, ends_allele1, attention_mask_allele1,
+                                                               tokens_allele2, starts_allele2, ends_allele2, attention_mask_allele2)
+                else:
+                    lls_allele1 = self.score(tokens_allele1, starts_allele1, ends_allele1, attention_mask_allele1, offsets_allele1, allele1)
+                    lls_allele2 = self.score(tokens_allele2, starts_allele2, ends_allele2, attention_mask_allele2, offsets_allele2, allele2)
+                writer.write(positions[start:end], allele1_scores=lls_allele1.flatten(), allele2_scores=lls_allele2.flatten())
+                start = end
                 # tokens_allele1 = tokens_allele1.to("cpu")
                 # tokens_allele2 = tokens_allele2.to("cpu")
 
-        data = {"allele1_scores" : allele1_likelihoods, "allele2_scores" : allele2_likelihoods}
-        df = pl.DataFrame(data, schema={"allele1_scores": pl.Float64, "allele2_scores": pl.Float64})
+        columns = ["allele1_scores", "allele2_scores", "allele1_se", "allele2_se"] if sampled else ["allele1_scores", "allele2_scores"]
 
-        return df
+        return _scores_df(scores_path, output_file, columns)
     
     def tokenize(self, seqs):
-        seqs_str = onehot_to_chars(seqs)
-        encoded = self.tokenizer.batch_encode_plus(seqs_str, return_tensors="pt", padding=True, return_offsets_mapping=True)
+        if isinstance(seqs, TokenBatch):
+            encoded = seqs.as_encoded()
+        elif self.tensor_tokenizer is not None:
+            # Offsets are not reported for tensor tokenization
+            encoded = self.tensor_tokenizer(seqs)
+        else:
+            seqs_str = onehot_to_chars(seqs)
+            encoded = self.tokenizer.batch_encode_plus(seqs_str, return_tensors="pt", padding=True, return_offsets_mapping=True)
         tokens = encoded["input_ids"]
         offsets = encoded.get("offset_mapping")
         attention_mask = encoded.get("attention_mask")
@@ -132,36 +203,34 @@ class VariantLikelihoodEvaluator(LikelihoodEvaluator):
             ends = attention_mask.sum(dim=1) 
         return tokens, starts, ends, attention_mask, offsets
 
+    @staticmethod
+    def _offsets_to_indices(offsets, seqs):
+        return offsets_to_indices(offsets, seqs.shape[1]).numpy(force=True)
 
-class VariantSingleTokenLikelihoodEvaluator(LikelihoodEvaluator):
-    def evaluate(self, dataset, output_file, progress_bar=True):
-        dataloader = DataLoader(dataset, batch_size=self.batch_size, shuffle=False, num_workers=self.num_workers)
-        allele1_likelihoods = []
-        allele2_likelihoods = []
 
-        with open(output_file, "a") as f:
+class VariantSingleTokenLikelihoodEvaluator(LikelihoodEvaluator):
+    def evaluate(self, dataset, output_file, progress_bar=True, resume=False):
+        scores_path = _scores_path(output_file)
+        with ScoreWriter(scores_path, chunk_size=self.score_chunk_size, resume=resume) as writer:
+            positions = writer.remaining(len(dataset))
+            subset = BatchedSubset(dataset, positions)
+            dataloader = DataLoader(subset, batch_size=self.batch_size, shuffle=False, num_workers=self.num_workers,
+                                    collate_fn=loader_collate_fn(subset, self, seq_fields=(0, 1)))
+
+            start = 0
             for allele1, allele2 in tqdm(dataloader, disable=(not progress_bar), ncols=120):
                 torch.cuda.empty_cache()
                 tokens_allele1, starts_allele1, ends_allele1, attention_mask_allele1 = self.tokenize(allele1)
                 tokens_allele2, starts_allele2, ends_allele2, attention_mask_allele2 = self.tokenize(allele2)
 
-                diffs = tokens_allele1 != tokens_allele2
-                tokens_masked = tokens_allele1.clone()
-                tokens_masked[diffs] = self.mask_token
+                lls_allele1, lls_allele2 = self.score_alleles(tokens_allele1, starts_allele1, ends_allele1, attention_mask_allele1,
+                                                              tokens_allele2, starts_allele2, ends_allele2, attention_mask_allele2)
 
-                lls_allele1 = self.score(tokens_masked, tokens_allele1, starts_allele1, ends_allele1, attention_mask_allele1, allele1)
-                lls_allele2 = self.score(tokens_masked, tokens_allele2, starts_allele2, ends_allele2, attention_mask_allele2, allele2)
+                end = start + tokens_allele1.shape[0]
+                writer.write(positions[start:end], allele1_scores=lls_allele1.flatten(), allele2_scores=lls_allele2.flatten())
+                start = end
 
-                for lhood_allele1, lhood_allele2 in zip(lls_allele1.flatten(), lls_allele2.flatten()):
-                    allele1_likelihoods.append(lhood_allele1)
-                    allele2_likelihoods.append(lhood_allele2)
-                    f.write(f"{lhood_allele1}\t{lhood_allele2}\n")
-                    f.flush()
-
-        data = {"allele1_scores" : allele1_likelihoods, "allele2_scores" : allele2_likelihoods}
-        df = pl.DataFrame(data, schema={"allele1_scores": pl.Float64, "allele2_scores": pl.Float64})
-
-        return df
+        return _scores_df(scores_path, output_file, ["allele1_scores", "allele2_scores"])
 
 
     def score(self, tokens_in, tokens_out, starts, ends, attention_mask, seq):
@@ -169,44 +238,91 @@ class VariantSingleTokenLikelihoodEvaluator(LikelihoodEvaluator):
         tokens_out = tokens_out.to(device=self.device)
         if attention_mask is not None:
             attention_mask = attention_mask.to(device=self.device)
-        lls = self.model_fwd(tokens_in, attention_mask, tokens_out)
-        clip_mask = torch.tensor([[(i >= s) and (i < e) for i in range(lls.shape[1])] for s, e in zip(starts, ends)], 
-                                 dtype=torch.float).to(device=self.device)
-
-        out = (lls * clip_mask).sum(1).numpy(force=True)
+        out = positions_ll(self.model_fwd_at, tokens_in, attention_mask, tokens_out, starts, ends)
 
         return out
 
+    def score_alleles(self, tokens_allele1, starts_allele1, ends_allele1, attention_mask_allele1,
+                      tokens_allele2, starts_allele2, ends_allele2, attention_mask_allele2):
+        """
+        Scores both alleles of each variant with the tokens that differ between them masked. Where the alleles
+        tokenize alike around the variant (same scored range and attention mask), the masked input is the same
+        for both, so one forward pass over those variants is read for the tokens of both alleles. Other variants
+        run a forward pass per allele.
+        """
+        if tokens_allele1.shape != tokens_allele2.shape:
+            raise ValueError(f"Allele token batches differ in shape: {tuple(tokens_allele1.shape)} and {tuple(tokens_allele2.shape)}")
+
+        diffs = tokens_allele1 != tokens_allele2
+        tokens_masked = tokens_allele1.clone()
+        tokens_masked[diffs] = self.mask_token
+
+        starts_allele1, ends_allele1 = torch.as_tensor(starts_allele1), torch.as_tensor(ends_allele1)
+        starts_allele2, ends_allele2 = torch.as_tensor(starts_allele2), torch.as_tensor(ends_allele2)
+        aligned = (starts_allele1 == starts_allele2) & (ends_allele1 == ends_allele2)
+        if attention_mask_allele1 is not None:
+            aligned &= (attention_mask_allele1 == attention_mask_allele2).all(dim=1)
+
+        lls_allele1 = np.zeros(tokens_masked.shape[0], dtype=np.float32)
+        lls_allele2 = np.zeros(tokens_masked.shape[0], dtype=np.float32)
+
+        shared = torch.nonzero(aligned, as_tuple=True)[0]
+        if shared.shape[0] > 0:
+            tokens_in = tokens_masked[shared].to(device=self.device)
+            tokens_out = (tokens_allele1[shared].to(device=self.device), tokens_allele2[shared].to(device=self.device))
+            attention_mask = attention_mask_allele1[shared].to(device=self.device) if attention_mask_allele1 is not None else None
+            rows, cols = scored_positions(starts_allele1[shared], ends_allele1[shared], tokens_in.shape, device=self.device)
+            out_allele1, out_allele2 = self.model_fwd_at(tokens_in, attention_mask, tokens_out, rows, cols)
+            lls_allele1[shared.numpy()] = row_sums(out_allele1, rows, cols, tokens_in.shape)
+            lls_allele2[shared.numpy()] = row_sums(out_allele2, rows, cols, tokens_in.shape)
+
+        split = torch.nonzero(~aligned, as_tuple=True)[0]
+        if split.shape[0] > 0:
+            # Both alleles in one batch of separate forwards
+            tokens_in = tokens_masked[split].repeat(2, 1)
+            tokens_out = torch.cat([tokens_allele1[split], tokens_allele2[split]])
+            starts = torch.cat([starts_allele1[split], starts_allele2[split]])
+            ends = torch.cat([ends_allele1[split], ends_allele2[split]])
+            attention_mask = None
+            if attention_mask_allele1 is not None:
+                attention_mask = torch.cat([attention_mask_allele1[split], attention_mask_allele2[split]])
+            out = self.score(tokens_in, tokens_out, starts, ends, attention_mask, None)
+            lls_allele1[split.numpy()] = out[:split.shape[0]]
+            lls_allele2[split.numpy()] = out[split.shape[0]:]
+
+        return lls_allele1, lls_allele2
 
-class VariantEmbeddingEvaluator(LikelihoodEvaluator):
-    def evaluate(self, dataset, output_file, progress_bar=True):
-        dataloader = DataLoader(dataset, batch_size=self.batch_size, shuffle=False, num_workers=self.num_workers)
-        allele1_embeddings = []
-        allele2_embeddings = []
-        dists = []
 
-        with open(output_file, "a") as f:
+class VariantEmbeddingEvaluator(LikelihoodEvaluator):
+    def evaluate(self, dataset, output_file, progress_bar=True, resume=False):
+        """
+        Distances between the mean embeddings of the alleles of each variant. The embeddings are stored with the
+        distances in the score file next to `output_file` (its name with a ".scores.h5" extension), as the
+        allele1_embeddings and allele2_embeddings columns read in variant order by `read_scores`, so only the
+        current batch is held in memory.
+        """
+        scores_path = _scores_path(output_file)
+        with ScoreWriter(scores_path, chunk_size=self.score_chunk_size, resume=resume) as writer:
+            positions = writer.remaining(len(dataset))
+            subset = BatchedSubset(dataset, positions)
+            dataloader = DataLoader(subset, batch_size=self.batch_size, shuffle=False, num_workers=self.num_workers,
+                                    collate_fn=loader_collate_fn(subset, self, seq_fields=(0, 1)))
+
+            start = 0
             for allele1, allele2 in tqdm(dataloader, disable=(not progress_bar), ncols=120):
                 torch.cuda.empty_cache()
                 tokens_allele1, starts_allele1, ends_allele1, attention_mask_allele1 = self.tokenize(allele1)
                 tokens_allele2, starts_allele2, ends_allele2, attention_mask_allele2 = self.tokenize(allele2)
                 embs_allele1 = self.embed(tokens_allele1, starts_allele1, ends_allele1, attention_mask_allele1, allele1)
                 embs_allele2 = self.embed(tokens_allele2, starts_allele2, ends_allele2, attention_mask_allele2, allele2)
-                for emb_allele1, emb_allele2 in zip(embs_allele1, embs_allele2):
-                    dist = distance.cosine(emb_allele1, emb_allele2)
-                    allele1_embeddings.append(emb_allele1)
-                    allele2_embeddings.append(emb_allele2)
-                    dists.append(dist)
-                    f.write(f"{dist}\n")
-                    f.flush()
-                
-        data = {"cosine_distance": dists}
-        df = pl.DataFrame(data, schema={"cosine_distance": pl.Float64})
-
-        allele1_embeddings = np.stack(allele1_embeddings)
-        allele2_embeddings = np.stack(allele2_embeddings)
-
-        return df, allele1_embeddings, allele2_embeddings
+                cosine_dists, dots, l2_dists = _embedding_distances(embs_allele1, embs_allele2)
+
+                end = start + embs_allele1.shape[0]
+                writer.write(positions[start:end], cosine_distance=cosine_dists, dot_product=dots, l2_distance=l2_dists,
+                             allele1_embeddings=embs_allele1, allele2_embeddings=embs_allele2)
+                start = end
+
+        return _scores_df(scores_path, output_file, ["cosine_distance", "dot_product", "l2_distance"])
     
     def embed(self, tokens, starts, ends, attention_mask, seq):
         tokens = tokens.to(device=self.device)
@@ -235,37 +351,83 @@ class VariantEmbeddingEvaluator(LikelihoodEvaluator):
 
 
 class MaskedZeroShotScore(metaclass=ABCMeta):
+    pll_max_tokens = None # Tokens per forward pass of masked copies, the batch size times its length by default
+    score_mode = "masked" # "unmasked" approximates the pseudo-log-likelihood from one forward pass without masking,
+                          # "sampled" and "adaptive" (per pair) estimate it from a random subset of positions
+    pll_num_samples = 32 # Positions sampled per sequence, per round in the adaptive mode
+    pll_positions_per_copy = 1 # Sampled positions masked together in each copy
+    pll_mask_spacing = 64 # Minimum distance between positions masked in the same copy
+    pll_confidence = 0.95 # Confidence at which the adaptive mode resolves the sign of each pair's difference
+    pll_seed = 0
+
     @property
     @abstractmethod
     def mask_token(self):
         pass
 
-    def score(self, tokens, starts, ends, attention_mask):
+    def score(self, tokens, starts, ends, attention_mask, offsets=None, seq=None):
+        # Offsets and sequences are taken for the probing signature, and are not needed for zero-shot scores
         tokens = tokens.to(device=self.device)
-        attention_mask = attention_mask.to(device=self.device)
-        lls = torch.zeros(tokens.shape[:2], device=self.device)
-        for i in range(tokens.shape[1]):
-            clip_mask = ((i >= starts) & (i < ends)).to(device=self.device)
-            masked_tokens = tokens.clone()
-            masked_tokens[:,i,...] = self.mask_token
-            lls[:,i] = self.model_fwd(masked_tokens, attention_mask, tokens)[:,i] * clip_mask
-
-        out = lls.sum(dim=1).numpy(force=True)
+        if attention_mask is not None:
+            attention_mask = attention_mask.to(device=self.device)
+        if self.score_mode == "masked":
+            out = masked_pll(self.model_fwd_at, tokens, starts, ends, attention_mask, self.mask_token, max_tokens=self.pll_max_tokens)
+        elif self.score_mode == "unmasked":
+            out = positions_ll(self.model_fwd_at, tokens, attention_mask, tokens, starts, ends)
+        elif self.score_mode in ("sampled", "adaptive"):
+            # Unpaired sequences get a fixed number of samples in either mode
+            out, _ = self.score_se(tokens, starts, ends, attention_mask)
+        else:
+            raise ValueError(f"Unknown score mode '{self.score_mode}'")
 
         return out
 
-class CausalZeroShotScore(metaclass=ABCMeta):
-    def score(self, tokens, starts, ends, attention_mask):
+    def _pll_sampler(self, tokens, starts, ends, attention_mask):
+        if getattr(self, "_pll_generator", None) is None:
+            self._pll_generator = torch.Generator().manual_seed(self.pll_seed)
         tokens = tokens.to(device=self.device)
         if attention_mask is not None:
             attention_mask = attention_mask.to(device=self.device)
-        lls = self.model_fwd(tokens, attention_mask, tokens)
-        clip_mask = torch.tensor([[(i >= s) and (i < e) for i in range(lls.shape[1])] for s, e in zip(starts, ends)], 
-                                 dtype=torch.float).to(device=self.device)
 
-        out = (lls * clip_mask).sum(1).numpy(force=True)
+        return SampledPLL(self.model_fwd_at, tokens, starts, ends, attention_mask, self.mask_token,
+                          positions_per_copy=self.pll_positions_per_copy, spacing=self.pll_mask_spacing,
+                          max_tokens=self.pll_max_tokens, generator=self._pll_generator)
+
+    def score_se(self, tokens, starts, ends, attention_mask):
+        sampler = self._pll_sampler(tokens, starts, ends, attention_mask)
+
+        return sampled_pll(sampler, self.pll_num_samples)
+
+    def score_pair_se(self, tokens_a, starts_a, ends_a, attention_mask_a, tokens_b, starts_b, ends_b, attention_mask_b):
+        sampler_a = self._pll_sampler(tokens_a, starts_a, ends_a, attention_mask_a)
+        sampler_b = self._pll_sampler(tokens_b, starts_b, ends_b, attention_mask_b)
+        if self.score_mode == "adaptive":
+            return adaptive_pll_pair(sampler_a, sampler_b, self.pll_num_samples, self.pll_confidence)
+
+        return (*sampled_pll(sampler_a, self.pll_num_samples), *sampled_pll(sampler_b, self.pll_num_samples))
+
+class CausalZeroShotScore(metaclass=ABCMeta):
+    pair_prefix = False # Score sequence pairs together from one pass over their shared prefix, for wrappers with kv_cache
+
+    def score(self, tokens, starts, ends, attention_mask, offsets=None, seq=None):
+        tokens = tokens.to(device=self.device)
+        if attention_mask is not None:
+            attention_mask = attention_mask.to(device=self.device)
+        out = positions_ll(self.model_fwd_at, tokens, attention_mask, tokens, starts, ends)
 
         return out
+
+    def score_pair(self, tokens_a, starts_a, ends_a, attention_mask_a, tokens_b, starts_b, ends_b, attention_mask_b):
+        tokens_a = tokens_a.to(device=self.device)
+        tokens_b = tokens_b.to(device=self.device)
+        if attention_mask_a is not None:
+            attention_mask_a = attention_mask_a.to(device=self.device)
+        if attention_mask_b is not None:
+            attention_mask_b = attention_mask_b.to(device=self.device)
+        out_a, out_b = pair_positions_ll(self.model_fwd_pair_at, tokens_a, attention_mask_a, starts_a, ends_a,
+                                         tokens_b, attention_mask_b, starts_b, ends_b)
+
+        return out_a, out_b
     
 class ProbingScore(metaclass=ABCMeta):
     
@@ -300,23 +462,23 @@ class ProbingScore(metaclass=ABCMeta):
         return probed_outs
 
 class FinetunedScore(metaclass=ABCMeta):
-    def evaluate(self, dataset, output_file, progress_bar=True):
-        dataloader = DataLoader(dataset, batch_size=self.batch_size, shuffle=False, num_workers=self.num_workers)
-        allele1_likelihoods = []
-        allele2_likelihoods = []
+    score_chunk_size = 4096 # Rows per committed part of the score file
+
+    def evaluate(self, dataset, output_file, progress_bar=True, resume=False):
+        scores_path = _scores_path(output_file)
+        with ScoreWriter(scores_path, chunk_size=self.score_chunk_size, resume=resume) as writer:
+            positions = writer.remaining(len(dataset))
+            dataloader = DataLoader(BatchedSubset(dataset, positions), batch_size=self.batch_size, shuffle=False, num_workers=self.num_workers)
 
-        with open(output_file, "a") as f:
+            start = 0
             for allele1, allele2 in tqdm(dataloader, disable=(not progress_bar), ncols=120):
                 lls_allele1 = self.score(None, None, None, None, None, allele1)
                 lls_allele2 =self.score(None, None, None, None, None, allele2)
-                for lhood_allele1, lhood_allele2 in zip(lls_allele1.flatten(), lls_allele2.flatten()):
-                    allele1_likelihoods.append(lhood_allele1)
-                    allele2_likelihoods.append(lhood_allele2)
-                    data = {"allele1_scores" : allele1_likelihoods, "allele2_scores" : allele2_likelihoods}
-                    df = pl.DataFrame(data, schema={"allele1_scores": pl.Float64, "allele2_scores": pl.Float64})
-                    f.write(f"{lhood_allele1}\t{lhood_allele2}\n")
-                    f.flush()
-            return df
+                end = start + len(allele1)
+                writer.write(positions[start:end], allele1_scores=lls_allele1.flatten(), allele2_scores=lls_allele2.flatten())
+                start = end
+
+        return _scores_df(scores_path, output_file, ["allele1_scores", "allele2_scores"])
 
     def score(self, tokens, starts, ends, attention_mask, offsets, seq):
         with torch.no_grad():
@@ -324,6 +486,8 @@ class FinetunedScore(metaclass=ABCMeta):
         return log1p_counts.numpy(force=True)
 
 class DNABERT2Evaluator(LikelihoodEvaluator, MaskedZeroShotScore):
+    lm_head = "cls"
+
     def __init__(self, model_name, batch_size, num_workers, device):
         model_name = f"zhihan1996/{model_name}"
         with NoModule("triton"):
@@ -341,6 +505,8 @@ class DNABERT2Evaluator(LikelihoodEvaluator, MaskedZeroShotScore):
         return 2
 
 class GenaLMEvaluator(LikelihoodEvaluator, MaskedZeroShotScore):
+    lm_head = "cls"
+
     def __init__(self, model_name, batch_size, num_workers, device):
         model_name = f"AIRI-Institute/{model_name}"
         tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
@@ -356,11 +522,16 @@ class GenaLMEvaluator(LikelihoodEvaluator, MaskedZeroShotScore):
         return 2
 
 class HDEvaluator(LikelihoodEvaluator, CausalZeroShotScore):
+    lm_head = "lm_head"
+    causal = True
+    takes_attention_mask = False
+
     def __init__(self, model_name, batch_size, num_workers, device):
         model_name = f"LongSafari/{model_name}"
         tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True, padding_side="right")
         model = AutoModelForCausalLM.from_pretrained(model_name, trust_remote_code=True)
         super().__init__(tokenizer, model, batch_size, num_workers, device)
+        self.tensor_tokenizer = CharTokenizer(tokenizer)
 
     def model_fwd(self, tokens_in, attention_mask, tokens_out):
         with torch.no_grad():
@@ -382,12 +553,17 @@ class HDEvaluator(LikelihoodEvaluator, CausalZeroShotScore):
 
 
 class HDUntrainedEvaluator(LikelihoodEvaluator, CausalZeroShotScore):
+    lm_head = "lm_head"
+    causal = True
+    takes_attention_mask = False
+
     def __init__(self, model_name, batch_size, num_workers, device):
         model_name = f"LongSafari/{model_name}"
         tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True, padding_side="right")
         config = AutoConfig.from_pretrained(model_name, trust_remote_code=True)
         model =  AutoModelForCausalLM.from_config(config, trust_remote_code=True)
         super().__init__(tokenizer, model, batch_size, num_workers, device)
+        self.tensor_tokenizer = CharTokenizer(tokenizer)
 
     def model_fwd(self, tokens_in, attention_mask, tokens_out):
         with torch.no_grad():
@@ -409,6 +585,10 @@ class HDUntrainedEvaluator(LikelihoodEvaluator, CausalZeroShotScore):
 
 
 class MistralEvaluator(LikelihoodEvaluator, CausalZeroShotScore):
+    lm_head = "lm_head"
+    causal = True
+    kv_cache = True
+
     def __init__(self, model_name, batch_size, num_workers, device):
         model_name = f"RaphaelMourad/{model_name}"
         tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
@@ -435,11 +615,15 @@ class MistralEvaluator(LikelihoodEvaluator, CausalZeroShotScore):
         return lls
 
 class CaduceusEvaluator(LikelihoodEvaluator, MaskedZeroShotScore):
+    lm_head = "lm_head"
+    takes_attention_mask = False
+
     def __init__(self, model_name, batch_size, num_workers, device):
         model_name = f"kuleshov-group/{model_name}"
         tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True, padding_side="right")
         model = AutoModelForMaskedLM.from_pretrained(model_name, trust_remote_code=True)
         super().__init__(tokenizer, model, batch_size, num_workers, device)
+        self.tensor_tokenizer = CharTokenizer(tokenizer)
 
     @property
     def start_token(self):
@@ -449,19 +633,6 @@ class CaduceusEvaluator(LikelihoodEvaluator, MaskedZeroShotScore):
     def end_token(self):
         return 1
 
-    def score(self, tokens, starts, ends, attention_mask):
-        tokens = tokens.to(device=self.device)
-        lls = torch.zeros(tokens.shape[:2], device=self.device)
-        for i in range(tokens.shape[1]):
-            clip_mask = ((i >= starts) & (i < ends)).to(device=self.device)
-            masked_tokens = tokens.clone()
-            masked_tokens[:,i,...] = self.mask_token
-            lls[:,i] = self.model_fwd(masked_tokens, attention_mask, tokens)[:,i] * clip_mask
-
-        out = lls.sum(dim=1).numpy(force=True)
-
-        return out
-
     def model_fwd(self, tokens_in, attention_mask, tokens_out):
         with torch.no_grad():
             torch_outs = self.model(
@@ -472,11 +643,14 @@ class CaduceusEvaluator(LikelihoodEvaluator, MaskedZeroShotScore):
         return lls
 
 class NTEvaluator(LikelihoodEvaluator, MaskedZeroShotScore):
+    lm_head = "lm_head"
+
     def __init__(self, model_name, batch_size, num_workers, device):
         model_name = f"InstaDeepAI/{model_name}"
         tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
         model = AutoModelForMaskedLM.from_pretrained(model_name, trust_remote_code=True)
         super().__init__(tokenizer, model, batch_size, num_workers, device)
+        self.tensor_tokenizer = KmerTokenizer(tokenizer)
 
     @property
     def start_token(self):
@@ -488,6 +662,7 @@ class NTEvaluator(LikelihoodEvaluator, MaskedZeroShotScore):
 
     
 class DNABERT2VariantEvaluator(VariantLikelihoodEvaluator):
+    lm_head = "cls"
     _hidden_states = "last"
     def __init__(self, tokenizer, model, batch_size, num_workers, device):
         super().__init__(tokenizer, model, batch_size, num_workers, device)
@@ -500,14 +675,6 @@ class DNABERT2VariantEvaluator(VariantLikelihoodEvaluator):
     def end_token(self):
         return 2
     
-    @staticmethod
-    def _offsets_to_indices(offsets, seqs):
-        gather_idx = np.zeros((seqs.shape[0], seqs.shape[1]), dtype=np.int64)
-        for i, offset in enumerate(offsets):
-            for j, (start, end) in enumerate(offset):
-                gather_idx[i,start:end] = j
-        return gather_idx
-    
 class DNABERT2ZeroShotVariantEvaluator(DNABERT2VariantEvaluator, MaskedZeroShotScore):
     def __init__(self, model_name, batch_size, num_workers, device):
         model_name = f"zhihan1996/{model_name}"
@@ -533,6 +700,7 @@ class DNABERT2ProbingVariantEvaluator(DNABERT2VariantEvaluator, ProbingScore):
         super().__init__(tokenizer, model, batch_size, num_workers, device)
     
 class GenaLMVariantEvaluator(VariantLikelihoodEvaluator):
+    lm_head = "cls"
     _hidden_states = "all"
     def __init__(self, tokenizer, model, batch_size, num_workers, device):
         super().__init__(tokenizer, model, batch_size, num_workers, device)
@@ -545,14 +713,6 @@ class GenaLMVariantEvaluator(VariantLikelihoodEvaluator):
     def end_token(self):
         return 2
     
-    @staticmethod
-    def _offsets_to_indices(offsets, seqs):
-        gather_idx = np.zeros((seqs.shape[0], seqs.shape[1]), dtype=np.int64)
-        for i, offset in enumerate(offsets):
-            for j, (start, end) in enumerate(offset):
-                gather_idx[i,start:end] = j
-        return gather_idx
-    
 class GenaLMZeroShotVariantEvaluator(GenaLMVariantEvaluator, MaskedZeroShotScore):
     def __init__(self, model_name, batch_size, num_workers, device):
         model_name = f"AIRI-Institute/{model_name}"
@@ -574,16 +734,19 @@ class GenaLMProbingVariantEvaluator(GenaLMVariantEvaluator, ProbingScore):
         super().__init__(tokenizer, model, batch_size, num_workers, device)
 
 class HDVariantEvaluator(VariantLikelihoodEvaluator):
+    lm_head = "lm_head"
+    causal = True
     _hidden_states = "all"
+    takes_attention_mask = False
     def __init__(self, model_name, batch_size, num_workers, device):
         model_name = f"LongSafari/{model_name}"
         tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True, padding_side="right")
         model = AutoModelForCausalLM.from_pretrained(model_name, trust_remote_code=True)
         super().__init__(tokenizer, model, batch_size, num_workers, device)
+        self.tensor_tokenizer = CharTokenizer(tokenizer)
 
     def tokenize(self, seqs):
-        seqs_str = onehot_to_chars(seqs)
-        encoded = self.tokenizer(seqs_str, return_tensors="pt", padding=True)
+        encoded = self.tensor_tokenizer(seqs)
         tokens = encoded["input_ids"]
         try:
             attention_mask = encoded["attention_mask"]
@@ -638,6 +801,7 @@ class HDProbingVariantEvaluator(HDVariantEvaluator, ProbingScore):
         return np.array([slice_idx] * seqs.shape[0])
     
 class MistralVariantEvaluator(VariantLikelihoodEvaluator):
+    lm_head = "lm_head"
     _hidden_states = "all"
     def __init__(self, model_name, batch_size, num_workers, device):
         model_name = f"RaphaelMourad/{model_name}"
@@ -652,14 +816,6 @@ class MistralVariantEvaluator(VariantLikelihoodEvaluator):
     @property
     def end_token(self):
         return 2
-
-    @staticmethod
-    def _offsets_to_indices(offsets, seqs):
-        gather_idx = np.zeros((seqs.shape[0], seqs.shape[1]), dtype=np.int64)
-        for i, offset in enumerate(offsets):
-            for j, (start, end) in enumerate(offset):
-                gather_idx[i,start:end] = j
-        return gather_idx
     
 class MistralZeroShotVariantEvaluator(MistralVariantEvaluator, CausalZeroShotScore):
     def __init__(self, model_name, batch_size, num_workers, device):
@@ -675,12 +831,15 @@ class MistralProbingVariantEvaluator(MistralVariantEvaluator, ProbingScore):
         super().__init__(model_name, batch_size, num_workers, device)
 
 class CaduceusVariantEvaluator(VariantLikelihoodEvaluator):
+    lm_head = "lm_head"
     _hidden_states = "all"
+    takes_attention_mask = False
     def __init__(self, model_name, batch_size, num_workers, device):
         model_name = f"kuleshov-group/{model_name}"
         tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True, padding_side="right")
         model = AutoModelForMaskedLM.from_pretrained(model_name, trust_remote_code=True)
         super().__init__(tokenizer, model, batch_size, num_workers, device)
+        self.tensor_tokenizer = CharTokenizer(tokenizer)
 
     @property
     def start_token(self):
@@ -689,14 +848,6 @@ class CaduceusVariantEvaluator(VariantLikelihoodEvaluator):
     @property
     def end_token(self):
         return 1
-
-    @staticmethod
-    def _offsets_to_indices(offsets, seqs):
-        gather_idx = np.zeros((seqs.shape[0], seqs.shape[1]), dtype=np.int64)
-        for i, offset in enumerate(offsets):
-            for j, (start, end) in enumerate(offset):
-                gather_idx[i,start:end] = j
-        return gather_idx
     
 class CaduceusZeroShotVariantEvaluator(CaduceusVariantEvaluator, MaskedZeroShotScore):
     def __init__(self, model_name, batch_size, num_workers, device):
@@ -712,8 +863,7 @@ class CaduceusProbingVariantEvaluator(CaduceusVariantEvaluator, ProbingScore):
         super().__init__(model_name, batch_size, num_workers, device)
 
     def tokenize(self, seqs):
-        seqs_str = onehot_to_chars(seqs)
-        encoded = self.tokenizer.batch_encode_plus(seqs_str, return_tensors="pt", padding=True)
+        encoded = self.tensor_tokenizer(seqs)
         tokens = encoded["input_ids"]
         attention_mask = encoded.get("attention_mask")
         # try:
@@ -731,9 +881,11 @@ class CaduceusProbingVariantEvaluator(CaduceusVariantEvaluator, ProbingScore):
         return tokens, starts, ends, attention_mask, None
 
 class NTVariantEvaluator(VariantLikelihoodEvaluator):
+    lm_head = "lm_head"
     _hidden_states = "all"
     def __init__(self, tokenizer, model, batch_size, num_workers, device):
         super().__init__(tokenizer, model, batch_size, num_workers, device)
+        self.tensor_tokenizer = KmerTokenizer(tokenizer)
 
     @property
     def start_token(self):
@@ -742,35 +894,26 @@ class NTVariantEvaluator(VariantLikelihoodEvaluator):
     @property
     def end_token(self):
         return None
-    
-    @staticmethod
-    def _offsets_to_indices(offsets, seqs):
-        seq_len = seqs.shape[1]
-        inds = np.zeros(seq_len, dtype=np.int64)
-        # seq_len_contig = (seq_len // 6) * 6
-        for i in range(seq_len // 6):
-            inds[i*6:(i+1)*6] = i + 1
-        inds[(i+1)*6:] = np.arange(i+2, i+(seq_len%6)+2)
-        return np.array([inds] * seqs.shape[0])
-    
+
     def tokenize(self, seqs):
-        seqs_str = onehot_to_chars(seqs)
-        encoded = self.tokenizer(seqs_str, return_tensors="pt", padding=True)
+        if isinstance(seqs, TokenBatch):
+            return super().tokenize(seqs)
+
+        # The token index of each base, from the tokenizer pass, is returned in place of the offsets
+        encoded = self.tensor_tokenizer(seqs, return_indices=True)
         tokens = encoded["input_ids"]
-        try:
-            attention_mask = encoded["attention_mask"]
-        except:
-            attention_mask = None
-        if self.start_token is not None:
-            starts = torch.where(tokens == self.start_token)[1] + 1 
-        else:
-            starts = torch.tensor([0]*tokens.shape[0])
-        if self.end_token is not None:
-            ends = torch.where(tokens == self.end_token)[1]
-        else:
-            ends = attention_mask.sum(dim=1) 
-        return tokens, starts, ends, attention_mask, None
-    
+        attention_mask = encoded.get("attention_mask")
+        starts = torch.where(tokens == self.start_token)[1] + 1
+        ends = attention_mask.sum(dim=1)
+
+        return tokens, starts, ends, attention_mask, encoded["indices"]
+
+    @staticmethod
+    def _offsets_to_indices(offsets, seqs):
+        if offsets.ndim == 3:
+            # Offset mappings of token cache rows
+            return VariantLikelihoodEvaluator._offsets_to_indices(offsets, seqs)
+        return offsets.numpy(force=True)
     
 class NTZeroShotVariantEvaluator(NTVariantEvaluator, MaskedZeroShotScore):
     def __init__(self, model_name, batch_size, num_workers, device):
@@ -795,6 +938,8 @@ class NTProbingVariantEvaluator(NTVariantEvaluator, ProbingScore):
 
 # class FinetunedVariantEvaluator(FinetunedScore): 
 class FinetunedVariantEvaluator: 
+    score_chunk_size = 4096 # Rows per committed part of the score file
+
     def __init__(self, model, batch_size, num_workers, device):
         self.model = model
         # super().__init__(None, model, batch_size, num_workers, device)
@@ -803,23 +948,21 @@ class FinetunedVariantEvaluator:
         self.device = device
         self.model.to(self.device)
 
-    def evaluate(self, dataset, output_file, progress_bar=True):
-        dataloader = DataLoader(dataset, batch_size=self.batch_size, shuffle=False, num_workers=self.num_workers)
-        allele1_likelihoods = []
-        allele2_likelihoods = []
+    def evaluate(self, dataset, output_file, progress_bar=True, resume=False):
+        scores_path = _scores_path(output_file)
+        with ScoreWriter(scores_path, chunk_size=self.score_chunk_size, resume=resume) as writer:
+            positions = writer.remaining(len(dataset))
+            dataloader = DataLoader(BatchedSubset(dataset, positions), batch_size=self.batch_size, shuffle=False, num_workers=self.num_workers)
 
-        with open(output_file, "a") as f:
+            start = 0
             for allele1, allele2 in tqdm(dataloader, disable=(not progress_bar), ncols=120):
                 lls_allele1 = self.score(None, None, None, None, None, allele1)
                 lls_allele2 =self.score(None, None, None, None, None, allele2)
-                for lhood_allele1, lhood_allele2 in zip(lls_allele1.flatten(), lls_allele2.flatten()):
-                    allele1_likelihoods.append(lhood_allele1)
-                    allele2_likelihoods.append(lhood_allele2)
-                    data = {"allele1_scores" : allele1_likelihoods, "allele2_scores" : allele2_likelihoods}
-                    df = pl.DataFrame(data, schema={"allele1_scores": pl.Float64, "allele2_scores": pl.Float64})
-                    f.write(f"{lhood_allele1}\t{lhood_allele2}\n")
-                    f.flush()
-            return df
+                end = start + len(allele1)
+                writer.write(positions[start:end], allele1_scores=lls_allele1.flatten(), allele2_scores=lls_allele2.flatten())
+                start = end
+
+        return _scores_df(scores_path, output_file, ["allele1_scores", "allele2_scores"])
 
     def score(self, tokens, starts, ends, attention_mask, offsets, seq):
         with torch.no_grad():
@@ -828,11 +971,16 @@ class FinetunedVariantEvaluator:
 
 
 class HDVariantSingleTokenEvaluator(VariantSingleTokenLikelihoodEvaluator):
+    lm_head = "lm_head"
+    causal = True
+    takes_attention_mask = False
+
     def __init__(self, model_name, batch_size, num_workers, device):
         model_name = f"LongSafari/{model_name}"
         tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True, padding_side="right")
         model = AutoModelForCausalLM.from_pretrained(model_name, trust_remote_code=True)
         super().__init__(tokenizer, model, batch_size, num_workers, device)
+        self.tensor_tokenizer = CharTokenizer(tokenizer)
 
     def model_fwd(self, tokens_in, attention_mask, tokens_out):
         with torch.no_grad():
@@ -854,11 +1002,14 @@ class HDVariantSingleTokenEvaluator(VariantSingleTokenLikelihoodEvaluator):
 
 
 class NTVariantSingleTokenEvaluator(VariantSingleTokenLikelihoodEvaluator):
+    lm_head = "lm_head"
+
     def __init__(self, model_name, batch_size, num_workers, device):
         model_name = f"InstaDeepAI/{model_name}"
         tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
         model = AutoModelForMaskedLM.from_pretrained(model_name, trust_remote_code=True)
         super().__init__(tokenizer, model, batch_size, num_workers, device)
+        self.tensor_tokenizer = KmerTokenizer(tokenizer)
 
     @property
     def start_token(self):
@@ -870,11 +1021,15 @@ class NTVariantSingleTokenEvaluator(VariantSingleTokenLikelihoodEvaluator):
 
 
 class CaduceusVariantSingleTokenEvaluator(VariantSingleTokenLikelihoodEvaluator):
+    lm_head = "lm_head"
+    takes_attention_mask = False
+
     def __init__(self, model_name, batch_size, num_workers, device):
         model_name = f"kuleshov-group/{model_name}"
         tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True, padding_side="right")
         model = AutoModelForMaskedLM.from_pretrained(model_name, trust_remote_code=True)
         super().__init__(tokenizer, model, batch_size, num_workers, device)
+        self.tensor_tokenizer = CharTokenizer(tokenizer)
 
     @property
     def start_token(self):
@@ -901,6 +1056,7 @@ class NTVariantEmbeddingEvaluator(VariantEmbeddingEvaluator):
         tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
         model = AutoModelForMaskedLM.from_pretrained(model_name, trust_remote_code=True)
         super().__init__(tokenizer, model, batch_size, num_workers, device)
+        self.tensor_tokenizer = KmerTokenizer(tokenizer)
 
     @property
     def start_token(self):
@@ -913,12 +1069,14 @@ class NTVariantEmbeddingEvaluator(VariantEmbeddingEvaluator):
 
 class HDVariantEmbeddingEvaluator(VariantEmbeddingEvaluator):
     _hidden_states = "all"
+    takes_attention_mask = False
 
     def __init__(self, model_name, batch_size, num_workers, device):
         model_name = f"LongSafari/{model_name}"
         tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True, padding_side="right")
         model = AutoModelForCausalLM.from_pretrained(model_name, trust_remote_code=True)
         super().__init__(tokenizer, model, batch_size, num_workers, device)
+        self.tensor_tokenizer = CharTokenizer(tokenizer)
 
     def model_fwd(self, tokens_in, attention_mask, tokens_out):
         with torch.no_grad():
@@ -995,12 +1153,14 @@ class MistralVariantEmbeddingEvaluator(VariantEmbeddingEvaluator):
     
 class CaduceusVariantEmbeddingEvaluator(VariantEmbeddingEvaluator):
     _hidden_states = "all"
+    takes_attention_mask = False
     
     def __init__(self, model_name, batch_size, num_workers, device):
         model_name = f"kuleshov-group/{model_name}"
         tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True, padding_side="right")
         model = AutoModel.from_pretrained(model_name, trust_remote_code=True)
         super().__init__(tokenizer, model, batch_size, num_workers, device)
+        self.tensor_tokenizer = CharTokenizer(tokenizer)
 
     @property
     def start_token(self):
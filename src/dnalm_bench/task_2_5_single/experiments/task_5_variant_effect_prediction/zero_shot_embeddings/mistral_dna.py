@@ -1,6 +1,5 @@
 import os
 import sys
-import numpy as np
 import polars as pl
 
 from ....evaluators import MistralVariantEmbeddingEvaluator
@@ -27,19 +26,12 @@ if __name__ == "__main__":
     
     out_path = os.path.join(out_dir, output_prefix + ".tsv")
 
-    allele1_embeddings_path = os.path.join(out_dir, f"{output_prefix}_allele1_embeddings.npy")
-    allele2_embeddings_path = os.path.join(out_dir, f"{output_prefix}_allele2_embeddings.npy")
-
     dataset = VariantDataset(genome_fa, variants_bed, chroms, seed)
     evaluator = MistralVariantEmbeddingEvaluator(model_name, batch_size, num_workers, device)
 
-    score_df, allele1_embeddings, allele2_embeddings = evaluator.evaluate(dataset, out_path, progress_bar=True)
+    score_df = evaluator.evaluate(dataset, out_path, progress_bar=True)
 
     df = dataset.elements_df
     scored_df = pl.concat([df, score_df], how="horizontal")
     print(out_path)
     scored_df.write_csv(out_path, separator="\t")
-
-    # Save embeddings
-    np.save(allele1_embeddings_path, allele1_embeddings)
-    np.save(allele2_embeddings_path, allele2_embeddings)
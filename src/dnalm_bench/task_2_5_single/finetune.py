@@ -1,10 +1,9 @@
 import os
 from abc import ABCMeta, abstractmethod
-import hashlib
-import shutil
 import importlib
 import json
 import warnings
+import bisect
 
 import numpy as np
 import torch
@@ -14,12 +13,18 @@ from transformers import AutoTokenizer, AutoModelForSequenceClassification, Bert
 from tqdm import tqdm
 import polars as pl
 import h5py
-import pyfaidx
 import pyBigWig
 from sklearn.metrics import roc_auc_score, average_precision_score, matthews_corrcoef
 
 from ..finetune import HFClassifierModel, LoRAModule
-from ..utils import onehot_to_chars, one_hot_encode, NoModule, log1mexp
+from ..utils import NoModule, log1mexp
+from ..tokenization import CharTokenizer, KmerTokenizer, loader_collate_fn
+from ..token_cache import SourcedTokenCollate
+from ..batching import loader_batching
+from ..genome import load_genome
+from ..elements import ElementTable
+from ..cache import cached_path, hold_cached
+from .region_counts import load_region_counts
 
 
 class ChromatinEndToEndDataset(Dataset):
@@ -31,44 +36,34 @@ class ChromatinEndToEndDataset(Dataset):
         "elem_end": pl.UInt32,
     }
 
-    def __init__(self, genome_fa, bigwig, elements_tsv, chroms, crop, downsample_ratio=None, cache_dir=None, return_idx_orig=False):
+    def __init__(self, genome_fa, bigwig, elements_tsv, chroms, crop, downsample_ratio=None, cache_dir=None, return_idx_orig=False, counts_only=False, token_cache=None):
         super().__init__()
 
         self.crop = crop
         self.return_idx_orig = return_idx_orig
+        self.counts_only = counts_only
+        self.token_cache = token_cache
 
         self.elements_df_all = self._load_elements(elements_tsv, chroms)
+        self.elements_all = ElementTable(self.elements_df_all)
+
+        # Counts-only mode returns the summed track per region, so the bigwig is never read per item
+        self.region_counts = load_region_counts(elements_tsv, bigwig, crop) if counts_only else None
 
         if cache_dir is not None:
-            os.makedirs(cache_dir, exist_ok=True)
-            
-            bw_path_abs = os.path.abspath(bigwig)
-            bw_path_hash = hashlib.sha256(bw_path_abs.encode('utf-8')).hexdigest()
-            bw_cache_path = os.path.join(cache_dir, bw_path_hash + ".bw")
-            self._copy_if_not_exists(bigwig, bw_cache_path)
-            bigwig = bw_cache_path
-
-            fa_path_abs = os.path.abspath(genome_fa)
-            fa_idx_path_abs = fa_path_abs + ".fai"
-            fa_path_hash = hashlib.sha256(fa_path_abs.encode('utf-8')).hexdigest()
-            fa_cache_path = os.path.join(cache_dir, fa_path_hash + ".fa")
-            fa_idx_cache_path = fa_cache_path + ".fai"
-            self._copy_if_not_exists(genome_fa, fa_cache_path)
-            genome_fa = fa_cache_path
-            try:
-                self._copy_if_not_exists(fa_idx_path_abs, fa_idx_cache_path)
-            except FileNotFoundError:
-                pass
+            if not counts_only:
+                bigwig = cached_path(bigwig, cache_dir)
+            genome_fa = cached_path(genome_fa, cache_dir, companions=(".fai",))
 
         self.genome_fa = genome_fa
-        fa = pyfaidx.Fasta(self.genome_fa) # Build index if needed
-        fa.close()
+        self.genome = load_genome(self.genome_fa)
 
         self.bw = bigwig
 
         self.downsample_ratio = downsample_ratio
         if downsample_ratio is None:
             self.elements_df = self.elements_df_all
+            self.elements = self.elements_all
 
     @classmethod
     def _load_elements(cls, elements_file, chroms):
@@ -81,61 +76,79 @@ class ChromatinEndToEndDataset(Dataset):
 
         return df
 
-    @staticmethod
-    def _copy_if_not_exists(src, dst):
-        try:
-            with open(dst, "xb") as f, open(src, "rb") as sf:
-                shutil.copyfileobj(sf, f)
-        except FileExistsError:
-            pass
-
     def set_epoch(self, epoch):
         if self.downsample_ratio is None:
             return
 
         offset = epoch % self.downsample_ratio
         self.elements_df = self.elements_df_all.take_every(n=self.downsample_ratio, offset=offset)
+        self.elements = self.elements_all.take(np.arange(offset, self.elements_all.height, self.downsample_ratio))
+
+    @property
+    def collate_fn(self):
+        return self.token_cache.collate if self.token_cache is not None else None
+
+    def token_lengths(self):
+        return self.token_cache.lengths(self.elements["index"]) if self.token_cache is not None else None
     
     def __len__(self):
-        return self.elements_df.height
+        return self.elements.height
     
     def __getitem__(self, idx):
-        idx_orig, chrom, start, end, elem_start, elem_end, _, _ = self.elements_df.row(idx)
-
-        seq = np.zeros((end - start, 4), dtype=np.int8)
-
-        fa = pyfaidx.Fasta(self.genome_fa, one_based_attributes=False)
-
-        sequence_data = fa[chrom][max(0, start):end]
-        sequence = sequence_data.seq.upper()
-        start_adj = sequence_data.start
-        end_adj = sequence_data.end
-
-        a = start_adj - start
-        b = end_adj - start
-        seq[a:b,:] = one_hot_encode(sequence)
+        return self.__getitems__([idx])[0]
+
+    def __getitems__(self, indices):
+        indices = np.asarray(indices)
+        chroms = self.elements.chroms(indices)
+        starts = self.elements["input_start"][indices].tolist()
+        ends = self.elements["input_end"][indices].tolist()
+        idxs_orig = self.elements["index"][indices].tolist()
+
+        if self.token_cache is not None:
+            # Token mode: rows of the token cache, padded into a TokenBatch by collate_fn
+            seqs = idxs_orig
+        else:
+            seqs = [torch.from_numpy(seq) for seq in self.genome.fetch_batch(chroms, starts, ends)]
+
+        if self.counts_only:
+            items = []
+            for idx_orig, seq in zip(idxs_orig, seqs):
+                signal = np.array([self.region_counts[idx_orig]], dtype=np.float32)
+
+                if self.return_idx_orig:
+                    items.append((seq, torch.from_numpy(signal), torch.tensor(idx_orig)))
+                else:
+                    items.append((seq, torch.from_numpy(signal)))
+
+            return items
+
+        items = []
+        hold_cached(self.bw)
+        bw = pyBigWig.open(self.bw)
+        for idx_orig, chrom, start, end, seq in zip(idxs_orig, chroms, starts, ends, seqs):
+            start_adj = max(0, start)
+            end_adj = min(end, self.genome.chrom_size(chrom))
 
-        fa.close()
+            out_start = start + self.crop
+            out_end = end - self.crop
+            out_start_adj = max(out_start, start_adj)
+            out_end_adj = min(out_end, end_adj)
 
-        out_start = start + self.crop
-        out_end = end - self.crop
-        out_start_adj = max(out_start, start_adj)
-        out_end_adj = min(out_end, end_adj)
+            c = out_start_adj - out_start
+            d = out_end_adj - out_start
 
-        c = out_start_adj - out_start
-        d = out_end_adj - out_start
+            signal = np.zeros(out_end - out_start, dtype=np.float32)
 
-        signal = np.zeros(out_end - out_start, dtype=np.float32)
+            track = bw.values(chrom, out_start_adj, out_end_adj, numpy=True)
+            signal[c:d] = np.nan_to_num(track)
 
-        bw = pyBigWig.open(self.bw)
-        track = bw.values(chrom, out_start_adj, out_end_adj, numpy=True)
-        signal[c:d] = np.nan_to_num(track)
+            if self.return_idx_orig:
+                items.append((seq, torch.from_numpy(signal), torch.tensor(idx_orig)))
+            else:
+                items.append((seq, torch.from_numpy(signal)))
         bw.close()
 
-        if self.return_idx_orig:
-            return torch.from_numpy(seq), torch.from_numpy(signal), torch.tensor(idx_orig)
-
-        return torch.from_numpy(seq), torch.from_numpy(signal)
+        return items
 
 
 class PeaksEndToEndDataset(Dataset):
@@ -146,32 +159,22 @@ class PeaksEndToEndDataset(Dataset):
         "label": pl.Utf8,
     }
 
-    def __init__(self, genome_fa, elements_tsv, chroms, classes, cache_dir=None, return_idx_orig=False):
+    def __init__(self, genome_fa, elements_tsv, chroms, classes, cache_dir=None, return_idx_orig=False, token_cache=None):
         super().__init__()
 
         self.classes = classes
+        self.token_cache = token_cache
         self.elements_df = self._load_elements(elements_tsv, chroms)
+        self.elements = ElementTable(self.elements_df)
+        self.label_inds = np.array([classes[label] for label in self.elements["label"]], dtype=np.int64)
 
         self.return_idx_orig = return_idx_orig
 
         if cache_dir is not None:
-            os.makedirs(cache_dir, exist_ok=True)
-        
-            fa_path_abs = os.path.abspath(genome_fa)
-            fa_idx_path_abs = fa_path_abs + ".fai"
-            fa_path_hash = hashlib.sha256(fa_path_abs.encode('utf-8')).hexdigest()
-            fa_cache_path = os.path.join(cache_dir, fa_path_hash + ".fa")
-            fa_idx_cache_path = fa_cache_path + ".fai"
-            self._copy_if_not_exists(genome_fa, fa_cache_path)
-            genome_fa = fa_cache_path
-            try:
-                self._copy_if_not_exists(fa_idx_path_abs, fa_idx_cache_path)
-            except FileNotFoundError:
-                pass
+            genome_fa = cached_path(genome_fa, cache_dir, companions=(".fai",))
 
         self.genome_fa = genome_fa
-        fa = pyfaidx.Fasta(self.genome_fa) # Build index if needed
-        fa.close()
+        self.genome = load_genome(self.genome_fa)
 
     @classmethod
     def _load_elements(cls, elements_file, chroms):
@@ -184,42 +187,96 @@ class PeaksEndToEndDataset(Dataset):
 
         return df
 
-    @staticmethod
-    def _copy_if_not_exists(src, dst):
-        try:
-            with open(dst, "xb") as f, open(src, "rb") as sf:
-                shutil.copyfileobj(sf, f)
-        except FileExistsError:
-            pass
-    
+    @property
+    def collate_fn(self):
+        return self.token_cache.collate if self.token_cache is not None else None
+
+    def token_lengths(self):
+        return self.token_cache.lengths(self.elements["index"]) if self.token_cache is not None else None
+
     def __len__(self):
-        return self.elements_df.height
+        return self.elements.height
     
     def __getitem__(self, idx):
-        idx_orig, chrom, start, end, _, _, _, label = self.elements_df.row(idx)
+        return self.__getitems__([idx])[0]
 
-        seq = np.zeros((end - start, 4), dtype=np.int8)
+    def __getitems__(self, indices):
+        indices = np.asarray(indices)
+        idxs_orig = self.elements["index"][indices].tolist()
 
-        fa = pyfaidx.Fasta(self.genome_fa, one_based_attributes=False)
+        if self.token_cache is not None:
+            # Token mode: rows of the token cache, padded into a TokenBatch by collate_fn
+            seqs = idxs_orig
+        else:
+            seqs = self.genome.fetch_batch(self.elements.chroms(indices), self.elements["input_start"][indices].tolist(), 
+                                           self.elements["input_end"][indices].tolist())
+            seqs = [torch.from_numpy(seq) for seq in seqs]
 
-        sequence_data = fa[chrom][max(0, start):end]
-        sequence = sequence_data.seq.upper()
-        start_adj = sequence_data.start
-        end_adj = sequence_data.end
+        items = []
+        for idx_orig, label_ind, seq in zip(idxs_orig, self.label_inds[indices].tolist(), seqs):
+            if self.return_idx_orig:
+                items.append((seq, torch.tensor(label_ind), torch.tensor(idx_orig)))
+            else:
+                items.append((seq, torch.tensor(label_ind)))
 
-        a = start_adj - start
-        b = end_adj - start
+        return items
 
-        seq[a:b,:] = one_hot_encode(sequence)
 
-        fa.close()
+class BatchedConcatDataset(ConcatDataset):
+    def _token_caches(self):
+        caches = [getattr(dataset, "token_cache", None) for dataset in self.datasets]
+        if all(cache is None for cache in caches):
+            return None
+        if any(cache is None for cache in caches):
+            raise ValueError("Datasets in token mode cannot be concatenated with datasets of sequences")
 
-        label_ind = self.classes[label]
+        return caches
 
-        if self.return_idx_orig:
-            return torch.from_numpy(seq), torch.tensor(label_ind), torch.tensor(idx_orig)
+    def _sourced(self):
+        # Items are tagged with their dataset when the parts are rows of different caches
+        caches = self._token_caches()
+        return caches is not None and len({cache.path for cache in caches}) > 1
 
-        return torch.from_numpy(seq), torch.tensor(label_ind)
+    @property
+    def collate_fn(self):
+        caches = self._token_caches()
+        if caches is None:
+            return getattr(self.datasets[0], "collate_fn", None)
+        if self._sourced():
+            return SourcedTokenCollate(caches)
+
+        return caches[0].collate
+
+    def token_lengths(self):
+        lengths = [getattr(dataset, "token_lengths", lambda: None)() for dataset in self.datasets]
+        if any(l is None for l in lengths):
+            return None
+
+        return np.concatenate(lengths)
+
+    # ConcatDataset does not forward __getitems__, so route each index to its part and fetch per part
+    def __getitems__(self, indices):
+        parts = {}
+        for i, idx in enumerate(indices):
+            if idx < 0:
+                idx += len(self)
+            dataset_idx = bisect.bisect_right(self.cumulative_sizes, idx)
+            sample_idx = idx - self.cumulative_sizes[dataset_idx - 1] if dataset_idx > 0 else idx
+            parts.setdefault(dataset_idx, []).append((i, sample_idx))
+
+        sourced = self._sourced()
+        items = [None] * len(indices)
+        for dataset_idx, members in parts.items():
+            dataset = self.datasets[dataset_idx]
+            sample_inds = [sample_idx for _, sample_idx in members]
+            if hasattr(dataset, "__getitems__"):
+                samples = dataset.__getitems__(sample_inds)
+            else:
+                samples = [dataset[sample_idx] for sample_idx in sample_inds]
+            for (i, _), sample in zip(members, samples):
+                items[i] = (dataset_idx, sample) if sourced else sample
+
+        return items
 
 
 def log1pMSELoss(log_predicted_counts, true_counts):
@@ -261,12 +318,12 @@ def counts_spearman(log_preds, targets):
 
 def train_finetuned_chromatin_model(train_pos_dataset, train_neg_dataset, val_pos_dataset, val_neg_dataset, model, 
                                     num_epochs, out_dir, batch_size, lr, wd, accumulate,
-                                    num_workers, prefetch_factor, device, progress_bar=False, resume_from=None, seed=0):
+                                    num_workers, prefetch_factor, device, progress_bar=False, resume_from=None, seed=0, max_tokens=None):
 
-    val_pos_dataloader = DataLoader(val_pos_dataset, batch_size=batch_size, num_workers=num_workers, 
-                                pin_memory=True, prefetch_factor=prefetch_factor, persistent_workers=True)
-    val_neg_dataloader = DataLoader(val_neg_dataset, batch_size=batch_size, num_workers=num_workers,
-                                pin_memory=True, prefetch_factor=prefetch_factor, persistent_workers=True)
+    val_pos_dataloader = DataLoader(val_pos_dataset, **loader_batching(val_pos_dataset, batch_size, max_tokens), num_workers=num_workers, 
+                                pin_memory=True, prefetch_factor=prefetch_factor, persistent_workers=True, collate_fn=loader_collate_fn(val_pos_dataset, model))
+    val_neg_dataloader = DataLoader(val_neg_dataset, **loader_batching(val_neg_dataset, batch_size, max_tokens), num_workers=num_workers,
+                                pin_memory=True, prefetch_factor=prefetch_factor, persistent_workers=True, collate_fn=loader_collate_fn(val_neg_dataset, model))
 
     torch.manual_seed(seed)
 
@@ -301,9 +358,9 @@ def train_finetuned_chromatin_model(train_pos_dataset, train_neg_dataset, val_po
             model.train()
             train_pos_dataset.set_epoch(epoch)
             train_neg_dataset.set_epoch(epoch)
-            train_dataset = ConcatDataset([train_pos_dataset, train_neg_dataset])
-            train_dataloader = DataLoader(train_dataset, batch_size=batch_size, num_workers=num_workers, shuffle=True,
-                                          pin_memory=True, prefetch_factor=prefetch_factor, persistent_workers=True)
+            train_dataset = BatchedConcatDataset([train_pos_dataset, train_neg_dataset])
+            train_dataloader = DataLoader(train_dataset, **loader_batching(train_dataset, batch_size, max_tokens, shuffle=True, seed=(seed + epoch)), num_workers=num_workers,
+                                          pin_memory=True, prefetch_factor=prefetch_factor, persistent_workers=True, collate_fn=loader_collate_fn(train_dataset, model))
             
             optimizer.zero_grad()
             for i, (seq, track) in enumerate(tqdm(train_dataloader, disable=(not progress_bar), desc="train", ncols=120)):
@@ -392,7 +449,7 @@ def train_finetuned_chromatin_model(train_pos_dataset, train_neg_dataset, val_po
 
 
 def evaluate_finetuned_chromatin_model(pos_dataset, idr_dataset, neg_dataset, model, batch_size, out_path,
-                                       num_workers, prefetch_factor, device, progress_bar=False, seed=0):
+                                       num_workers, prefetch_factor, device, progress_bar=False, seed=0, max_tokens=None):
     # val_loss = 0
     # val_counts_pred = []
     # val_counts_true = []
@@ -406,8 +463,8 @@ def evaluate_finetuned_chromatin_model(pos_dataset, idr_dataset, neg_dataset, mo
         test_loss_pos = 0
         test_counts_pred_pos = []
         test_counts_true_pos = []
-        test_pos_dataloader = DataLoader(pos_dataset, batch_size=batch_size, num_workers=num_workers,
-                                         pin_memory=True, prefetch_factor=prefetch_factor)
+        test_pos_dataloader = DataLoader(pos_dataset, **loader_batching(pos_dataset, batch_size, max_tokens), num_workers=num_workers,
+                                         pin_memory=True, prefetch_factor=prefetch_factor, collate_fn=loader_collate_fn(pos_dataset, model))
         for i, (seq, track) in enumerate(tqdm(test_pos_dataloader, disable=(not progress_bar), desc="test_pos", ncols=120)):
             track = track.to(device)
             true_counts = track.sum(dim=1)
@@ -428,8 +485,8 @@ def evaluate_finetuned_chromatin_model(pos_dataset, idr_dataset, neg_dataset, mo
         test_loss_idr = 0
         test_counts_pred_idr = []
         test_counts_true_idr = []
-        test_idr_dataloader = DataLoader(idr_dataset, batch_size=batch_size, num_workers=num_workers,
-                                            pin_memory=True, prefetch_factor=prefetch_factor)
+        test_idr_dataloader = DataLoader(idr_dataset, **loader_batching(idr_dataset, batch_size, max_tokens), num_workers=num_workers,
+                                            pin_memory=True, prefetch_factor=prefetch_factor, collate_fn=loader_collate_fn(idr_dataset, model))
         for i, (seq, track) in enumerate(tqdm(test_idr_dataloader, disable=(not progress_bar), desc="test_idr", ncols=120)):
             track = track.to(device)
             true_counts = track.sum(dim=1)
@@ -450,8 +507,8 @@ def evaluate_finetuned_chromatin_model(pos_dataset, idr_dataset, neg_dataset, mo
         test_loss_neg = 0
         test_counts_pred_neg = []
         test_counts_true_neg = []
-        test_neg_dataloader = DataLoader(neg_dataset, batch_size=batch_size, num_workers=num_workers,
-                                            pin_memory=True, prefetch_factor=prefetch_factor)
+        test_neg_dataloader = DataLoader(neg_dataset, **loader_batching(neg_dataset, batch_size, max_tokens), num_workers=num_workers,
+                                            pin_memory=True, prefetch_factor=prefetch_factor, collate_fn=loader_collate_fn(neg_dataset, model))
         for i, (seq, track) in enumerate(tqdm(test_neg_dataloader, disable=(not progress_bar), desc="test_neg", ncols=120)):
             track = track.to(device)
             true_counts = track.sum(dim=1)
@@ -506,12 +563,12 @@ def evaluate_finetuned_chromatin_model(pos_dataset, idr_dataset, neg_dataset, mo
 
 def train_finetuned_peak_classifier(train_dataset, val_dataset, model, 
                                     num_epochs, out_dir, batch_size, lr, wd, accumulate,
-                                    num_workers, prefetch_factor, device, progress_bar=False, resume_from=None, seed=0):
+                                    num_workers, prefetch_factor, device, progress_bar=False, resume_from=None, seed=0, max_tokens=None):
 
-    train_dataloader = DataLoader(train_dataset, batch_size=batch_size, num_workers=num_workers, 
-                                pin_memory=True, prefetch_factor=prefetch_factor, persistent_workers=True)
-    val_dataloader = DataLoader(val_dataset, batch_size=batch_size, num_workers=num_workers,
-                                pin_memory=True, prefetch_factor=prefetch_factor, persistent_workers=True)
+    train_dataloader = DataLoader(train_dataset, **loader_batching(train_dataset, batch_size, max_tokens), num_workers=num_workers, 
+                                pin_memory=True, prefetch_factor=prefetch_factor, persistent_workers=True, collate_fn=loader_collate_fn(train_dataset, model))
+    val_dataloader = DataLoader(val_dataset, **loader_batching(val_dataset, batch_size, max_tokens), num_workers=num_workers,
+                                pin_memory=True, prefetch_factor=prefetch_factor, persistent_workers=True, collate_fn=loader_collate_fn(val_dataset, model))
 
     torch.manual_seed(seed)
 
@@ -606,10 +663,10 @@ def train_finetuned_peak_classifier(train_dataset, val_dataset, model,
 
 
 def eval_finetuned_peak_classifier(test_dataset, model, out_path, batch_size, 
-                                    num_workers, prefetch_factor, device, progress_bar=False, seed=0):
+                                    num_workers, prefetch_factor, device, progress_bar=False, seed=0, max_tokens=None):
 
-    test_dataloader = DataLoader(test_dataset, batch_size=batch_size, num_workers=num_workers, 
-                                pin_memory=True, prefetch_factor=prefetch_factor, persistent_workers=True)
+    test_dataloader = DataLoader(test_dataset, **loader_batching(test_dataset, batch_size, max_tokens), num_workers=num_workers, 
+                                pin_memory=True, prefetch_factor=prefetch_factor, persistent_workers=True, collate_fn=loader_collate_fn(test_dataset, model))
 
     torch.manual_seed(seed)
 
@@ -717,10 +774,10 @@ class NucleotideTransformerLoRAModel(HFClassifierModel):
         model.esm = LoRAModule(model.esm, lora_rank, lora_alpha, lora_dropout)
 
         super().__init__(tokenizer, model)
+        self.tensor_tokenizer = KmerTokenizer(tokenizer)
 
     def _tokenize(self, seqs):
-        seqs_str = onehot_to_chars(seqs)
-        encoded = self.tokenizer(seqs_str, return_tensors="pt", padding=True)
+        encoded = self.tensor_tokenizer(seqs)
         tokens = encoded["input_ids"]
 
         return tokens.to(self.device), None
@@ -734,10 +791,10 @@ class HyenaDNALoRAModel(HFClassifierModel):
         model.hyena = LoRAModule(model.hyena, lora_rank, lora_alpha, lora_dropout)
 
         super().__init__(tokenizer, model)
+        self.tensor_tokenizer = CharTokenizer(tokenizer)
 
     def _tokenize(self, seqs):
-        seqs_str = onehot_to_chars(seqs)
-        encoded = self.tokenizer(seqs_str, return_tensors="pt", padding=True)
+        encoded = self.tensor_tokenizer(seqs)
         tokens = encoded["input_ids"]
 
         return tokens.to(self.device), None
@@ -759,10 +816,10 @@ class CaduceusLoRAModel(HFClassifierModel):
         model.caduceus = LoRAModule(model.caduceus, lora_rank, lora_alpha, lora_dropout)
 
         super().__init__(tokenizer, model)
+        self.tensor_tokenizer = CharTokenizer(tokenizer)
 
     def _tokenize(self, seqs):
-        seqs_str = onehot_to_chars(seqs)
-        encoded = self.tokenizer(seqs_str, return_tensors="pt", padding=True)
+        encoded = self.tensor_tokenizer(seqs)
         tokens = encoded["input_ids"]
 
         return tokens.to(self.device), None
@@ -20,7 +20,8 @@ import pyBigWig
 from sklearn.metrics import roc_auc_score, average_precision_score, matthews_corrcoef
 
 from ..finetune import HFClassifierModel, LoRAModule
-from ..utils import onehot_to_chars, one_hot_encode, NoModule, log1mexp
+from ..utils import one_hot_encode, NoModule, log1mexp
+from ..tokenization import CharTokenizer, KmerTokenizer
 
 
 
@@ -148,10 +149,10 @@ class NucleotideTransformerModel(HFClassifierModel):
         model = AutoModelForSequenceClassification.from_pretrained(model_name, trust_remote_code=True, num_labels=num_labels)
 
         super().__init__(tokenizer, model)
+        self.tensor_tokenizer = KmerTokenizer(tokenizer)
 
     def _tokenize(self, seqs):
-        seqs_str = onehot_to_chars(seqs)
-        encoded = self.tokenizer(seqs_str, return_tensors="pt", padding=True)
+        encoded = self.tensor_tokenizer(seqs)
         tokens = encoded["input_ids"]
 
         return tokens.to(self.device), None
@@ -164,10 +165,10 @@ class HyenaDNAModel(HFClassifierModel):
         model = AutoModelForSequenceClassification.from_pretrained(model_name, trust_remote_code=True, num_labels=num_labels)
 
         super().__init__(tokenizer, model)
+        self.tensor_tokenizer = CharTokenizer(tokenizer)
 
     def _tokenize(self, seqs):
-        seqs_str = onehot_to_chars(seqs)
-        encoded = self.tokenizer(seqs_str, return_tensors="pt", padding=True)
+        encoded = self.tensor_tokenizer(seqs)
         tokens = encoded["input_ids"]
 
         return tokens.to(self.device), None
@@ -188,10 +189,10 @@ class CaduceusModel(HFClassifierModel):
         model = AutoModelForSequenceClassification.from_pretrained(model_name, trust_remote_code=True, num_labels=num_labels)
 
         super().__init__(tokenizer, model)
+        self.tensor_tokenizer = CharTokenizer(tokenizer)
 
     def _tokenize(self, seqs):
-        seqs_str = onehot_to_chars(seqs)
-        encoded = self.tokenizer(seqs_str, return_tensors="pt", padding=True)
+        encoded = self.tensor_tokenizer(seqs)
         tokens = encoded["input_ids"]
 
         return tokens.to(self.device), None
@@ -0,0 +1,100 @@
+import os
+import argparse
+
+import numpy as np
+import polars as pl
+import pyBigWig
+from tqdm import tqdm
+
+from ..cache import file_fingerprint
+
+_elements_dtypes = {
+    "chr": pl.Utf8,
+    "input_start": pl.UInt32,
+    "input_end": pl.UInt32,
+}
+
+
+def region_counts_path(elements_tsv, bigwig, crop):
+    """
+    Location of the precomputed counts, next to the elements file and keyed by the bigwig contents and crop.
+    """
+    bw_key = file_fingerprint(bigwig)[:16]
+    return f"{elements_tsv}.{bw_key}.crop{crop}.counts.npy"
+
+
+def compute_region_counts(elements_tsv, bigwig, crop, progress_bar=False):
+    """
+    Total signal over [input_start + crop, input_end - crop) for every row of the elements file, clipped to the
+    chromosome. Uses exact bigwig summary queries, so it matches summing the per-base profile with NaNs as 0.
+    """
+    df = pl.read_csv(elements_tsv, separator="\t", quote_char=None, dtypes=_elements_dtypes,
+                     columns=list(_elements_dtypes.keys()))
+    chroms = df.get_column("chr").to_numpy()
+    starts = df.get_column("input_start").to_numpy().astype(np.int64) + crop
+    ends = df.get_column("input_end").to_numpy().astype(np.int64) - crop
+
+    counts = np.zeros(df.height, dtype=np.float64)
+
+    bw = pyBigWig.open(bigwig)
+    chrom_sizes = bw.chroms()
+    order = np.lexsort((starts, chroms))
+    for i in tqdm(order, disable=(not progress_bar), ncols=120):
+        chrom = chroms[i]
+        start = max(starts[i], 0)
+        end = min(ends[i], chrom_sizes[chrom])
+        if end <= start:
+            continue
+
+        total = bw.stats(chrom, int(start), int(end), type="sum", exact=True)[0]
+        if total is not None:
+            counts[i] = total
+    bw.close()
+
+    return counts
+
+
+def _save_counts(counts_path, counts):
+    tmp_path = f"{counts_path}.tmp{os.getpid()}.npy"
+    np.save(tmp_path, counts)
+    os.replace(tmp_path, counts_path)
+
+
+def load_region_counts(elements_tsv, bigwig, crop):
+    """
+    Loads the per-region counts for this elements file, bigwig and crop, computing and saving them on first use.
+    Counts are indexed by row of the full elements file.
+    """
+    counts_path = region_counts_path(elements_tsv, bigwig, crop)
+    try:
+        return np.load(counts_path)
+    except FileNotFoundError:
+        pass
+
+    counts = compute_region_counts(elements_tsv, bigwig, crop)
+
+    _save_counts(counts_path, counts)
+
+    return counts
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Precomputes per-region total counts of a bigwig over an elements file")
+    parser.add_argument("--elements_tsv", type=str, required=True, help="Elements file with chr, input_start and input_end columns")
+    parser.add_argument("--bigwig", type=str, required=True, help="Signal bigwig")
+    parser.add_argument("--crop", type=int, default=557, help="Bases cropped from each side of the input window")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    counts_path = region_counts_path(args.elements_tsv, args.bigwig, args.crop)
+    counts = compute_region_counts(args.elements_tsv, args.bigwig, args.crop, progress_bar=True)
+
+    _save_counts(counts_path, counts)
+
+    print(f"Wrote counts for {len(counts)} regions to {counts_path}")
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,6 @@
 import os
 import math
 import heapq
-import hashlib
 import warnings
 import json
 
@@ -17,7 +16,10 @@ from ncls import NCLS
 from sklearn.metrics import roc_auc_score, average_precision_score, matthews_corrcoef
 from tqdm import tqdm
 
-from ..utils import copy_if_not_exists, log1mexp
+from ..utils import log1mexp
+from ..cache import cached_path, hold_cached
+from ..elements import ElementTable
+from .region_counts import load_region_counts
 
 class AssayEmbeddingsDataset(IterableDataset):
     _elements_dtypes = {
@@ -30,30 +32,25 @@ class AssayEmbeddingsDataset(IterableDataset):
         "elem_relative_end": pl.UInt32
     }
 
-    def __init__(self, embeddings_h5, elements_tsv, chroms, assay_bw, bounds=None, crop=0, downsample_ratio=1, cache_dir=None):
+    def __init__(self, embeddings_h5, elements_tsv, chroms, assay_bw, bounds=None, crop=0, downsample_ratio=1, cache_dir=None, counts_only=False):
         super().__init__()
 
         self.elements_df_all = self._load_elements(elements_tsv, chroms)
+        self.elements_all = ElementTable(self.elements_df_all)
         self.embeddings_h5 = embeddings_h5
         self.assay_bw = assay_bw
         self.bounds = bounds
         self.crop = crop
         self.downsample_ratio = downsample_ratio
+        self.counts_only = counts_only
 
-        if cache_dir is not None:
-            os.makedirs(cache_dir, exist_ok=True)
-
-            embeddings_h5_abs = os.path.abspath(embeddings_h5)
-            embeddings_h5_hash = hashlib.sha256(embeddings_h5_abs.encode('utf-8')).hexdigest()
-            embeddings_h5_cache_path = os.path.join(cache_dir, embeddings_h5_hash + ".h5")
-            copy_if_not_exists(embeddings_h5, embeddings_h5_cache_path)
-            self.embeddings_h5 = embeddings_h5_cache_path
+        # Counts-only mode yields the summed track per region, so the bigwig is never read per item
+        self.region_counts = load_region_counts(elements_tsv, assay_bw, crop) if counts_only else None
 
-            bw_path_abs = os.path.abspath(assay_bw)
-            bw_path_hash = hashlib.sha256(bw_path_abs.encode('utf-8')).hexdigest()
-            bw_cache_path = os.path.join(cache_dir, bw_path_hash + ".bw")
-            copy_if_not_exists(assay_bw, bw_cache_path)
-            self.assay_bw = bw_cache_path
+        if cache_dir is not None:
+            self.embeddings_h5 = cached_path(embeddings_h5, cache_dir)
+            if not counts_only:
+                self.assay_bw = cached_path(assay_bw, cache_dir)
 
         self.next_epoch = 0
         self._set_epoch()
@@ -80,10 +77,11 @@ class AssayEmbeddingsDataset(IterableDataset):
         end = segment_boundaries[segment + 1]
 
         self.elements_df = self.elements_df_all.slice(start, end - start)
+        self.elements = self.elements_all.slice(start, end - start)
         self.next_epoch += 1
 
     def __len__(self):
-        return self.elements_df.height
+        return self.elements.height
 
     def __iter__(self):
         worker_info = get_worker_info()
@@ -97,14 +95,19 @@ class AssayEmbeddingsDataset(IterableDataset):
             start = worker_info.id * per_worker
             end = min(start + per_worker, len(self))
 
-        df_sub = self.elements_df.slice(start, end - start)
-        valid_inds = df_sub.get_column('region_idx').to_numpy().astype(np.int32)
-        region_idx_to_row = {v: i for i, v in enumerate(valid_inds)}
+        elements_sub = self.elements.slice(start, end - start)
+        valid_inds = elements_sub["region_idx"]
         query_struct = NCLS(valid_inds, valid_inds + 1, valid_inds)
+        chroms_sub = elements_sub.chroms()
+        starts_sub = elements_sub["input_start"].tolist()
+        ends_sub = elements_sub["input_end"].tolist()
 
-        bw = pyBigWig.open(self.assay_bw)
+        if not self.counts_only:
+            hold_cached(self.assay_bw)
+        bw = None if self.counts_only else pyBigWig.open(self.assay_bw)
 
         chunk_start = 0
+        hold_cached(self.embeddings_h5)
         with h5py.File(self.embeddings_h5) as h5:
             chunk_ranges = []
             for name in h5["seq"].keys():
@@ -139,15 +142,21 @@ class AssayEmbeddingsDataset(IterableDataset):
 
                     seq_emb = seq_chunk[i_rel]
 
-                    _, chrom, region_start, region_end, _, _, _, _ = self.elements_df.row(region_idx_to_row[i])
+                    if self.counts_only:
+                        track = np.array([self.region_counts[i]], dtype=np.float32)
+                        yield torch.from_numpy(seq_emb), torch.from_numpy(seq_inds), torch.from_numpy(track)
+                        continue
 
-                    track = np.nan_to_num(bw.values(chrom, region_start, region_end, numpy=True))
+                    # region_idx increases with row order, so the row is found by binary search
+                    row = np.searchsorted(valid_inds, i)
+                    track = np.nan_to_num(bw.values(chroms_sub[row], starts_sub[row], ends_sub[row], numpy=True))
                     if self.crop > 0:
                         track = track[self.crop:-self.crop]
 
                     yield torch.from_numpy(seq_emb), torch.from_numpy(seq_inds), torch.from_numpy(track)
 
-        bw.close()
+        if bw is not None:
+            bw.close()
         self._set_epoch()
 
 
@@ -206,17 +215,13 @@ class PeaksEmbeddingsDataset(IterableDataset):
 
         self.classes = classes
         self.elements_df = self._load_elements(elements_tsv, chroms)
+        self.elements = ElementTable(self.elements_df)
+        self.label_inds = np.array([classes[label] for label in self.elements["label"]], dtype=np.int64)
         self.embeddings_h5 = embeddings_h5
         self.bounds = bounds
 
         if cache_dir is not None:
-            os.makedirs(cache_dir, exist_ok=True)
-
-            embeddings_h5_abs = os.path.abspath(embeddings_h5)
-            embeddings_h5_hash = hashlib.sha256(embeddings_h5_abs.encode('utf-8')).hexdigest()
-            embeddings_h5_cache_path = os.path.join(cache_dir, embeddings_h5_hash + ".h5")
-            copy_if_not_exists(embeddings_h5, embeddings_h5_cache_path)
-            self.embeddings_h5 = embeddings_h5_cache_path
+            self.embeddings_h5 = cached_path(embeddings_h5, cache_dir)
 
     @classmethod
     def _load_elements(cls, elements_file, chroms):
@@ -233,7 +238,7 @@ class PeaksEmbeddingsDataset(IterableDataset):
         return df
 
     def __len__(self):
-        return self.elements_df.height
+        return self.elements.height
 
     def __iter__(self):
         worker_info = get_worker_info()
@@ -247,12 +252,12 @@ class PeaksEmbeddingsDataset(IterableDataset):
             start = worker_info.id * per_worker
             end = min(start + per_worker, len(self))
 
-        df_sub = self.elements_df.slice(start, end - start)
-        valid_inds = df_sub.get_column('region_idx').to_numpy().astype(np.int32)
-        region_idx_to_row = {v: i for i, v in enumerate(valid_inds)}
+        valid_inds = self.elements["region_idx"][start:end]
+        label_inds_sub = self.label_inds[start:end]
         query_struct = NCLS(valid_inds, valid_inds + 1, valid_inds)
 
         chunk_start = 0
+        hold_cached(self.embeddings_h5)
         with h5py.File(self.embeddings_h5) as h5:
             chunk_ranges = []
             for name in h5["seq"].keys():
@@ -287,8 +292,8 @@ class PeaksEmbeddingsDataset(IterableDataset):
 
                     seq_emb = seq_chunk[i_rel]
 
-                    _, chrom, start, end, _, _, _, label = self.elements_df.row(region_idx_to_row[i])
-                    label_ind = self.classes[label]
+                    # region_idx increases with row order, so the row is found by binary search
+                    label_ind = label_inds_sub[np.searchsorted(valid_inds, i)]
 
                     yield torch.from_numpy(seq_emb), torch.from_numpy(seq_inds), torch.tensor(label_ind)
 
@@ -10,6 +10,7 @@ from tqdm import tqdm
 
 from ..components import SimpleSequence
 from ...utils import onehot_to_chars
+from ..tokenization import CharTokenizer, KmerTokenizer
 
 class MaskedZeroShotScore(metaclass=ABCMeta):
     @property
@@ -46,6 +47,8 @@ class CausalZeroShotScore(metaclass=ABCMeta):
 
 
 class LogitExtractor(metaclass=ABCMeta):
+    tensor_tokenizer = None
+
     def __init__(self, tokenizer, model, genome_fa, elements_tsv, chroms, batch_size, num_workers, seed, device):
         self.dataset = SimpleSequence(genome_fa, elements_tsv, chroms, seed)
         self.dataloader = DataLoader(self.dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
@@ -71,8 +74,11 @@ class LogitExtractor(metaclass=ABCMeta):
         return self.tokenizer.mask_token_id
 
     def tokenize(self, seqs):
-        seqs_str = onehot_to_chars(seqs)
-        encoded = self.tokenizer.batch_encode_plus(seqs_str, return_tensors="pt", padding=True)
+        if self.tensor_tokenizer is not None:
+            encoded = self.tensor_tokenizer(seqs)
+        else:
+            seqs_str = onehot_to_chars(seqs)
+            encoded = self.tokenizer.batch_encode_plus(seqs_str, return_tensors="pt", padding=True)
         tokens = encoded["input_ids"]
         attention_mask = encoded["attention_mask"]
         if self.start_token is not None:
@@ -137,6 +143,7 @@ class HDEvaluator(LogitExtractor, CausalZeroShotScore):
         tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True, padding_side="right")
         model = AutoModelForCausalLM.from_pretrained(model_name, trust_remote_code=True)
         super().__init__(tokenizer, model, genome_fa, elements_tsv, chroms, batch_size, num_workers, seed, device)
+        self.tensor_tokenizer = CharTokenizer(tokenizer)
 
     @property
     def start_token(self):
@@ -170,6 +177,7 @@ class NTEvaluator(LogitExtractor, MaskedZeroShotScore):
         tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
         model = AutoModelForMaskedLM.from_pretrained(model_name, trust_remote_code=True)
         super().__init__(tokenizer, model, genome_fa, elements_tsv, chroms, batch_size, num_workers, seed, device)
+        self.tensor_tokenizer = KmerTokenizer(tokenizer)
 
     @property
     def start_token(self):
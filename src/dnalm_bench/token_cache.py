@@ -0,0 +1,338 @@
+import os
+import json
+import shutil
+import hashlib
+import argparse
+
+import numpy as np
+import polars as pl
+import torch
+from torch.utils.data import default_collate
+from transformers import AutoTokenizer
+from tqdm import tqdm
+
+from .cache import file_fingerprint, _Lock
+from .genome import load_genome
+from .utils import onehot_to_chars
+
+_elements_dtypes = {
+    "chr": pl.Utf8,
+    "input_start": pl.UInt32,
+    "input_end": pl.UInt32,
+}
+
+_META_NAME = "meta.json"
+
+
+def tokenizer_fingerprint(tokenizer):
+    """
+    Content key for a tokenizer: the full serialized pipeline for fast tokenizers, or the vocabulary otherwise,
+    along with the special token and padding settings.
+    """
+    h = hashlib.sha256(type(tokenizer).__name__.encode("utf-8"))
+    if getattr(tokenizer, "is_fast", False):
+        h.update(tokenizer.backend_tokenizer.to_str().encode("utf-8"))
+    else:
+        h.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode("utf-8"))
+    settings = [tokenizer.all_special_ids, tokenizer.pad_token_id, tokenizer.padding_side]
+    h.update(json.dumps(settings).encode("utf-8"))
+
+    return h.hexdigest()[:32]
+
+
+def _genome_fingerprint(genome_path):
+    if not os.path.isdir(genome_path):
+        return file_fingerprint(genome_path)
+
+    # Compiled genomes are directories of per-chromosome arrays and an index
+    h = hashlib.sha256()
+    for name in sorted(os.listdir(genome_path)):
+        path = os.path.join(genome_path, name)
+        if os.path.isfile(path):
+            h.update(f"{name}:{file_fingerprint(path)}".encode("utf-8"))
+
+    return h.hexdigest()[:32]
+
+
+def token_cache_path(cache_dir, tokenizer, genome_fa, elements_tsv):
+    """
+    Location of the cached tokenization of an elements file, keyed by the tokenizer, genome and elements contents.
+    """
+    key = hashlib.sha256(":".join([
+        tokenizer_fingerprint(tokenizer),
+        _genome_fingerprint(genome_fa),
+        file_fingerprint(elements_tsv),
+    ]).encode("utf-8")).hexdigest()[:32]
+
+    return os.path.join(cache_dir, f"tokens-{key}")
+
+
+class TokenBatch:
+    """
+    Padded tokenization of a batch of sequences, used in place of the (B, L, 4) one-hot batch by models and
+    evaluators that accept pretokenized input. `shape` and `len` describe the sequences it stands for. The
+    attention mask and offsets are None when the tokenizer does not return them.
+    """
+    def __init__(self, input_ids, attention_mask, offsets=None, seq_len=0):
+        self.input_ids = input_ids
+        self.attention_mask = attention_mask
+        self.offsets = offsets
+        self.seq_len = seq_len
+
+    def __len__(self):
+        return self.input_ids.shape[0]
+
+    @property
+    def shape(self):
+        return (self.input_ids.shape[0], self.seq_len)
+
+    def _map(self, fn):
+        tensors = [x if x is None else fn(x) for x in (self.input_ids, self.attention_mask, self.offsets)]
+        return TokenBatch(*tensors, self.seq_len)
+
+    def __getitem__(self, idx):
+        return self._map(lambda x: x[idx])
+
+    def to(self, device):
+        return self._map(lambda x: x.to(device))
+
+    def pin_memory(self):
+        return self._map(lambda x: x.pin_memory())
+
+    def as_encoded(self):
+        """
+        The batch as the dict returned by the HF tokenizer with `return_tensors="pt"` and `padding=True`.
+        """
+        encoded = {"input_ids": self.input_ids}
+        if self.attention_mask is not None:
+            encoded["attention_mask"] = self.attention_mask
+        if self.offsets is not None:
+            encoded["offset_mapping"] = self.offsets
+
+        return encoded
+
+
+class TokenCache:
+    """
+    Tokenization of every row of an elements file, stored ragged on disk: flat token ids (and offset mappings
+    for fast tokenizers) with per-row splits. Rows are indexed by their position in the elements file, so one
+    cache serves all chromosome splits and epochs. Rows are stored unpadded, so attention masks are rebuilt
+    from the row lengths when batches are padded. Arrays are memory-mapped on first use in each process.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, _META_NAME)) as f:
+            meta = json.load(f)
+
+        self.num_rows = meta["num_rows"]
+        self.seq_len = meta["seq_len"]
+        self.pad_id = meta["pad_id"]
+        self.padding_side = meta["padding_side"]
+        self.has_offsets = meta["offsets"]
+
+        self._arrays = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_arrays"] = None # Reopened lazily in workers instead of pickling the mapped arrays
+        return state
+
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            names = ["input_ids", "row_splits"] + (["offset_mapping"] if self.has_offsets else [])
+            self._arrays = {name: np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode="r") for name in names}
+
+        return self._arrays
+
+    def __len__(self):
+        return self.num_rows
+
+    def lengths(self, rows=None):
+        """
+        Token counts of the given rows (all rows by default), including special tokens.
+        """
+        splits = self.arrays["row_splits"]
+        if rows is None:
+            return np.diff(splits)
+
+        rows = np.asarray(rows, dtype=np.int64)
+        return splits[rows + 1] - splits[rows]
+
+    def batch(self, rows):
+        """
+        Pads the given rows into a TokenBatch, matching the HF tokenizer's padding side and pad id.
+        """
+        return batch_from_caches([self], np.zeros(len(rows), dtype=np.int64), rows)
+
+    def collate(self, items):
+        """
+        DataLoader collate function for datasets in token mode, which return cache rows in place of sequences.
+        """
+        if not isinstance(items[0], tuple):
+            return self.batch(items)
+
+        rows = [item[0] for item in items]
+        rest = default_collate([item[1:] for item in items])
+
+        return (self.batch(rows), *rest)
+
+
+def batch_from_caches(caches, sources, rows):
+    """
+    Pads rows drawn from several caches, row `rows[i]` of `caches[sources[i]]`, into one TokenBatch. The caches
+    must share their pad id, padding side and offsets.
+    """
+    first = caches[0]
+    for cache in caches[1:]:
+        if (cache.pad_id, cache.padding_side, cache.has_offsets) != (first.pad_id, first.padding_side, first.has_offsets):
+            raise ValueError(f"Token caches {first.path} and {cache.path} differ in padding or offsets")
+
+    sources = np.asarray(sources, dtype=np.int64)
+    rows = np.asarray(rows, dtype=np.int64)
+    starts = np.zeros(len(rows), dtype=np.int64)
+    lengths = np.zeros(len(rows), dtype=np.int64)
+    for source, cache in enumerate(caches):
+        sel = sources == source
+        splits = cache.arrays["row_splits"]
+        starts[sel] = splits[rows[sel]]
+        lengths[sel] = splits[rows[sel] + 1] - starts[sel]
+    width = int(lengths.max()) if len(rows) > 0 else 0
+
+    pad = width - lengths if first.padding_side == "left" else np.zeros_like(lengths)
+    cols = np.arange(width)[None,:] - pad[:,None]
+    mask = (cols >= 0) & (cols < lengths[:,None])
+
+    input_ids = np.full((len(rows), width), first.pad_id, dtype=np.int64)
+    offsets = np.zeros((len(rows), width, 2), dtype=np.int64) if first.has_offsets else None
+    for source, cache in enumerate(caches):
+        sel = np.flatnonzero(sources == source)
+        if len(sel) == 0:
+            continue
+        sel_mask = mask[sel]
+        src = (starts[sel,None] + cols[sel])[sel_mask]
+
+        sel_ids = input_ids[sel]
+        sel_ids[sel_mask] = cache.arrays["input_ids"][src]
+        input_ids[sel] = sel_ids
+        if offsets is not None:
+            sel_offsets = offsets[sel]
+            sel_offsets[sel_mask] = cache.arrays["offset_mapping"][src]
+            offsets[sel] = sel_offsets
+
+    if offsets is not None:
+        offsets = torch.from_numpy(offsets)
+    seq_len = max(cache.seq_len for cache in caches)
+
+    return TokenBatch(torch.from_numpy(input_ids), torch.from_numpy(mask.astype(np.int64)), offsets, seq_len)
+
+
+class SourcedTokenCollate:
+    """
+    Collate function for items tagged (source, item) by a concatenation of token mode datasets with different
+    caches, padding the rows of each item from the cache of its source.
+    """
+    def __init__(self, caches):
+        self.caches = caches
+
+    def __call__(self, items):
+        sources = [source for source, _ in items]
+        items = [item for _, item in items]
+        if not isinstance(items[0], tuple):
+            return batch_from_caches(self.caches, sources, items)
+
+        rows = [item[0] for item in items]
+        rest = default_collate([item[1:] for item in items])
+
+        return (batch_from_caches(self.caches, sources, rows), *rest)
+
+
+def build_token_cache(path, tokenizer, genome_fa, elements_tsv, batch_size=1024, progress_bar=False):
+    """
+    Tokenizes every row of the elements file, using the same sequence strings as tokenizing one-hot batches,
+    and writes the cache through a temporary directory and an atomic rename.
+    """
+    df = pl.read_csv(elements_tsv, separator="\t", quote_char=None, dtypes=_elements_dtypes,
+                     columns=list(_elements_dtypes.keys()))
+    chroms = df.get_column("chr").to_list()
+    starts = df.get_column("input_start").to_list()
+    ends = df.get_column("input_end").to_list()
+
+    genome = load_genome(genome_fa)
+    has_offsets = bool(getattr(tokenizer, "is_fast", False))
+
+    input_ids = []
+    offsets = []
+    lengths = []
+    for i in tqdm(range(0, df.height, batch_size), disable=(not progress_bar), ncols=120):
+        seqs = genome.fetch_batch(chroms[i:i + batch_size], starts[i:i + batch_size], ends[i:i + batch_size])
+        encoded = tokenizer(onehot_to_chars(seqs), return_offsets_mapping=has_offsets)
+        for j, ids in enumerate(encoded["input_ids"]):
+            input_ids.append(np.asarray(ids, dtype=np.int32))
+            lengths.append(len(ids))
+            if has_offsets:
+                offsets.append(np.asarray(encoded["offset_mapping"][j], dtype=np.int32).reshape(-1, 2))
+
+    row_splits = np.zeros(df.height + 1, dtype=np.int64)
+    np.cumsum(lengths, out=row_splits[1:])
+
+    meta = {
+        "tokenizer": getattr(tokenizer, "name_or_path", ""),
+        "num_rows": df.height,
+        "seq_len": (ends[0] - starts[0]) if df.height > 0 else 0,
+        "pad_id": tokenizer.pad_token_id,
+        "padding_side": tokenizer.padding_side,
+        "offsets": has_offsets,
+    }
+
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    try:
+        np.save(os.path.join(tmp_path, "input_ids.npy"), np.concatenate(input_ids) if input_ids else np.zeros(0, dtype=np.int32))
+        np.save(os.path.join(tmp_path, "row_splits.npy"), row_splits)
+        if has_offsets:
+            np.save(os.path.join(tmp_path, "offset_mapping.npy"), np.concatenate(offsets) if offsets else np.zeros((0, 2), dtype=np.int32))
+        with open(os.path.join(tmp_path, _META_NAME), "w") as f:
+            json.dump(meta, f, indent=4)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+
+
+def load_token_cache(cache_dir, tokenizer, genome_fa, elements_tsv, batch_size=1024, progress_bar=False):
+    """
+    Loads the token cache for this tokenizer, genome and elements file, building it on first use. Concurrent
+    jobs wait for a single build through a lock file in the cache directory.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = token_cache_path(cache_dir, tokenizer, genome_fa, elements_tsv)
+
+    with _Lock(f"{path}.lock"):
+        if not os.path.exists(path):
+            build_token_cache(path, tokenizer, genome_fa, elements_tsv, batch_size=batch_size, progress_bar=progress_bar)
+
+    return TokenCache(path)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Pretokenizes the sequences of an elements file into a token cache")
+    parser.add_argument("--tokenizer", type=str, required=True, help="HF tokenizer name or path")
+    parser.add_argument("--genome_fa", type=str, required=True, help="Genome fasta or compiled genome directory")
+    parser.add_argument("--elements_tsv", type=str, required=True, help="Elements file with chr, input_start and input_end columns")
+    parser.add_argument("--cache_dir", type=str, required=True, help="Token cache directory")
+    parser.add_argument("--batch_size", type=int, default=1024)
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer, trust_remote_code=True)
+    cache = load_token_cache(args.cache_dir, tokenizer, args.genome_fa, args.elements_tsv, batch_size=args.batch_size,
+                             progress_bar=True)
+
+    print(f"Token cache for {len(cache)} regions at {cache.path}")
+
+if __name__ == "__main__":
+    main()
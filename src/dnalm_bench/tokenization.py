@@ -0,0 +1,253 @@
+import os
+import itertools
+
+import numpy as np
+import torch
+from torch.utils.data import default_collate
+
+from .utils import onehot_to_chars
+from .token_cache import TokenBatch
+
+_BASES = "ACGTN" # Indexed by the token ids of encoding.py
+_N = 4
+
+
+def _token_codes(seqs):
+    """
+    Token ids (0-4, as in encoding.py) for a (B, L, 4) one-hot batch or a (B, L) uint8 token batch.
+    """
+    if isinstance(seqs, np.ndarray):
+        seqs = torch.from_numpy(seqs)
+    if seqs.ndim == 3:
+        # Same as onehot_to_chars: first maximal channel, so all-zero (N) positions read as A
+        return seqs.argmax(dim=2)
+
+    return seqs.long()
+
+
+class CharTokenizer:
+    """
+    Tensor-native tokenizer for character-level vocabularies (HyenaDNA, Caduceus). The base and special token ids
+    are read from the HF tokenizer once, and batches are mapped to input ids with a lookup table gather instead
+    of building Python strings. Construction checks the output against the HF tokenizer on a probe batch.
+    """
+    _probe = "ACGTNNTGCAAC"
+
+    def __init__(self, tokenizer):
+        base_ids = []
+        for c in _BASES:
+            ids = tokenizer(c, add_special_tokens=False)["input_ids"]
+            if len(ids) != 1:
+                raise ValueError(f"{type(tokenizer).__name__} has no single token for '{c}': got {ids}")
+            base_ids.extend(ids)
+        self.lut = torch.tensor(base_ids, dtype=torch.long)
+
+        # Special tokens are whatever the tokenizer adds around a single base
+        ids = tokenizer("A")["input_ids"]
+        a = ids.index(base_ids[0])
+        self.prefix = torch.tensor(ids[:a], dtype=torch.long)
+        self.suffix = torch.tensor(ids[a + 1:], dtype=torch.long)
+
+        self.pad_id = tokenizer.pad_token_id
+        self.padding_side = tokenizer.padding_side
+        self.return_attention_mask = "attention_mask" in tokenizer.model_input_names
+
+        self._check(tokenizer)
+
+    def _check(self, tokenizer):
+        probes = [self._probe, self._probe[:-4]]
+        expected = tokenizer(probes, padding=True, return_tensors="pt")
+        codes = torch.tensor([[_BASES.index(c) for c in self._probe]] * 2, dtype=torch.uint8)
+        encoded = self(codes, lengths=torch.tensor([len(p) for p in probes]))
+        for k, v in encoded.items():
+            if not torch.equal(v, expected[k]):
+                raise ValueError(f"Fast tokenization does not match {type(tokenizer).__name__} for '{k}'")
+
+    def _encode_tokens(self, codes, lengths):
+        """
+        Maps (B, L) base codes to (B, T) token ids without special tokens. Also returns the number of tokens per
+        sequence and the (B, L) index of the token covering each base.
+        """
+        token_idx = torch.arange(codes.shape[1]).expand(codes.shape[0], -1)
+        return self.lut[codes], lengths, token_idx
+
+    def __call__(self, seqs, lengths=None, return_indices=False):
+        """
+        Encodes a (B, L, 4) one-hot or (B, L) token batch, like calling the HF tokenizer on the sequence strings
+        with padding=True. `lengths` gives per-sequence lengths for padded batches; positions past them are dropped.
+        With `return_indices`, "indices" maps each base to the position of its token in "input_ids".
+        """
+        codes = _token_codes(seqs)
+        batch_size, seq_len = codes.shape
+        if lengths is None:
+            lengths = torch.full((batch_size,), seq_len, dtype=torch.long)
+        else:
+            lengths = torch.as_tensor(lengths, dtype=torch.long)
+
+        token_ids, num_tokens, token_idx = self._encode_tokens(codes, lengths)
+
+        num_prefix, num_suffix = len(self.prefix), len(self.suffix)
+        max_tokens = int(num_tokens.max()) if batch_size > 0 else 0
+        width = num_prefix + max_tokens + num_suffix
+
+        # Right-padded layout first: prefix, tokens, suffix, then padding
+        input_ids = torch.full((batch_size, width), self.pad_id, dtype=torch.long)
+        input_ids[:,:num_prefix] = self.prefix
+        input_ids[:,num_prefix:num_prefix + max_tokens] = token_ids[:,:max_tokens]
+
+        pos = torch.arange(width)
+        totals = num_prefix + num_tokens + num_suffix
+        input_ids[pos[None,:] >= (num_prefix + num_tokens)[:,None]] = self.pad_id
+        if num_suffix > 0:
+            suffix_pos = (num_prefix + num_tokens)[:,None] + torch.arange(num_suffix)[None,:]
+            input_ids.scatter_(1, suffix_pos, self.suffix.expand(batch_size, -1))
+        attention_mask = (pos[None,:] < totals[:,None]).long()
+        indices = token_idx + num_prefix
+
+        if self.padding_side == "left":
+            shift = (width - totals)[:,None]
+            gather_pos = (pos[None,:] - shift) % width
+            input_ids = input_ids.gather(1, gather_pos)
+            attention_mask = attention_mask.gather(1, gather_pos)
+            indices = indices + shift
+
+        encoded = {"input_ids": input_ids}
+        if self.return_attention_mask:
+            encoded["attention_mask"] = attention_mask
+        if return_indices:
+            encoded["indices"] = indices
+
+        return encoded
+
+
+class KmerTokenizer(CharTokenizer):
+    """
+    Tensor-native tokenizer for non-overlapping k-mer vocabularies (Nucleotide Transformer). Like the HF
+    tokenizer, each run of ACGT bases between Ns is split into k-mers from its start, and the run's remainder and
+    each N become single-base tokens. K-mer ids are computed arithmetically from base-4 values of each window.
+    """
+    _probe = "ACGTACGTTGCANACGNTTGCAACGGCATAACGTTC"
+
+    def __init__(self, tokenizer, k=6):
+        self.k = k
+        kmers = ["".join(p) for p in itertools.product(_BASES[:4], repeat=k)] # Ordered by base-4 value
+        self.kmer_lut = torch.tensor(tokenizer.convert_tokens_to_ids(kmers), dtype=torch.long)
+
+        super().__init__(tokenizer)
+
+    def _encode_tokens(self, codes, lengths):
+        batch_size, seq_len = codes.shape
+        pos = torch.arange(seq_len).expand(batch_size, -1)
+
+        # Runs of ACGT bases, delimited by Ns and the end of each sequence
+        valid = pos < lengths[:,None]
+        is_break = (codes == _N) | ~valid
+        run_start = torch.cummax(torch.where(is_break, pos, -1), dim=1).values + 1
+        run_end = torch.cummin(torch.where(is_break, pos, seq_len).flip(1), dim=1).values.flip(1)
+        run_offset = pos - run_start
+        in_kmer = ~is_break & (run_offset < (run_end - run_start) // self.k * self.k)
+
+        kmer_start = in_kmer & (run_offset % self.k == 0)
+        single = valid & ~in_kmer
+        token_start = kmer_start | single
+
+        token_idx = torch.cumsum(token_start, dim=1) - 1
+        num_tokens = token_start.sum(dim=1)
+
+        # Base-4 value of the k bases starting at each position
+        values = torch.zeros_like(codes)
+        for j in range(self.k):
+            shifted = torch.zeros_like(codes)
+            shifted[:,:max(seq_len - j, 0)] = codes[:,j:].clamp(max=3)
+            values = values * 4 + shifted
+
+        ids = torch.where(kmer_start, self.kmer_lut[values], self.lut[codes])
+
+        max_tokens = int(num_tokens.max()) if batch_size > 0 else 0
+        token_ids = torch.full((batch_size, max_tokens), self.pad_id, dtype=torch.long)
+        rows, cols = torch.nonzero(token_start, as_tuple=True)
+        token_ids[rows, token_idx[rows, cols]] = ids[rows, cols]
+
+        return token_ids, num_tokens, token_idx
+
+
+def offsets_to_indices(offsets, seq_len):
+    """
+    Maps (B, T, 2) token offset mappings to the (B, seq_len) index of the token covering each base, on the device
+    of `offsets`. Bases covered by no token map to 0, and where token spans overlap the later token wins, as when
+    filling the indices token by token. Each span is expanded to its bases with repeat_interleave and the token
+    indices are scattered with a max reduction.
+    """
+    offsets = torch.as_tensor(offsets)
+    batch_size, num_tokens = offsets.shape[:2]
+    device = offsets.device
+
+    starts = offsets[:,:,0].long().clamp(0, seq_len).flatten()
+    ends = offsets[:,:,1].long().clamp(0, seq_len).flatten()
+    span_lens = (ends - starts).clamp(min=0)
+
+    # One entry per (token, covered base)
+    span_idx = torch.repeat_interleave(torch.arange(batch_size * num_tokens, device=device), span_lens)
+    span_base = torch.cumsum(span_lens, dim=0) - span_lens
+    base_pos = starts[span_idx] + torch.arange(span_idx.shape[0], device=device) - span_base[span_idx]
+    flat_pos = (span_idx // num_tokens) * seq_len + base_pos
+    token_idx = span_idx % num_tokens
+
+    indices = torch.zeros(batch_size * seq_len, dtype=torch.long, device=device)
+    indices.scatter_reduce_(0, flat_pos, token_idx, reduce="amax")
+
+    return indices.view(batch_size, seq_len)
+
+
+def tokenize_in_workers():
+    """
+    Whether HF tokenization runs in DataLoader workers, set through DART_TOKENIZE_IN_WORKERS.
+    """
+    return os.environ.get("DART_TOKENIZE_IN_WORKERS", "0").lower() not in ("", "0", "false")
+
+
+class TokenizingCollate:
+    """
+    Picklable DataLoader collate function that runs the HF tokenizer inside the workers, so that tokenization
+    overlaps model compute in the main process. The one-hot sequences at `seq_fields` of each item are replaced
+    by a TokenBatch, the same as tokenizing the collated batch with padding=True.
+    """
+    def __init__(self, tokenizer, seq_fields=(0,), return_offsets=False):
+        self.tokenizer = tokenizer
+        self.seq_fields = seq_fields
+        self.return_offsets = return_offsets
+
+    def tokenize(self, seqs):
+        seqs_str = onehot_to_chars(seqs)
+        if self.return_offsets:
+            encoded = self.tokenizer(seqs_str, return_tensors="pt", padding=True, return_offsets_mapping=True)
+        else:
+            encoded = self.tokenizer(seqs_str, return_tensors="pt", padding=True)
+
+        return TokenBatch(encoded["input_ids"], encoded.get("attention_mask"), encoded.get("offset_mapping"),
+                          seqs.shape[1])
+
+    def __call__(self, items):
+        batch = default_collate(items)
+        if isinstance(batch, torch.Tensor):
+            return self.tokenize(batch)
+
+        return [self.tokenize(x) if i in self.seq_fields else x for i, x in enumerate(batch)]
+
+
+def loader_collate_fn(dataset, owner, seq_fields=(0,), return_offsets=False):
+    """
+    Collate function for a DataLoader over `dataset` feeding `owner` (a model or evaluator): the dataset's own
+    if it has one (token cache rows), a TokenizingCollate when tokenizing in workers and the owner uses its HF
+    tokenizer, or None for default collation. Tensor tokenizers stay in the main process, as they are a
+    vectorized pass over the batch.
+    """
+    collate_fn = getattr(dataset, "collate_fn", None)
+    if collate_fn is not None:
+        return collate_fn
+
+    tokenizer = getattr(owner, "tokenizer", None)
+    if tokenize_in_workers() and tokenizer is not None and getattr(owner, "tensor_tokenizer", None) is None:
+        return TokenizingCollate(tokenizer, seq_fields=seq_fields, return_offsets=return_offsets)
+
+    return None
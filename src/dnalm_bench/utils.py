@@ -1,10 +1,12 @@
 import sys
-import shutil
 import math
+import hashlib
 
 import numpy as np
 import torch
 
+from .encoding import encode_one_hot
+
 ALPHABET = np.array(["A","C","G","T"], dtype="S1")
 
 def onehot_to_chars(onehot):
@@ -15,20 +17,7 @@ def onehot_to_chars(onehot):
 
 
 def one_hot_encode(sequence):
-    sequence = sequence.upper()
-
-    seq_chararray = np.frombuffer(sequence.encode('UTF-8'), dtype='S1')
-    one_hot = (seq_chararray[:,None] == ALPHABET[None,:]).astype(np.int8)
-
-    return one_hot
-
-
-def copy_if_not_exists(src, dst):
-    try:
-        with open(src, "rb") as sf, open(dst, "xb") as f:
-            shutil.copyfileobj(sf, f)
-    except FileExistsError:
-        pass
+    return encode_one_hot(sequence)
 
 
 class NoModule:
@@ -87,6 +76,90 @@ def dinucleotide_shuffle(seq, rng):
 
     return shuffled
 
+_SPLITMIX_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+_SPLITMIX_C1 = np.uint64(0xBF58476D1CE4E5B9)
+_SPLITMIX_C2 = np.uint64(0x94D049BB133111EB)
+_KEY_MAX = np.uint64(2**64 - 1)
+
+def splitmix64(x):
+    """
+    Counter-based 64-bit mixing function (SplitMix64 finalizer), applied elementwise.
+    """
+    with np.errstate(over="ignore"):
+        z = np.asarray(x, dtype=np.uint64) + _SPLITMIX_GAMMA
+        z = (z ^ (z >> np.uint64(30))) * _SPLITMIX_C1
+        z = (z ^ (z >> np.uint64(27))) * _SPLITMIX_C2
+    return z ^ (z >> np.uint64(31))
+
+
+def _string_key(s):
+    return int.from_bytes(hashlib.sha256(s.encode("utf-8")).digest()[:8], "little")
+
+
+def dinucleotide_shuffle_keys(seed, chroms, elem_starts, elem_ends, replicates=0):
+    """
+    Deterministic per-element stream keys for `dinucleotide_shuffle_batch`, derived from the seed, the element
+    coordinates and the replicate index, so each control does not depend on batch composition or row order.
+    """
+    chrom_keys = np.array([_string_key(c) for c in chroms], dtype=np.uint64)
+    keys = splitmix64(np.full(len(chrom_keys), seed, dtype=np.uint64))
+    for values in (chrom_keys, elem_starts, elem_ends):
+        keys = splitmix64(keys ^ np.asarray(values, dtype=np.uint64))
+    keys = splitmix64(keys ^ np.broadcast_to(np.asarray(replicates, dtype=np.uint64), keys.shape))
+
+    return keys
+
+
+def dinucleotide_shuffle_batch(tokens, lengths, keys, num_tokens=5):
+    """
+    Batched dinucleotide shuffle of token sequences (B, L), each valid up to its length, with one stream key per
+    row. Follows the deeplift algorithm: the successors of each token are randomly permuted (keeping the last
+    one fixed) and the resulting Eulerian path is walked, one step for the whole batch at a time.
+    """
+    tokens = np.asarray(tokens)
+    lengths = np.asarray(lengths)
+    num_seqs, seq_len = tokens.shape
+    result = tokens.copy()
+    if seq_len < 2:
+        return result
+
+    rows = np.arange(num_seqs)
+    pos = np.arange(seq_len - 1)
+
+    # Token at each position that has a successor; positions past the end of a sequence get their own group
+    has_succ = pos[None,:] < (lengths[:,None] - 1)
+    succ_tokens = np.where(has_succ, tokens[:,:-1], num_tokens)
+
+    # Random sort keys per (sequence, position), with the last successor of each token pinned to the end
+    with np.errstate(over="ignore"):
+        sort_keys = splitmix64(keys[:,None] + pos[None,:].astype(np.uint64)) >> np.uint64(1)
+    for t in range(num_tokens):
+        mask = succ_tokens == t
+        last = seq_len - 2 - np.argmax(mask[:,::-1], axis=1)
+        present = mask.any(axis=1)
+        sort_keys[rows[present], last[present]] = _KEY_MAX
+
+    group_ids = rows[:,None] * (num_tokens + 1) + succ_tokens
+    order = np.lexsort((sort_keys.ravel(), group_ids.ravel()))
+    shuf_next_inds = np.broadcast_to(pos + 1, succ_tokens.shape).ravel()[order]
+
+    group_counts = np.bincount(group_ids.ravel(), minlength=num_seqs * (num_tokens + 1))
+    group_starts = (np.cumsum(group_counts) - group_counts).reshape(num_seqs, num_tokens + 1)
+
+    # Walk all sequences in lockstep
+    counters = np.zeros((num_seqs, num_tokens + 1), dtype=np.int64)
+    ind = np.zeros(num_seqs, dtype=np.int64)
+    for j in range(1, seq_len):
+        active = j < lengths
+        t = tokens[rows, ind]
+        next_ind = shuf_next_inds[np.where(active, group_starts[rows, t] + counters[rows, t], 0)]
+        counters[rows, t] += active
+        ind = np.where(active, next_ind, ind)
+        result[:,j] = np.where(active, tokens[rows, ind], result[:,j])
+
+    return result
+
+
 def log1mexp(x):
     """
     Numerically accurate evaluation of log(1 - exp(x)) for x < 0.